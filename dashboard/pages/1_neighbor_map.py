@@ -14,14 +14,21 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from utils.data_loader import (
     load_poi_data,
     load_filter_options,
+    query_poi_store,
+    load_map_tiles,
+    tile_level_for_zoom,
     filter_poi_by_category,
     filter_poi_by_naics,
 )
 from utils.map_utils import (
+    map_payload,
     create_scatter_layer,
+    create_cell_layer,
     create_map_view,
     create_tooltip,
+    create_cell_tooltip,
     create_deck,
+    get_viewport_bounds,
 )
 
 st.set_page_config(
@@ -33,7 +40,8 @@ st.set_page_config(
 st.title("🗺️ Partisan Lean Map")
 st.markdown("""
 POIs colored by **consumer partisan lean** - red indicates more Republican customers,
-blue indicates more Democratic customers. Filter by category or NAICS to compare similar businesses.
+blue indicates more Democratic customers. Switch to **excess lean** to see how each POI
+differs from its neighbors. Filter by category or NAICS to compare similar businesses.
 """)
 
 
@@ -74,9 +82,31 @@ STATE_NAMES = {
 }
 
 
+# Views zoomed out further than this draw aggregated tiles in "Auto" mode
+POINT_ZOOM = 6
+
+MAP_COLUMNS = ['latitude', 'longitude', 'location_name', 'brand', 'city', 'region',
+               'mean_rep_lean_2020', 'excess_lean_2020', 'total_visitors', 'top_category', 'naics_code']
+
+# Built by scripts/dashboard/01_compute_neighbor_lean.py
+COLOR_OPTIONS = {
+    "Partisan lean": 'mean_rep_lean_2020',
+    "Excess lean vs neighbors": 'excess_lean_2020',
+}
+
+
 @st.cache_data(ttl=3600)
 def get_sampled_data(state, category, naics_2, sample_size=50000):
-    """Load and sample POI data for a specific state."""
+    """Load and sample POI data for a specific state.
+
+    Reads only the matching row groups of the full spatial POI store when it
+    has been built; otherwise filters the 500k-row sample in memory.
+    """
+    df = query_poi_store(region=state, category=category, naics_2=naics_2,
+                         columns=MAP_COLUMNS, sample_size=sample_size)
+    if df is not None:
+        return df
+
     df = load_poi_data()
     if df is None:
         return None
@@ -93,6 +123,15 @@ def get_sampled_data(state, category, naics_2, sample_size=50000):
     return df
 
 
+@st.cache_data(ttl=3600)
+def get_map_payload(state, category, naics_2, sample_size=50000, color_column='mean_rep_lean_2020'):
+    """Coordinates, tooltips and radii for the current filters (independent of color scale)."""
+    df = get_sampled_data(state, category, naics_2, sample_size)
+    if df is None or len(df) == 0 or color_column not in df.columns:
+        return None
+    return map_payload(df, color_column=color_column, size_by_visitors=True)
+
+
 with st.sidebar:
     st.header("Location")
 
@@ -118,93 +157,143 @@ with st.sidebar:
         st.warning("Filter options not loaded")
 
     st.header("Map Settings")
+    color_by = st.selectbox("Color by", list(COLOR_OPTIONS), index=0,
+                            help="Excess lean is the POI's lean minus the visit-weighted "
+                                 "lean of its nearest neighbors")
+    color_column = COLOR_OPTIONS[color_by]
     color_scale = st.slider("Color intensity", 0.05, 0.5, 0.15, 0.01,
-                           help="Excess lean value for full color saturation")
+                           help="Deviation from neutral for full color saturation")
+    display_mode = st.radio("Display", ["Auto", "Aggregated cells", "Points"], index=0,
+                            help="Auto shows aggregated cells for the national view and points for states")
     point_radius = st.slider("Point size", 50, 500, 150, 10)
     sample_size = st.slider("Max points", 10000, 100000, 50000, 5000,
                            help="Sample size for performance")
 
 
-df = get_sampled_data(selected_state, selected_category, selected_naics, sample_size)
-
-if df is None:
-    st.error("Data not available. Please wait for data preparation to complete.")
-    st.stop()
-
-if len(df) == 0:
-    st.warning("No POIs match the current filters.")
-    st.stop()
-
-if selected_state == "All States":
-    st.info(f"Showing {len(df):,} POIs (sampled from national dataset)")
-else:
-    st.info(f"Showing {len(df):,} POIs in {STATE_NAMES.get(selected_state, selected_state)}")
-
-col1, col2, col3, col4 = st.columns(4)
-with col1:
-    st.metric("POIs Displayed", f"{len(df):,}")
-with col2:
-    st.metric("Unique Brands", f"{df['brand'].nunique():,}")
-with col3:
-    mean_lean = df['mean_rep_lean_2020'].mean()
-    st.metric("Mean Rep Lean", f"{mean_lean:.3f}" if pd.notna(mean_lean) else "N/A")
-with col4:
-    std_lean = df['mean_rep_lean_2020'].std()
-    st.metric("Std Dev", f"{std_lean:.3f}" if pd.notna(std_lean) else "N/A")
-
 if selected_state != "All States" and selected_state in STATE_CENTERS:
     center_lat, center_lon, zoom = STATE_CENTERS[selected_state]
 else:
     center_lat, center_lon, zoom = 39.8, -98.5, 4
 view_state = create_map_view(center_lat, center_lon, zoom)
 
-try:
-    map_df = df.copy()
+tiles = None
+if display_mode == "Aggregated cells" or (display_mode == "Auto" and zoom < POINT_ZOOM):
+    bounds = None if selected_state == "All States" else get_viewport_bounds(view_state)
+    tiles = load_map_tiles(tile_level_for_zoom(zoom), selected_category, selected_naics, bounds)
+    if tiles is not None and color_column not in tiles.columns:
+        tiles = None
+    if tiles is None:
+        st.caption("Aggregated cells are not available for this filter combination or color; showing points.")
+
+if tiles is not None:
+    if len(tiles) == 0:
+        st.warning("No POIs match the current filters.")
+        st.stop()
+
+    n_pois = int(tiles['n_pois'].sum())
+    st.info(f"Showing all {n_pois:,} POIs aggregated into {len(tiles):,} map cells")
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("POIs Aggregated", f"{n_pois:,}")
+    with col2:
+        st.metric("Map Cells", f"{len(tiles):,}")
+    with col3:
+        # Cell means are visit-weighted; weight them back by their visitors
+        leaned = tiles[tiles['mean_rep_lean_2020'].notna() & (tiles['total_visitors'] > 0)]
+        mean_lean = ((leaned['mean_rep_lean_2020'] * leaned['total_visitors']).sum() /
+                     leaned['total_visitors'].sum()) if len(leaned) else float('nan')
+        st.metric("Mean Rep Lean (visit-weighted)", f"{mean_lean:.3f}" if pd.notna(mean_lean) else "N/A")
+    with col4:
+        std_lean = tiles['mean_rep_lean_2020'].std()
+        st.metric("Std Dev (cells)", f"{std_lean:.3f}" if pd.notna(std_lean) else "N/A")
+
+    try:
+        layer = create_cell_layer(tiles, color_column=color_column, scale=color_scale)
+        deck = create_deck([layer], view_state, create_cell_tooltip(color_by))
+        st.pydeck_chart(deck, use_container_width=True)
+    except Exception as e:
+        st.error(f"Error rendering map: {e}")
+
+else:
+    df = get_sampled_data(selected_state, selected_category, selected_naics, sample_size)
+
+    if df is None:
+        st.error("Data not available. Please wait for data preparation to complete.")
+        st.stop()
+
+    if len(df) == 0:
+        st.warning("No POIs match the current filters.")
+        st.stop()
 
-    if 'location_name' in map_df.columns:
-        map_df['display_name'] = map_df['location_name'].fillna('Unknown')
+    if selected_state == "All States":
+        st.info(f"Showing {len(df):,} POIs (sampled from national dataset)")
     else:
-        map_df['display_name'] = map_df['brand'].fillna(map_df['top_category'].fillna('Unknown'))
-
-    def format_brand(brand):
-        if pd.isna(brand) or brand == 'Unbranded' or brand == '':
-            return ''
-        return f'<b>Brand:</b> {brand}<br/>'
-    map_df['brand_display'] = map_df['brand'].apply(format_brand)
-
-    map_df['lean_display'] = map_df['mean_rep_lean_2020'].apply(
-        lambda x: f'{x:.3f}' if pd.notna(x) else 'N/A'
-    )
-    map_df['visitors_display'] = map_df['total_visitors'].apply(
-        lambda x: f'{int(x):,}' if pd.notna(x) else 'N/A'
-    )
-
-    layer = create_scatter_layer(map_df, color_column='mean_rep_lean_2020', scale=color_scale,
-                                radius=point_radius, size_by_visitors=True)
-    tooltip = create_tooltip()
-    deck = create_deck([layer], view_state, tooltip)
-    st.pydeck_chart(deck, use_container_width=True)
-except Exception as e:
-    st.error(f"Error rendering map: {e}")
-    st.write("Falling back to simple map...")
-    st.map(df[['latitude', 'longitude']].dropna().head(10000))
+        st.info(f"Showing {len(df):,} POIs in {STATE_NAMES.get(selected_state, selected_state)}")
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("POIs Displayed", f"{len(df):,}")
+    with col2:
+        st.metric("Unique Brands", f"{df['brand'].nunique():,}")
+    with col3:
+        mean_lean = df['mean_rep_lean_2020'].mean()
+        st.metric("Mean Rep Lean", f"{mean_lean:.3f}" if pd.notna(mean_lean) else "N/A")
+    with col4:
+        std_lean = df['mean_rep_lean_2020'].std()
+        st.metric("Std Dev", f"{std_lean:.3f}" if pd.notna(std_lean) else "N/A")
+
+    try:
+        # Cached per filter; a color intensity change only recolors the payload
+        map_df = get_map_payload(selected_state, selected_category, selected_naics, sample_size,
+                                 color_column)
+        if map_df is None:
+            st.error(f"{color_by} is not available yet. Run scripts/dashboard/01_compute_neighbor_lean.py.")
+            st.stop()
+
+        layer = create_scatter_layer(map_df, color_column=color_column, scale=color_scale,
+                                    radius=point_radius, size_by_visitors=True)
+        tooltip = create_tooltip()
+        deck = create_deck([layer], view_state, tooltip)
+        st.pydeck_chart(deck, use_container_width=True)
+    except Exception as e:
+        st.error(f"Error rendering map: {e}")
+        st.write("Falling back to simple map...")
+        st.map(df[['latitude', 'longitude']].dropna().head(10000))
 
 st.markdown("---")
 
 st.subheader("Legend")
 col1, col2, col3 = st.columns(3)
 with col1:
-    st.markdown("🔴 **Red**: Republican-leaning customers (>0.5)")
+    if color_column == 'excess_lean_2020':
+        st.markdown("🔴 **Red**: More Republican customers than nearby POIs (>0)")
+    else:
+        st.markdown("🔴 **Red**: Republican-leaning customers (>0.5)")
 with col2:
-    st.markdown("⚪ **Gray/White**: Neutral (~0.5)")
+    if color_column == 'excess_lean_2020':
+        st.markdown("⚪ **Gray/White**: Similar to nearby POIs (~0)")
+    else:
+        st.markdown("⚪ **Gray/White**: Neutral (~0.5)")
 with col3:
-    st.markdown("🔵 **Blue**: Democratic-leaning customers (<0.5)")
+    if color_column == 'excess_lean_2020':
+        st.markdown("🔵 **Blue**: More Democratic customers than nearby POIs (<0)")
+    else:
+        st.markdown("🔵 **Blue**: Democratic-leaning customers (<0.5)")
 
 st.markdown("---")
 
 st.subheader("Sample Data")
 with st.expander("Show data table"):
-    display_cols = ['brand', 'city', 'region', 'mean_rep_lean_2020',
-                   'total_visitors', 'top_category', 'naics_code']
-    display_df = df[display_cols].sort_values('mean_rep_lean_2020', ascending=False).head(100)
+    if tiles is not None:
+        display_cols = ['quadkey', 'latitude', 'longitude', 'n_pois', 'total_visitors',
+                        'mean_rep_lean_2020', 'excess_lean_2020']
+        display_cols = [c for c in display_cols if c in tiles.columns]
+        display_df = tiles[display_cols].sort_values('n_pois', ascending=False).head(100)
+    else:
+        display_cols = ['brand', 'city', 'region', 'mean_rep_lean_2020', 'excess_lean_2020',
+                       'total_visitors', 'top_category', 'naics_code']
+        display_cols = [c for c in display_cols if c in df.columns]
+        sort_column = color_column if color_column in df.columns else 'mean_rep_lean_2020'
+        display_df = df[display_cols].sort_values(sort_column, ascending=False).head(100)
     st.dataframe(display_df.round(3), width="stretch")
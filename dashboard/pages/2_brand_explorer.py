@@ -9,7 +9,7 @@ import pandas as pd
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from utils.data_loader import load_brand_summary, load_poi_data
+from utils.data_loader import load_brand_summary, load_poi_table
 from utils.map_utils import create_scatter_layer, create_map_view, create_tooltip, create_deck
 
 st.set_page_config(
@@ -105,12 +105,9 @@ if selected_brands:
 
     st.subheader("Brand Location Map")
 
-    poi_data = load_poi_data()
-    if poi_data is not None:
-        brand_pois = poi_data[poi_data['brand'].isin(selected_brands)]
-
-        if len(brand_pois) > 10000:
-            brand_pois = brand_pois.sample(n=10000, random_state=42)
+    poi_table = load_poi_table()
+    if poi_table is not None:
+        brand_pois = poi_table.brand_pois(selected_brands, sample_size=10000)
 
         if len(brand_pois) > 0:
             view_state = create_map_view()
@@ -9,7 +9,7 @@ import pandas as pd
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from utils.data_loader import load_msa_summary, load_poi_data, load_brand_summary
+from utils.data_loader import load_msa_summary, load_poi_table
 from utils.map_utils import create_scatter_layer, create_map_view, create_tooltip, create_deck
 
 st.set_page_config(
@@ -84,11 +84,10 @@ selected_msa = st.selectbox(
 )
 
 if selected_msa:
-    poi_data = load_poi_data()
-    brand_summary = load_brand_summary()
+    poi_table = load_poi_table()
 
-    if poi_data is not None:
-        msa_pois = poi_data[poi_data['cbsa_title'] == selected_msa]
+    if poi_table is not None:
+        msa_pois = poi_table.msa_pois(selected_msa, columns=['brand', 'mean_rep_lean_2020'])
 
         st.markdown(f"**{selected_msa}**: {len(msa_pois):,} POIs")
 
@@ -101,14 +100,8 @@ if selected_msa:
             mean_lean = msa_pois['mean_rep_lean_2020'].mean()
             st.metric("Mean Rep Lean", f"{mean_lean:.3f}")
 
-        msa_brands = msa_pois[msa_pois['brand'].notna()].groupby('brand').agg({
-            'placekey': 'count',
-            'mean_rep_lean_2020': ['mean', 'std'],
-            'total_visitors': 'sum',
-        }).reset_index()
-        msa_brands.columns = ['brand', 'locations', 'mean_rep_lean', 'std_rep_lean', 'total_visitors']
-        msa_brands = msa_brands[msa_brands['locations'] >= 3]
-        msa_brands = msa_brands.sort_values('mean_rep_lean', ascending=False)
+        # Aggregated once per server process, not on every rerun
+        msa_brands = poi_table.msa_brand_summary(selected_msa, min_locations=3)
 
         st.markdown("**Brands in this MSA (3+ locations)**")
         st.dataframe(msa_brands.head(30).round(3), width="stretch", hide_index=True)
@@ -117,10 +110,7 @@ if selected_msa:
 
         st.subheader("Map of Selected MSA")
 
-        if len(msa_pois) > 5000:
-            map_pois = msa_pois.sample(n=5000, random_state=42)
-        else:
-            map_pois = msa_pois
+        map_pois = poi_table.msa_pois(selected_msa, sample_size=5000)
 
         center_lat = map_pois['latitude'].mean()
         center_lon = map_pois['longitude'].mean()
@@ -2,10 +2,20 @@
 
 from .data_loader import (
     load_poi_data,
+    PoiTable,
+    load_poi_table,
     load_brand_summary,
     load_msa_summary,
     load_filter_options,
     check_data_available,
+    poi_store_available,
+    load_poi_store_index,
+    select_row_groups,
+    query_poi_store,
+    load_poi_viewport,
+    map_tiles_available,
+    tile_level_for_zoom,
+    load_map_tiles,
     filter_poi_by_viewport,
     filter_poi_by_category,
     filter_poi_by_naics,
@@ -13,8 +23,15 @@ from .data_loader import (
 )
 
 from .map_utils import (
+    lean_colors,
     get_color_for_lean,
+    visitor_radius,
+    format_thousands,
+    format_tooltip_columns,
+    map_payload,
     create_scatter_layer,
+    create_cell_layer,
+    create_cell_tooltip,
     create_map_view,
     create_tooltip,
     create_deck,
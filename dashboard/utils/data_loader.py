@@ -3,11 +3,22 @@ Data loading utilities for the Stakeholder Ideology Dashboard.
 """
 
 import pandas as pd
+import numpy as np
 import json
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import streamlit as st
 
 DATA_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology/dashboard_data")
+# Built by scripts/dashboard/02_build_poi_store.py
+POI_STORE_DIR = DATA_DIR / "poi_store"
+# Built by scripts/dashboard/03_build_map_tiles.py
+MAP_TILES_FILE = DATA_DIR / "map_tiles.parquet"
+MAP_TILE_LEVELS = range(4, 13)
+# Tile level = map zoom + offset, i.e. cells ~8 px across (256 px / 2^5)
+TILE_LEVEL_OFFSET = 5
 
 
 @st.cache_data(ttl=3600)
@@ -28,6 +39,98 @@ def load_poi_data(sampled=True):
     return pd.read_parquet(path)
 
 
+class PoiTable:
+    """
+    POI table shared by every session, with row indices per MSA and brand.
+
+    Holds the Arrow table itself (no pandas copy) plus, for each cbsa_title
+    and brand, the row positions of its POIs, so a page slices one MSA or a
+    few brands with a take() instead of a boolean mask over every row.
+    Brand statistics within each MSA are aggregated once when it is built.
+    Read-only after construction.
+    """
+
+    def __init__(self, table):
+        self.table = table.combine_chunks()
+        self.msa_rows = self._group_rows('cbsa_title')
+        self.brand_rows = self._group_rows('brand')
+        self.msa_brands = self._msa_brand_stats()
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def _group_rows(self, column):
+        """{value: sorted row positions} for a column (nulls skipped)."""
+        if column not in self.table.column_names:
+            return {}
+        encoded = pc.dictionary_encode(self.table[column]).combine_chunks()
+        codes = pc.fill_null(encoded.indices, -1).to_numpy(zero_copy_only=False)
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes[codes >= 0], minlength=len(encoded.dictionary))
+        groups = np.split(order[len(codes) - counts.sum():], np.cumsum(counts)[:-1])
+        return dict(zip(encoded.dictionary.to_pylist(), groups))
+
+    def _msa_brand_stats(self):
+        """{cbsa_title: its brands' locations, mean/std lean and visitors}, most Republican first."""
+        needed = ['cbsa_title', 'brand', 'placekey', 'mean_rep_lean_2020', 'total_visitors']
+        if not all(c in self.table.column_names for c in needed):
+            return None
+        branded = self.table.select(needed).filter(pc.is_valid(self.table['brand']))
+        stats = branded.group_by(['cbsa_title', 'brand']).aggregate([
+            ('placekey', 'count'),
+            ('mean_rep_lean_2020', 'mean'),
+            ('mean_rep_lean_2020', 'stddev', pc.VarianceOptions(ddof=1)),
+            ('total_visitors', 'sum'),
+        ]).to_pandas()
+        stats.columns = ['cbsa_title', 'brand', 'locations', 'mean_rep_lean',
+                         'std_rep_lean', 'total_visitors']
+        stats = stats.sort_values('mean_rep_lean', ascending=False)
+        return {msa: group.drop(columns='cbsa_title').reset_index(drop=True)
+                for msa, group in stats.groupby('cbsa_title', sort=False)}
+
+    def take(self, rows, columns=None, sample_size=None):
+        """Rows as a DataFrame, optionally a reproducible sample of them."""
+        if sample_size is not None and len(rows) > sample_size:
+            rows = np.sort(np.random.default_rng(42).choice(rows, sample_size, replace=False))
+        table = self.table if columns is None else self.table.select(columns)
+        return table.take(pa.array(rows, type=pa.int64())).to_pandas()
+
+    def msa_pois(self, msa, columns=None, sample_size=None):
+        """POIs in one MSA (cbsa_title)."""
+        rows = self.msa_rows.get(msa, np.array([], dtype=np.int64))
+        return self.take(rows, columns, sample_size)
+
+    def brand_pois(self, brands, columns=None, sample_size=None):
+        """POIs of any of the given brands."""
+        parts = [self.brand_rows[b] for b in brands if b in self.brand_rows]
+        rows = np.sort(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+        return self.take(rows, columns, sample_size)
+
+    def msa_brand_summary(self, msa, min_locations=1):
+        """Brands in one MSA with at least min_locations POIs, most Republican first."""
+        if self.msa_brands is None or msa not in self.msa_brands:
+            return pd.DataFrame(columns=['brand', 'locations', 'mean_rep_lean',
+                                         'std_rep_lean', 'total_visitors'])
+        brands = self.msa_brands[msa]
+        return brands[brands['locations'] >= min_locations].reset_index(drop=True)
+
+
+@st.cache_resource
+def load_poi_table(sampled=True):
+    """Process-wide PoiTable over the same file load_poi_data() reads.
+
+    Unlike st.cache_data, the cached object is shared by reference across
+    reruns, pages and sessions, so it is loaded and indexed once per server
+    process and never pickled or copied. Returns None if no POI file exists.
+    """
+    path = DATA_DIR / "poi_sampled.parquet"
+    if not (sampled and path.exists()):
+        path = DATA_DIR / "poi_with_coords.parquet"
+    if not path.exists():
+        return None
+    return PoiTable(pq.read_table(path, memory_map=True))
+
+
 @st.cache_data(ttl=3600)
 def load_brand_summary():
     """Load brand-level summary statistics."""
@@ -68,6 +171,157 @@ def check_data_available():
     return len(missing) == 0, missing
 
 
+def poi_store_available():
+    """Check if the spatially indexed POI store has been built."""
+    return (POI_STORE_DIR / "index.parquet").exists() and (POI_STORE_DIR / "values.parquet").exists()
+
+
+@st.cache_data(ttl=3600)
+def load_poi_store_index():
+    """Load the POI store's row group index and per-row-group filter values."""
+    groups = pd.read_parquet(POI_STORE_DIR / "index.parquet")
+    values = pd.read_parquet(POI_STORE_DIR / "values.parquet")
+    return groups, values
+
+
+def select_row_groups(region=None, bounds=None, category=None, naics_2=None):
+    """Row groups that can hold POIs matching the filters.
+
+    Args:
+        region: State code, or None / "All States" for every state.
+        bounds: (lat_min, lat_max, lon_min, lon_max) viewport, or None.
+        category: top_category value, or None / "All".
+        naics_2: 2-digit NAICS code, or None / "All".
+    """
+    groups, values = load_poi_store_index()
+    if region and region != "All States":
+        groups = groups[groups['region'] == region]
+    if bounds is not None:
+        lat_min, lat_max, lon_min, lon_max = bounds
+        groups = groups[
+            (groups['lat_max'] >= lat_min) & (groups['lat_min'] <= lat_max) &
+            (groups['lon_max'] >= lon_min) & (groups['lon_min'] <= lon_max)
+        ]
+    for column, value in (('top_category', category), ('naics_2', naics_2)):
+        if value and value != "All":
+            present = values[(values['column'] == column) & (values['value'] == str(value))]
+            groups = groups.merge(present[['file', 'row_group']], on=['file', 'row_group'])
+    return groups
+
+
+def query_poi_store(region=None, bounds=None, category=None, naics_2=None,
+                    columns=None, sample_size=None):
+    """Read POIs matching the filters, touching only the relevant row groups.
+
+    Row groups are chosen from the store index (state, viewport overlap,
+    category/NAICS membership); rows are then filtered exactly. With
+    sample_size, the matching rows with the smallest stored sample_key are
+    kept before conversion to pandas, so a national query never builds a
+    9M-row DataFrame and the sample is stable across reruns.
+    Returns None if the store has not been built.
+    """
+    if not poi_store_available():
+        return None
+    groups = select_row_groups(region, bounds, category, naics_2)
+
+    read_columns = None
+    if columns is not None:
+        filter_columns = ['sample_key', 'latitude', 'longitude', 'top_category', 'naics_2']
+        read_columns = list(dict.fromkeys(list(columns) + filter_columns))
+
+    tables = []
+    for file, file_groups in groups.groupby('file', sort=False):
+        parquet_file = pq.ParquetFile(POI_STORE_DIR / file)
+        file_columns = None
+        if read_columns is not None:
+            file_columns = [c for c in read_columns if c in parquet_file.schema_arrow.names]
+        tables.append(parquet_file.read_row_groups(file_groups['row_group'].tolist(), columns=file_columns))
+    if not tables:
+        return pd.DataFrame(columns=list(columns) if columns is not None else [])
+    table = pa.concat_tables(tables)
+
+    mask = pa.array(np.ones(len(table), dtype=bool))
+    if bounds is not None:
+        lat_min, lat_max, lon_min, lon_max = bounds
+        for column, low, high in (('latitude', lat_min, lat_max), ('longitude', lon_min, lon_max)):
+            mask = pc.and_(mask, pc.and_(pc.greater_equal(table[column], low), pc.less_equal(table[column], high)))
+    if category and category != "All":
+        mask = pc.and_(mask, pc.equal(table['top_category'], category))
+    if naics_2 and naics_2 != "All":
+        mask = pc.and_(mask, pc.equal(table['naics_2'], str(naics_2)))
+    mask = pc.fill_null(mask, False)
+
+    if sample_size is not None:
+        # Keep the sample_size matching rows with the smallest sample_key
+        keys = table['sample_key'].filter(mask).to_numpy()
+        if len(keys) > sample_size:
+            cutoff = np.partition(keys, sample_size - 1)[sample_size - 1]
+            mask = pc.and_(mask, pc.less_equal(table['sample_key'], cutoff))
+
+    df = table.filter(mask).to_pandas()
+    if sample_size is not None and len(df) > sample_size:
+        df = df.nsmallest(sample_size, 'sample_key')
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df.reset_index(drop=True)
+
+
+def load_poi_viewport(lat_min, lat_max, lon_min, lon_max, category=None, naics_2=None,
+                      columns=None, sample_size=None):
+    """POIs inside a viewport, read from the spatial store (None if not built)."""
+    return query_poi_store(bounds=(lat_min, lat_max, lon_min, lon_max), category=category,
+                           naics_2=naics_2, columns=columns, sample_size=sample_size)
+
+
+def map_tiles_available():
+    """Check if the multi-resolution map tiles have been built."""
+    return MAP_TILES_FILE.exists()
+
+
+def tile_level_for_zoom(zoom):
+    """Tile level whose cells are a few pixels across at a map zoom."""
+    level = int(round(zoom)) + TILE_LEVEL_OFFSET
+    return min(max(level, MAP_TILE_LEVELS[0]), MAP_TILE_LEVELS[-1])
+
+
+@st.cache_data(ttl=3600)
+def load_map_tiles(level, category=None, naics_2=None, bounds=None):
+    """Aggregated quadkey cells for one tile level and filter.
+
+    Tiles are precomputed for all POIs, per top_category and per naics_2, so
+    only one of category / naics_2 can be set. Returns None if the tiles have
+    not been built or the filter combination was not precomputed.
+
+    Args:
+        level: Tile level (see tile_level_for_zoom)
+        category: top_category value, or None / "All"
+        naics_2: 2-digit NAICS code, or None / "All"
+        bounds: (lat_min, lat_max, lon_min, lon_max) to crop to, or None
+    """
+    if not map_tiles_available():
+        return None
+    category = category if category and category != "All" else None
+    naics_2 = naics_2 if naics_2 and naics_2 != "All" else None
+    if category and naics_2:
+        return None
+    if category:
+        filter_column, filter_value = 'top_category', category
+    elif naics_2:
+        filter_column, filter_value = 'naics_2', str(naics_2)
+    else:
+        filter_column, filter_value = 'All', 'All'
+
+    # The file is sorted by filter and level, so this reads a few row groups
+    df = pq.read_table(MAP_TILES_FILE, filters=[
+        ('filter_column', '=', filter_column),
+        ('filter_value', '=', filter_value),
+        ('level', '=', level),
+    ]).to_pandas()
+    if bounds is not None:
+        df = filter_poi_by_viewport(df, *bounds)
+    return df.drop(columns=['filter_column', 'filter_value']).reset_index(drop=True)
+
+
 def filter_poi_by_viewport(df, lat_min, lat_max, lon_min, lon_max):
     """Filter POIs to a geographic viewport."""
     mask = (
@@ -4,6 +4,54 @@ Map visualization utilities for the Stakeholder Ideology Dashboard.
 
 import pydeck as pdk
 import numpy as np
+import pandas as pd
+
+
+NAN_COLOR = (160, 160, 160, 150)
+NEUTRAL_COLOR = (160, 160, 160, 180)
+POINT_ALPHA = 180
+
+# Columns referenced by create_tooltip()
+TOOLTIP_COLUMNS = ['display_name', 'city', 'region', 'brand_display',
+                   'lean_display', 'excess_display', 'visitors_display', 'top_category']
+
+# Color columns and the value shown as neutral grey
+COLOR_CENTERS = {'mean_rep_lean_2020': 0.5, 'excess_lean_2020': 0.0}
+
+
+def lean_colors(values, scale=0.5, neutral_zone=0.03, center=0.5):
+    """
+    Convert partisan lean values to RGBA colors in one vectorized pass.
+
+    Same ramp as get_color_for_lean: red above center, blue below, gray
+    within neutral_zone of center and for missing values.
+
+    Args:
+        values: Array-like of partisan lean (0 = full Dem, 1 = full Rep)
+        scale: How much deviation from center gives full color saturation
+        neutral_zone: Deviation from center that still counts as neutral (grey)
+        center: Neutral value (0.5 for lean, 0 for excess lean)
+
+    Returns:
+        (n, 4) uint8 array of [R, G, B, A]
+    """
+    values = np.asarray(values, dtype=np.float64)
+    deviation = values - center
+    effective_dev = deviation - np.sign(deviation) * neutral_zone
+    normalized = np.nan_to_num(np.clip(effective_dev / scale, -1, 1))
+
+    # Republican side fades green/blue out of white, Democratic side red/green
+    fade = (255 * (1 - np.abs(normalized))).astype(np.int64)
+    rep = normalized > 0
+    colors = np.empty((len(values), 4), dtype=np.uint8)
+    colors[:, 0] = np.where(rep, 255, fade)
+    colors[:, 1] = fade
+    colors[:, 2] = np.where(rep, fade, 255)
+    colors[:, 3] = POINT_ALPHA
+
+    colors[np.abs(deviation) <= neutral_zone] = NEUTRAL_COLOR
+    colors[np.isnan(values)] = NAN_COLOR
+    return colors
 
 
 def get_color_for_lean(lean_value, scale=0.5, neutral_zone=0.03):
@@ -22,31 +70,84 @@ def get_color_for_lean(lean_value, scale=0.5, neutral_zone=0.03):
     Returns:
         [R, G, B, A] color array
     """
-    if np.isnan(lean_value):
-        return [160, 160, 160, 150]
+    return lean_colors([lean_value], scale, neutral_zone)[0].tolist()
 
-    deviation = lean_value - 0.5
 
-    if abs(deviation) <= neutral_zone:
-        return [160, 160, 160, 180]
+def visitor_radius(visitors, min_radius=50, max_radius=500):
+    """Point radius scaled by log visitors between min_radius and max_radius."""
+    log_visitors = np.log1p(np.nan_to_num(np.asarray(visitors, dtype=np.float64), nan=0.0))
+    if len(log_visitors) and log_visitors.max() > log_visitors.min():
+        normalized = (log_visitors - log_visitors.min()) / (log_visitors.max() - log_visitors.min())
+    else:
+        normalized = np.full(len(log_visitors), 0.5)
+    return min_radius + normalized * (max_radius - min_radius)
+
+
+def format_thousands(values):
+    """Format non-negative integers with thousands separators (vectorized)."""
+    values = np.asarray(values, dtype=np.int64)
+    out = np.full(len(values), '', dtype=object)
+    n_groups = 1
+    while len(values) and values.max() >= 1000 ** n_groups:
+        n_groups += 1
+    for g in range(n_groups - 1, -1, -1):
+        part = (values // 1000 ** g) % 1000
+        present = (values >= 1000 ** g) | (g == 0)
+        leading = values < 1000 ** (g + 1)
+        text = np.where(leading, np.char.mod('%d', part), np.char.add(',', np.char.mod('%03d', part)))
+        out = np.where(present, out + text.astype(object), out)
+    return out
+
+
+def format_tooltip_columns(df):
+    """
+    Pre-format the tooltip fields create_tooltip() expects, without per-row apply.
 
-    if deviation > 0:
-        effective_dev = deviation - neutral_zone
+    Returns a copy of df with display_name, brand_display, lean_display,
+    excess_display and visitors_display added.
+    """
+    df = df.copy()
+    if 'location_name' in df.columns:
+        df['display_name'] = df['location_name'].fillna('Unknown')
     else:
-        effective_dev = deviation + neutral_zone
+        df['display_name'] = df['brand'].fillna(df['top_category'].fillna('Unknown'))
 
-    normalized = np.clip(effective_dev / scale, -1, 1)
+    brand = df['brand'].astype(object)
+    has_brand = brand.notna() & ~brand.isin(['Unbranded', ''])
+    df['brand_display'] = np.where(has_brand, '<b>Brand:</b> ' + brand.fillna('').astype(str) + '<br/>', '')
 
-    if normalized > 0:
-        r = 255
-        g = int(255 * (1 - normalized))
-        b = int(255 * (1 - normalized))
-    else:
-        r = int(255 * (1 + normalized))
-        g = int(255 * (1 + normalized))
-        b = 255
+    lean = df['mean_rep_lean_2020'].to_numpy(dtype=np.float64)
+    df['lean_display'] = np.where(np.isnan(lean), 'N/A', np.char.mod('%.3f', lean))
+
+    df['excess_display'] = ''
+    if 'excess_lean_2020' in df.columns:
+        excess = df['excess_lean_2020'].to_numpy(dtype=np.float64)
+        df['excess_display'] = np.where(np.isnan(excess), '',
+                                        np.char.add(np.char.add('<b>Excess vs Neighbors:</b> ',
+                                                                np.char.mod('%+.3f', excess)), '<br/>'))
 
-    return [r, g, b, 180]
+    visitors = df['total_visitors'].to_numpy(dtype=np.float64)
+    missing = np.isnan(visitors)
+    df['visitors_display'] = np.where(missing, 'N/A', format_thousands(np.where(missing, 0, visitors)))
+    return df
+
+
+def map_payload(df, color_column='mean_rep_lean_2020', size_by_visitors=False,
+                min_radius=50, max_radius=500):
+    """
+    Slim frame for create_scatter_layer: coordinates, tooltip strings, the
+    color column and (optionally) visitor-scaled radius.
+
+    Everything here is independent of the color scale, so pages can cache
+    the payload per filter and recolor it cheaply when only the scale changes.
+    """
+    if 'lean_display' not in df.columns:
+        df = format_tooltip_columns(df)
+    columns = ['longitude', 'latitude', color_column, 'radius'] + TOOLTIP_COLUMNS
+    payload = df[[c for c in dict.fromkeys(columns) if c in df.columns]].reset_index(drop=True)
+    if size_by_visitors and 'radius' not in payload.columns and 'total_visitors' in df.columns:
+        payload['radius'] = visitor_radius(df['total_visitors'], min_radius, max_radius)
+    return payload
 
 
 def create_scatter_layer(df, color_column='mean_rep_lean_2020', scale=0.2,
@@ -55,9 +156,11 @@ def create_scatter_layer(df, color_column='mean_rep_lean_2020', scale=0.2,
     Create a pydeck ScatterplotLayer for POI visualization.
 
     Args:
-        df: DataFrame with latitude, longitude, and color_column
+        df: DataFrame with latitude, longitude, and color_column, or a
+            payload from map_payload() (reused as is)
         color_column: Column to use for coloring points
-        scale: Color intensity scale (0.5 = full red/blue at 0.5 deviation from 0.5)
+        scale: Color intensity scale (0.5 = full red/blue at 0.5 deviation from
+            the column's neutral value, see COLOR_CENTERS)
         radius: Base point radius in meters (used if size_by_visitors=False)
         size_by_visitors: If True, scale radius by total_visitors
         min_radius: Minimum radius when scaling by visitors
@@ -66,26 +169,17 @@ def create_scatter_layer(df, color_column='mean_rep_lean_2020', scale=0.2,
     Returns:
         pydeck Layer
     """
-    df = df.copy()
-    df['color'] = df[color_column].apply(lambda x: get_color_for_lean(x, scale))
-
-    if size_by_visitors and 'total_visitors' in df.columns:
-        visitors = df['total_visitors'].fillna(0)
-        log_visitors = np.log1p(visitors)
-        if log_visitors.max() > log_visitors.min():
-            normalized = (log_visitors - log_visitors.min()) / (log_visitors.max() - log_visitors.min())
-        else:
-            normalized = 0.5
-        df['radius'] = min_radius + normalized * (max_radius - min_radius)
-        get_radius = 'radius'
-    else:
-        get_radius = radius
+    df = map_payload(df, color_column, size_by_visitors, min_radius, max_radius)
+    colors = lean_colors(df[color_column].to_numpy(dtype=np.float64), scale,
+                         center=COLOR_CENTERS.get(color_column, 0.5))
+    data = df.assign(color_r=colors[:, 0], color_g=colors[:, 1], color_b=colors[:, 2], color_a=colors[:, 3])
+    get_radius = 'radius' if size_by_visitors and 'radius' in data.columns else radius
 
     return pdk.Layer(
         'ScatterplotLayer',
-        data=df,
+        data=data,
         get_position=['longitude', 'latitude'],
-        get_color='color',
+        get_color='[color_r, color_g, color_b, color_a]',
         get_radius=get_radius,
         pickable=True,
         opacity=0.8,
@@ -95,6 +189,64 @@ def create_scatter_layer(df, color_column='mean_rep_lean_2020', scale=0.2,
     )
 
 
+def create_cell_layer(tiles, color_column='mean_rep_lean_2020', scale=0.2):
+    """
+    Create a pydeck QuadkeyLayer for aggregated map tiles.
+
+    Args:
+        tiles: DataFrame from data_loader.load_map_tiles (quadkey, color_column,
+            n_pois, total_visitors)
+        color_column: Column to use for coloring cells
+        scale: Color intensity scale, as in create_scatter_layer
+
+    Returns:
+        pydeck Layer
+    """
+    lean = tiles[color_column].to_numpy(dtype=np.float64)
+    center = COLOR_CENTERS.get(color_column, 0.5)
+    colors = lean_colors(lean, scale, center=center)
+    visitors = np.nan_to_num(tiles['total_visitors'].to_numpy(dtype=np.float64), nan=0.0)
+    data = pd.DataFrame({
+        'quadkey': tiles['quadkey'].to_numpy(),
+        'pois_display': format_thousands(tiles['n_pois'].to_numpy()),
+        'lean_display': np.where(np.isnan(lean), 'N/A', np.char.mod('%+.3f' if center == 0 else '%.3f', lean)),
+        'visitors_display': format_thousands(visitors),
+        'color_r': colors[:, 0], 'color_g': colors[:, 1],
+        'color_b': colors[:, 2], 'color_a': colors[:, 3],
+    })
+
+    return pdk.Layer(
+        'QuadkeyLayer',
+        data=data,
+        get_quadkey='quadkey',
+        get_fill_color='[color_r, color_g, color_b, color_a]',
+        pickable=True,
+        opacity=0.8,
+        stroked=False,
+        filled=True,
+        extruded=False,
+    )
+
+
+def create_cell_tooltip(label="Partisan Lean (2020)"):
+    """Tooltip configuration for aggregated cells (see create_cell_layer)."""
+    return {
+        "html": f"""
+        <b>{{pois_display}} POIs</b><br/>
+        <hr style="margin: 4px 0"/>
+        <b>{label}, visit-weighted:</b> {{lean_display}}<br/>
+        <b>Total Visitors:</b> {{visitors_display}}
+        """,
+        "style": {
+            "backgroundColor": "white",
+            "color": "black",
+            "padding": "10px",
+            "borderRadius": "5px",
+            "fontSize": "12px"
+        }
+    }
+
+
 def create_map_view(center_lat=39.8283, center_lon=-98.5795, zoom=4, pitch=0):
     """
     Create a pydeck ViewState for the map.
@@ -122,7 +274,8 @@ def create_tooltip():
 
     Note: Pydeck doesn't support Python format specifiers in tooltips.
     Data must be pre-formatted as strings before passing to the layer.
-    Expected pre-formatted columns: display_name, brand_display, lean_display, visitors_display
+    Expected pre-formatted columns: display_name, brand_display, lean_display,
+    excess_display, visitors_display
     """
     return {
         "html": """
@@ -131,6 +284,7 @@ def create_tooltip():
         <hr style="margin: 4px 0"/>
         {brand_display}
         <b>Partisan Lean (2020):</b> {lean_display}<br/>
+        {excess_display}
         <b>Total Visitors:</b> {visitors_display}<br/>
         <b>Category:</b> {top_category}
         """,
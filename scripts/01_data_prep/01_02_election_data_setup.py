@@ -9,10 +9,17 @@ This script:
    - 2020: Trump / (Trump + Biden)
    - 2016: Trump / (Trump + Clinton)
 4. Handles zero-vote CBGs by setting to 0.5 (neutral)
+5. Writes a sorted binary lookup (int64 GEOID, float64 rep share per year) that
+   workers np.memmap so one copy is shared through the page cache per node
 
 Output: /global/scratch/users/maxkagan/project_oakland/inputs/cbg_partisan_lean_national_both_years.parquet
+        /global/scratch/users/maxkagan/project_oakland/inputs/cbg_partisan_lean_lookup/
+          (symlink to the current cbg_partisan_lean_lookup.<version>/ directory)
+          geoids.npy           sorted int64 GEOIDs
+          rep_share_{year}.npy float64 two-party rep share aligned with geoids.npy
 """
 
+import sys
 import zipfile
 import pandas as pd
 import numpy as np
@@ -20,6 +27,9 @@ import logging
 from pathlib import Path
 import io
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / '02_partisan_lean'))
+from partisan_lean_engine import publish_lookup
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
@@ -29,6 +39,7 @@ logger = logging.getLogger(__name__)
 ELECTION_ZIP = Path("/global/scratch/users/maxkagan/02_election_voter/election_results_geocoded/000 Contiguous USA - Main Method.zip")
 OUTPUT_DIR = Path("/global/scratch/users/maxkagan/project_oakland/inputs")
 OUTPUT_FILE = OUTPUT_DIR / "cbg_partisan_lean_national_both_years.parquet"
+LOOKUP_DIR = OUTPUT_DIR / "cbg_partisan_lean_lookup"
 
 BG_2020_PATH = "Contiguous USA - Main Method/Block Groups/bg-2020-RLCR.csv"
 BG_2016_PATH = "Contiguous USA - Main Method/Block Groups/bg-2016-RLCR.csv"
@@ -121,6 +132,24 @@ def process_2016_data(df):
     return result[['GEOID', 'two_party_rep_share_2016']]
 
 
+def write_memmap_lookup(combined, lookup_dir):
+    """Publish the combined lookup as sorted GEOID / per-year rep share .npy columns."""
+    logger.info(f"Writing memory-mapped lookup to {lookup_dir}...")
+    geoids = combined['GEOID'].astype(np.int64).to_numpy()
+    order = np.argsort(geoids, kind='stable')
+    columns = {'geoids': geoids[order]}
+
+    for col in combined.columns:
+        if not col.startswith('two_party_rep_share_'):
+            continue
+        year = col.rsplit('_', 1)[-1]
+        columns[f"rep_share_{year}"] = combined[col].to_numpy(dtype=np.float64)[order]
+        logger.info(f"  rep_share_{year}.npy: {len(order):,} CBGs")
+
+    version_dir = publish_lookup(lookup_dir, columns)
+    logger.info(f"  {lookup_dir.name} -> {version_dir.name}")
+
+
 def main():
     """Run election data setup."""
     logger.info("Starting election data setup...")
@@ -169,11 +198,17 @@ def main():
         logger.info(f"Saved to {OUTPUT_FILE}")
         logger.info(f"Final shape: {combined.shape}")
         logger.info(f"Columns: {combined.columns.tolist()}")
-        return 0
     except Exception as e:
         logger.error(f"Failed to save: {e}")
         return 1
 
+    try:
+        write_memmap_lookup(combined, LOOKUP_DIR)
+        return 0
+    except Exception as e:
+        logger.error(f"Failed to write memory-mapped lookup: {e}")
+        return 1
+
 
 if __name__ == "__main__":
     exit(main())
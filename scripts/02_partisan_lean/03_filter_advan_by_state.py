@@ -10,23 +10,56 @@ This is an array job script. It:
 5. Saves filtered data by state for Step 4 processing
 
 Usage:
-  python3 03_filter_advan_by_state.py <STATE>
+  python3 03_filter_advan_by_state.py <STATE> [--stream] [--block-size-mb N]
+  python3 03_filter_advan_by_state.py --fanout --task-index I --num-tasks N [--by-month]
+  python3 03_filter_advan_by_state.py --finalize [STATE] [--by-month]
 
 Example:
   python3 03_filter_advan_by_state.py CA
+  python3 03_filter_advan_by_state.py CA --stream
+
+--stream reads each csv.gz in bounded record batches with the pyarrow CSV
+streaming reader and appends matching rows to a parquet writer, so peak memory
+is set by the block size and worker count rather than by the size of the state.
+
+--fanout reads every raw file once and routes rows into all states at the same
+time, instead of one invocation per state each decompressing the full corpus.
+Array task I of N takes every Nth raw file. Rows land in hive-style partitions
+(_fanout/state=CA[/year_month=2023-01]/<raw file>.parquet) and each finished raw
+file leaves a checkpoint in _fanout/_checkpoints, so resubmitted tasks skip it.
+--finalize then merges each state's partitions into the usual
+advan_{STATE}_filtered.parquet once every raw file is checkpointed (pass the
+same --by-month as the fan-out). Only partitions listed in the current raw
+files' checkpoints are merged, so leftovers from removed raw files or from
+the other layout are ignored.
+
+Checkpoints are pipeline_manifest records (raw file size, mtime, content hash,
+output partitions, code version). When a new Advan delivery lands, only raw
+files that changed are fanned out again, and --finalize only re-merges states
+whose contributing raw files changed. The per-state modes keep the same kind of
+record per state in _manifest/state and skip states whose inputs are unchanged.
+Delete a manifest directory to force a full rebuild.
 
 Output: /global/scratch/users/maxkagan/project_oakland/intermediate/advan_filtered/{STATE}/advan_{STATE}_filtered.parquet
 """
 
 import sys
 import logging
+import argparse
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv_csv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pathlib import Path
 import glob
 import os
+import shutil
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
 
+from pipeline_manifest import StageManifest, code_version
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
@@ -36,6 +69,20 @@ logger = logging.getLogger(__name__)
 ADVAN_DATA_DIR = Path("/global/scratch/users/maxkagan/project_oakland/foot_traffic_monthly_complete_2026-01-12/monthly-patterns-foot-traffic")
 CBSA_CROSSWALK_PATH = Path("/global/scratch/users/maxkagan/project_oakland/inputs/cbsa_crosswalk.parquet")
 OUTPUT_BASE_DIR = Path("/global/scratch/users/maxkagan/project_oakland/intermediate/advan_filtered")
+FANOUT_DIR = OUTPUT_BASE_DIR / "_fanout"
+CHECKPOINT_DIR = FANOUT_DIR / "_checkpoints"
+STATE_MANIFEST_DIR = OUTPUT_BASE_DIR / "_manifest" / "state"
+FINALIZE_MANIFEST_DIR = OUTPUT_BASE_DIR / "_manifest" / "finalize"
+
+CODE_VERSION = code_version(__file__)
+
+US_STATES = [
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FL',
+    'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME',
+    'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH',
+    'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI',
+    'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY'
+]
 
 COLUMNS_TO_SELECT = [
     'PLACEKEY',
@@ -69,6 +116,31 @@ COLUMN_RENAME = {
     'RAW_VISITOR_COUNTS': 'raw_visitor_counts'
 }
 
+# Fixed types for the streaming reader: per-block inference would otherwise
+# give batches of one file different schemas (e.g. an all-null BRANDS block).
+ARROW_COLUMN_TYPES = {
+    'PLACEKEY': pa.string(),
+    'DATE_RANGE_START': pa.string(),
+    'BRANDS': pa.string(),
+    'TOP_CATEGORY': pa.string(),
+    'SUB_CATEGORY': pa.string(),
+    'NAICS_CODE': pa.string(),
+    'CITY': pa.string(),
+    'REGION': pa.string(),
+    'POI_CBG': pa.string(),
+    'PARENT_PLACEKEY': pa.string(),
+    'MEDIAN_DWELL': pa.float64(),
+    'VISITOR_HOME_CBGS': pa.string(),
+    'RAW_VISITOR_COUNTS': pa.int64()
+}
+
+OUTPUT_SCHEMA = pa.schema(
+    [(COLUMN_RENAME[c], ARROW_COLUMN_TYPES[c]) for c in COLUMNS_TO_SELECT]
+    + [('cbsa_title', pa.string())]
+)
+
+DEFAULT_BLOCK_SIZE_MB = 64
+
 
 def load_cbsa_crosswalk():
     """Load CBSA crosswalk for county → MSA mapping."""
@@ -110,8 +182,378 @@ def process_single_file(args):
         return None
 
 
+def open_csv_stream(file_path, columns, block_size_mb=DEFAULT_BLOCK_SIZE_MB):
+    """Open a csv.gz as a pyarrow record batch stream with fixed column types."""
+    return pv_csv.open_csv(
+        file_path,
+        read_options=pv_csv.ReadOptions(block_size=block_size_mb * 1024 * 1024),
+        convert_options=pv_csv.ConvertOptions(
+            include_columns=columns,
+            column_types={c: ARROW_COLUMN_TYPES[c] for c in columns},
+            strings_can_be_null=True
+        )
+    )
+
+
+def add_cbsa_column(table, cbsa_keys, cbsa_values):
+    """Append cbsa_title from zero-padded poi_cbg county FIPS (arrow port of the pandas path)."""
+    if cbsa_keys is None:
+        return table.append_column('cbsa_title', pa.nulls(len(table), pa.string()))
+
+    poi_cbg = pc.utf8_lpad(pc.fill_null(table['poi_cbg'], ''), width=12, padding='0')
+    table = table.set_column(table.schema.get_field_index('poi_cbg'), 'poi_cbg', poi_cbg)
+    county_fips = pc.utf8_slice_codeunits(poi_cbg, 0, 5)
+    cbsa_title = pc.take(cbsa_values, pc.index_in(county_fips, value_set=cbsa_keys))
+    return table.append_column('cbsa_title', cbsa_title)
+
+
+def cbsa_arrays(cbsa_lookup):
+    """Split the county → CBSA dict into arrow key/value arrays for add_cbsa_column."""
+    if cbsa_lookup is None:
+        return None, None
+    return pa.array(list(cbsa_lookup.keys()), pa.string()), pa.array(list(cbsa_lookup.values()), pa.string())
+
+
+def prepare_table(table, cbsa_keys, cbsa_values):
+    """Rename raw columns, add cbsa_title and cast to OUTPUT_SCHEMA."""
+    table = table.rename_columns([COLUMN_RENAME[c] for c in table.column_names])
+    table = add_cbsa_column(table, cbsa_keys, cbsa_values)
+    return table.select(OUTPUT_SCHEMA.names).cast(OUTPUT_SCHEMA)
+
+
+def filter_batch(batch, state, cbsa_keys, cbsa_values):
+    """Keep one state's rows of a raw record batch, renamed and with cbsa_title."""
+    table = pa.Table.from_batches([batch])
+    table = table.filter(pc.equal(table['REGION'], state))
+    if table.num_rows == 0:
+        return None
+
+    return prepare_table(table, cbsa_keys, cbsa_values)
+
+
+def merge_parts(part_paths, output_file):
+    """
+    Copy part files row group by row group into one parquet file.
+
+    The merge goes to a tmp file that replaces output_file only on success, so
+    a failure leaves the previous state file intact.
+    """
+    output_file = Path(output_file)
+    tmp_file = output_file.with_suffix('.parquet.tmp')
+    rows = 0
+    try:
+        with pq.ParquetWriter(tmp_file, OUTPUT_SCHEMA, compression='snappy') as writer:
+            for part in part_paths:
+                if not Path(part).exists():
+                    continue
+                part_file = pq.ParquetFile(part)
+                for rg in range(part_file.num_row_groups):
+                    table = part_file.read_row_group(rg)
+                    writer.write_table(table)
+                    rows += table.num_rows
+        os.replace(tmp_file, output_file)
+    except Exception:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return rows
+
+
+def stream_single_file(args):
+    """Stream one csv.gz in record batches, writing a state's rows to a part file."""
+    file_path, state, part_path, cbsa_lookup, block_size_mb = args
+    cbsa_keys, cbsa_values = cbsa_arrays(cbsa_lookup)
+
+    rows_written = 0
+    writer = None
+    try:
+        reader = open_csv_stream(file_path, COLUMNS_TO_SELECT, block_size_mb)
+        for batch in reader:
+            table = filter_batch(batch, state, cbsa_keys, cbsa_values)
+            if table is None:
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(part_path, OUTPUT_SCHEMA, compression='snappy')
+            writer.write_table(table)
+            rows_written += table.num_rows
+    except Exception as e:
+        logger.error(f"Error streaming {file_path}: {e}")
+        # Drop the truncated part so it can never be merged
+        if writer is not None:
+            writer.close()
+            writer = None
+        Path(part_path).unlink(missing_ok=True)
+        rows_written = -1
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows_written
+
+
+def process_state_streaming(state, cbsa_lookup, block_size_mb=DEFAULT_BLOCK_SIZE_MB):
+    """
+    Filter Advan data for a single state with bounded memory.
+
+    Returns: (success, wrote_output); wrote_output is False when the state
+    has no rows, in which case the state file was not written.
+    """
+    logger.info(f"Processing state (streaming): {state}")
+
+    output_dir = OUTPUT_BASE_DIR / state
+    output_dir.mkdir(parents=True, exist_ok=True)
+    parts_dir = output_dir / "_parts"
+    if parts_dir.exists():
+        shutil.rmtree(parts_dir)
+    parts_dir.mkdir()
+
+    csv_files = sorted(glob.glob(str(ADVAN_DATA_DIR / "*.csv.gz")))
+    logger.info(f"Found {len(csv_files)} csv.gz files")
+
+    if not csv_files:
+        logger.error(f"No csv.gz files found in {ADVAN_DATA_DIR}")
+        return False, False
+
+    n_workers = min(8, int(os.environ.get('SLURM_CPUS_PER_TASK', multiprocessing.cpu_count())))
+    logger.info(f"Using {n_workers} workers, {block_size_mb} MB blocks")
+
+    part_paths = [parts_dir / f"{i:05d}.parquet" for i in range(len(csv_files))]
+    args_list = [
+        (f, state, part, cbsa_lookup, block_size_mb)
+        for f, part in zip(csv_files, part_paths)
+    ]
+
+    total_rows = 0
+    failed_files = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i, rows in enumerate(executor.map(stream_single_file, args_list), 1):
+            if rows < 0:
+                failed_files += 1
+            else:
+                total_rows += rows
+            if i % 200 == 0:
+                logger.info(f"  Processed {i}/{len(csv_files)} files, {total_rows:,} rows")
+
+    logger.info(f"{state}: Processed {len(csv_files)} files, {failed_files} failed, {total_rows:,} rows")
+
+    # A state file missing some raw files' rows would look complete downstream
+    if failed_files:
+        logger.error(f"{state}: {failed_files} files failed, not writing a partial state file")
+        shutil.rmtree(parts_dir)
+        return False, False
+
+    if total_rows == 0:
+        logger.warning(f"{state}: No data found for this state")
+        shutil.rmtree(parts_dir)
+        return True, False
+
+    # Parts are copied row group by row group, so the final file is also
+    # assembled without holding the state in memory.
+    output_file = output_dir / f"advan_{state}_filtered.parquet"
+    try:
+        merge_parts(part_paths, output_file)
+        shutil.rmtree(parts_dir)
+        logger.info(f"{state}: Saved {total_rows:,} rows to {output_file}")
+        return True, True
+    except Exception as e:
+        logger.error(f"{state}: Failed to save output: {e}")
+        return False, False
+
+
+def raw_file_stem(file_path):
+    """Raw file name without .csv.gz, used for part and checkpoint names."""
+    return Path(file_path).name.replace('.csv.gz', '')
+
+
+def route_batch(batch, by_month):
+    """
+    Split a raw record batch into per-partition tables in one pass.
+
+    Rows are sorted by partition key once and sliced into contiguous runs,
+    rather than filtering the batch once per state.
+    Yields: (partition_dir, table) where partition_dir is relative to FANOUT_DIR.
+    """
+    table = pa.Table.from_batches([batch])
+    table = table.filter(pc.is_in(table['REGION'], value_set=pa.array(US_STATES)))
+    if table.num_rows == 0:
+        return
+
+    key = table['REGION']
+    if by_month:
+        year_month = pc.utf8_slice_codeunits(table['DATE_RANGE_START'], 0, 7)
+        key = pc.binary_join_element_wise(key, pc.fill_null(year_month, 'unknown'), '|')
+
+    order = pc.sort_indices(key)
+    table = table.take(order)
+    encoded = pc.dictionary_encode(key.take(order)).combine_chunks()
+    codes = encoded.indices.to_numpy()
+    labels = encoded.dictionary.to_pylist()
+
+    starts = [0] + [int(i) + 1 for i in (codes[1:] != codes[:-1]).nonzero()[0]] + [len(codes)]
+    for start, end in zip(starts[:-1], starts[1:]):
+        label = labels[codes[start]]
+        if by_month:
+            state, year_month = label.split('|')
+            partition_dir = Path(f"state={state}") / f"year_month={year_month}"
+        else:
+            partition_dir = Path(f"state={label}")
+        yield partition_dir, table.slice(start, end - start)
+
+
+def fanout_single_file(args):
+    """Read one raw file once, writing every state's rows to its partitions."""
+    file_path, cbsa_lookup, block_size_mb, by_month = args
+    cbsa_keys, cbsa_values = cbsa_arrays(cbsa_lookup)
+    stem = raw_file_stem(file_path)
+    manifest = fanout_manifest(by_month)
+
+    # A re-delivered file may no longer touch every partition it used to.
+    # Drop the checkpoint first: if this run fails, the file must not count as done.
+    previous = manifest.load(stem)
+    manifest.invalidate(stem)
+    if previous:
+        for part in previous.get('outputs', []):
+            Path(part).unlink(missing_ok=True)
+
+    writers = {}
+    rows_by_partition = {}
+    try:
+        reader = open_csv_stream(file_path, COLUMNS_TO_SELECT, block_size_mb)
+        for batch in reader:
+            for partition_dir, table in route_batch(batch, by_month):
+                table = prepare_table(table, cbsa_keys, cbsa_values)
+                if partition_dir not in writers:
+                    out_dir = FANOUT_DIR / partition_dir
+                    out_dir.mkdir(parents=True, exist_ok=True)
+                    writers[partition_dir] = pq.ParquetWriter(
+                        out_dir / f"{stem}.parquet", OUTPUT_SCHEMA, compression='snappy'
+                    )
+                writers[partition_dir].write_table(table)
+                rows_by_partition[str(partition_dir)] = rows_by_partition.get(str(partition_dir), 0) + table.num_rows
+    except Exception as e:
+        logger.error(f"Error fanning out {file_path}: {e}")
+        for partition_dir, writer in writers.items():
+            writer.close()
+            (FANOUT_DIR / partition_dir / f"{stem}.parquet").unlink(missing_ok=True)
+        writers = {}
+        return None
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    # Written last: a checkpoint means every partition of this file is complete.
+    manifest.record(
+        stem,
+        inputs=[file_path],
+        outputs=[FANOUT_DIR / d / f"{stem}.parquet" for d in rows_by_partition],
+        rows_by_partition=rows_by_partition
+    )
+
+    return rows_by_partition
+
+
+def fanout_manifest(by_month):
+    """Checkpoint manifest for fan-out; switching --by-month invalidates every file."""
+    return StageManifest(CHECKPOINT_DIR, f"{CODE_VERSION}-{'month' if by_month else 'state'}")
+
+
+def fanout_is_current(manifest, file_path):
+    """True if a raw file's checkpoint matches the file and its partitions still exist."""
+    record = manifest.load(raw_file_stem(file_path))
+    if record is None:
+        return False
+    return manifest.is_current(raw_file_stem(file_path), [file_path], record.get('outputs', []))
+
+
+def run_fanout(task_index, num_tasks, cbsa_lookup, block_size_mb=DEFAULT_BLOCK_SIZE_MB, by_month=False):
+    """Fan out this task's share of the raw files (every num_tasks-th file)."""
+    csv_files = sorted(glob.glob(str(ADVAN_DATA_DIR / "*.csv.gz")))
+    if not csv_files:
+        logger.error(f"No csv.gz files found in {ADVAN_DATA_DIR}")
+        return False
+
+    if task_index < 1 or task_index > num_tasks:
+        logger.error(f"Task index {task_index} out of range (1-{num_tasks})")
+        return False
+
+    task_files = csv_files[task_index - 1::num_tasks]
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = fanout_manifest(by_month)
+    pending = [f for f in task_files if not fanout_is_current(manifest, f)]
+    logger.info(f"Fan-out task {task_index}/{num_tasks}: {len(task_files)} files, "
+                f"{len(task_files) - len(pending)} unchanged since last checkpoint")
+
+    if not pending:
+        return True
+
+    n_workers = min(8, int(os.environ.get('SLURM_CPUS_PER_TASK', multiprocessing.cpu_count())))
+    args_list = [(f, cbsa_lookup, block_size_mb, by_month) for f in pending]
+
+    total_rows = 0
+    failed_files = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i, result in enumerate(executor.map(fanout_single_file, args_list), 1):
+            if result is None:
+                failed_files += 1
+            else:
+                total_rows += sum(result.values())
+            if i % 20 == 0:
+                logger.info(f"  Processed {i}/{len(pending)} files, {total_rows:,} rows")
+
+    logger.info(f"Fan-out task {task_index}: {len(pending)} files, {failed_files} failed, {total_rows:,} rows routed")
+    return failed_files == 0
+
+
+def finalize_fanout(states, by_month=False):
+    """Merge each state's fan-out partitions into advan_{STATE}_filtered.parquet."""
+    csv_files = sorted(glob.glob(str(ADVAN_DATA_DIR / "*.csv.gz")))
+    fanout = fanout_manifest(by_month)
+    missing = [f for f in csv_files if not fanout_is_current(fanout, f)]
+    if missing:
+        logger.error(f"{len(missing)} raw files have no current fan-out checkpoint (first: {missing[0]})")
+        return False
+
+    # A state depends on the checkpoints of the raw files that routed rows to
+    # it, and is built from exactly the partitions those checkpoints list
+    state_checkpoints = {state: [] for state in states}
+    state_parts = {state: [] for state in states}
+    for f in csv_files:
+        stem = raw_file_stem(f)
+        for part in fanout.load(stem).get('outputs', []):
+            state = Path(part).relative_to(FANOUT_DIR).parts[0].split('=', 1)[1]
+            if state in state_parts:
+                state_parts[state].append(Path(part))
+                if not state_checkpoints[state] or state_checkpoints[state][-1] != fanout.record_path(stem):
+                    state_checkpoints[state].append(fanout.record_path(stem))
+
+    manifest = StageManifest(FINALIZE_MANIFEST_DIR, CODE_VERSION)
+    for state in states:
+        output_dir = OUTPUT_BASE_DIR / state
+        output_file = output_dir / f"advan_{state}_filtered.parquet"
+        if manifest.is_current(state, state_checkpoints[state], [output_file]):
+            logger.info(f"{state}: Unchanged since last finalize, skipping")
+            continue
+
+        part_paths = sorted(state_parts[state])
+        if not part_paths:
+            logger.warning(f"{state}: No fan-out partitions found")
+            output_file.unlink(missing_ok=True)
+            manifest.invalidate(state)
+            continue
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            rows = merge_parts(part_paths, output_file)
+            manifest.record(state, state_checkpoints[state], [output_file], rows=rows)
+            logger.info(f"{state}: Merged {len(part_paths)} partitions, {rows:,} rows to {output_file}")
+        except Exception as e:
+            logger.error(f"{state}: Failed to merge fan-out partitions: {e}")
+            return False
+
+    return True
+
+
 def process_state(state, cbsa_lookup):
-    """Filter Advan data for a single state."""
+    """Filter Advan data for a single state. Returns (success, wrote_output)."""
     logger.info(f"Processing state: {state}")
 
     output_dir = OUTPUT_BASE_DIR / state
@@ -122,7 +564,7 @@ def process_state(state, cbsa_lookup):
 
     if not csv_files:
         logger.error(f"No csv.gz files found in {ADVAN_DATA_DIR}")
-        return False
+        return False, False
 
     state_data = []
     processed_files = 0
@@ -137,7 +579,7 @@ def process_state(state, cbsa_lookup):
     if missing_cols:
         logger.error(f"Missing columns: {missing_cols}")
         logger.info(f"Available columns: {sample_df.columns.tolist()}")
-        return False
+        return False, False
     logger.info("All required columns found")
 
     args_list = [(f, state, COLUMNS_TO_SELECT) for f in csv_files]
@@ -158,7 +600,7 @@ def process_state(state, cbsa_lookup):
 
     if not state_data:
         logger.warning(f"{state}: No data found for this state")
-        return True
+        return True, False
 
     logger.info(f"{state}: Combining {len(state_data)} file chunks...")
     combined_df = pd.concat(state_data, ignore_index=True)
@@ -186,28 +628,73 @@ def process_state(state, cbsa_lookup):
         logger.info(f"{state}: Date range: {combined_df['date_range_start'].min()} to {combined_df['date_range_start'].max()}")
         logger.info(f"{state}: Unique POIs: {combined_df['placekey'].nunique()}")
 
-        return True
+        return True, True
     except Exception as e:
         logger.error(f"{state}: Failed to save output: {e}")
-        return False
+        return False, False
 
 
 def main():
     """Run Step 3 for specified state."""
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <STATE>")
-        print(f"Example: {sys.argv[0]} CA")
-        sys.exit(1)
-
-    state = sys.argv[1].upper()
+    parser = argparse.ArgumentParser(description='Step 3: Filter Advan data by state')
+    parser.add_argument('state', nargs='?', help='Two-letter state code, e.g. CA')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream files in bounded record batches (bounded memory)')
+    parser.add_argument('--block-size-mb', type=int, default=DEFAULT_BLOCK_SIZE_MB,
+                        help='CSV block size per record batch in streaming mode')
+    parser.add_argument('--fanout', action='store_true',
+                        help='Read each raw file once and route rows to all states')
+    parser.add_argument('--task-index', type=int,
+                        default=int(os.environ.get('SLURM_ARRAY_TASK_ID', 1)),
+                        help='1-based fan-out task index (default: SLURM_ARRAY_TASK_ID)')
+    parser.add_argument('--num-tasks', type=int, default=1,
+                        help='Number of fan-out tasks splitting the raw file list')
+    parser.add_argument('--by-month', action='store_true',
+                        help='Also partition fan-out output by year_month (give it to --finalize too)')
+    parser.add_argument('--finalize', action='store_true',
+                        help='Merge fan-out partitions into per-state filtered files')
+    args = parser.parse_args()
+
+    if args.fanout:
+        cbsa_lookup = load_cbsa_crosswalk()
+        success = run_fanout(args.task_index, args.num_tasks, cbsa_lookup,
+                             args.block_size_mb, args.by_month)
+        sys.exit(0 if success else 1)
+
+    if args.finalize:
+        states = [args.state.upper()] if args.state else US_STATES
+        success = finalize_fanout(states, args.by_month)
+        sys.exit(0 if success else 1)
+
+    if not args.state:
+        parser.error("STATE is required unless --fanout or --finalize is given")
+
+    state = args.state.upper()
 
     if not state.isalpha() or len(state) != 2:
         logger.error(f"Invalid state code: {state}")
         sys.exit(1)
 
+    manifest = StageManifest(STATE_MANIFEST_DIR, CODE_VERSION)
+    csv_files = sorted(glob.glob(str(ADVAN_DATA_DIR / "*.csv.gz")))
+    output_file = OUTPUT_BASE_DIR / state / f"advan_{state}_filtered.parquet"
+    if csv_files and manifest.is_current(state, csv_files, [output_file]):
+        logger.info(f"{state}: Raw files unchanged since last run, skipping")
+        sys.exit(0)
+
     cbsa_lookup = load_cbsa_crosswalk()
 
-    success = process_state(state, cbsa_lookup)
+    if args.stream:
+        success, wrote_output = process_state_streaming(state, cbsa_lookup, args.block_size_mb)
+    else:
+        success, wrote_output = process_state(state, cbsa_lookup)
+
+    if success and wrote_output:
+        manifest.record(state, csv_files, [output_file])
+    elif success:
+        # No rows for this state: a file from an earlier run must not look current
+        output_file.unlink(missing_ok=True)
+        manifest.invalidate(state)
 
     if success:
         logger.info(f"Step 3 complete for {state}")
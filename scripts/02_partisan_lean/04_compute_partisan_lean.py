@@ -5,12 +5,13 @@ Step 4: Parse visitor CBGs and compute partisan lean by POI-month.
 This is an array job script. It:
 1. Reads filtered Advan data for a state
 2. Reads national CBG partisan lean lookup (both 2016 and 2020)
-3. For each POI-month:
-   - Parses visitor_home_cbgs JSON
-   - Looks up partisan lean for each CBG (both years)
+3. For all POI-months at once (partisan_lean_engine.py):
+   - Parses visitor_home_cbgs JSON into CSR arrays
+   - Matches CBGs against the sorted GEOID array (both years)
    - Computes weighted average rep_lean_2020 and rep_lean_2016
-   - Tracks unmatched CBGs
 4. Generates state-level output with diagnostic columns
+5. Skips states whose filtered input, CBG lookup and code are unchanged since
+   the last run (pipeline_manifest record in OUTPUT_DIR/_manifest)
 
 Usage:
   python3 04_compute_partisan_lean.py <STATE>
@@ -23,15 +24,13 @@ Diagnostics: /global/scratch/users/maxkagan/project_oakland/intermediate/unmatch
 """
 
 import sys
-import os
-import json
 import logging
 import pandas as pd
-import numpy as np
 from pathlib import Path
-from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
-import multiprocessing
+
+import partisan_lean_engine
+from partisan_lean_engine import compute_partisan_lean_batch, open_cbg_lookup
+from pipeline_manifest import StageManifest, code_version
 
 logging.basicConfig(
     level=logging.INFO,
@@ -41,16 +40,18 @@ logger = logging.getLogger(__name__)
 
 FILTERED_DATA_DIR = Path("/global/scratch/users/maxkagan/project_oakland/intermediate/advan_filtered")
 CBG_LOOKUP_PATH = Path("/global/scratch/users/maxkagan/project_oakland/inputs/cbg_partisan_lean_national_both_years.parquet")
+CBG_LOOKUP_DIR = Path("/global/scratch/users/maxkagan/project_oakland/inputs/cbg_partisan_lean_lookup")
 OUTPUT_DIR = Path("/global/scratch/users/maxkagan/project_oakland/intermediate/advan_partisan")
 DIAGNOSTIC_DIR = Path("/global/scratch/users/maxkagan/project_oakland/intermediate/unmatched_cbgs")
+MANIFEST_DIR = OUTPUT_DIR / "_manifest"
 
-CBG_DICT_2020 = None
-CBG_DICT_2016 = None
+CBG_GEOIDS = None
+CBG_REP_SHARES = None
 
 
 def load_cbg_lookup():
-    """Load national CBG partisan lean lookup table as dicts for fast lookup."""
-    global CBG_DICT_2020, CBG_DICT_2016
+    """Load national CBG partisan lean lookup as sorted arrays for batch matching."""
+    global CBG_GEOIDS, CBG_REP_SHARES
 
     logger.info("Loading national CBG lookup...")
 
@@ -59,107 +60,19 @@ def load_cbg_lookup():
         return False
 
     try:
-        cbg_df = pd.read_parquet(CBG_LOOKUP_PATH)
-        logger.info(f"Loaded {len(cbg_df)} CBGs from lookup table")
-
-        CBG_DICT_2020 = dict(zip(cbg_df['GEOID'].astype(str), cbg_df['two_party_rep_share_2020']))
-        CBG_DICT_2016 = dict(zip(cbg_df['GEOID'].astype(str), cbg_df['two_party_rep_share_2016']))
-
-        logger.info(f"Built lookup dicts with {len(CBG_DICT_2020)} entries")
+        CBG_GEOIDS, CBG_REP_SHARES = open_cbg_lookup(CBG_LOOKUP_DIR, CBG_LOOKUP_PATH)
+        logger.info(f"Loaded {len(CBG_GEOIDS)} CBGs from lookup table")
         return True
     except Exception as e:
         logger.error(f"Failed to load CBG lookup: {e}")
         return False
 
 
-def parse_visitor_cbgs(visitor_cbgs_json):
-    """Parse visitor_home_cbgs JSON string into dict."""
-    if pd.isna(visitor_cbgs_json) or visitor_cbgs_json is None:
-        return {}
-
-    if isinstance(visitor_cbgs_json, dict):
-        return visitor_cbgs_json
-
-    try:
-        return json.loads(visitor_cbgs_json)
-    except (json.JSONDecodeError, TypeError):
-        return {}
-
-
-def compute_partisan_lean_for_row(visitor_cbgs_json):
-    """Compute weighted average partisan lean for a single POI (both 2016 and 2020)."""
-    visitor_cbgs_dict = parse_visitor_cbgs(visitor_cbgs_json)
-
-    if not visitor_cbgs_dict:
-        return np.nan, np.nan, 0, 0
-
-    total_visitors = 0
-    weighted_rep_2020 = 0.0
-    weighted_rep_2016 = 0.0
-    matched_visitors = 0
-
-    for cbg_geoid, visitor_count in visitor_cbgs_dict.items():
-        try:
-            visitor_count = int(visitor_count)
-        except (ValueError, TypeError):
-            continue
-
-        cbg_str = str(cbg_geoid).zfill(12)
-        total_visitors += visitor_count
-
-        if cbg_str in CBG_DICT_2020:
-            rep_share_2020 = CBG_DICT_2020[cbg_str]
-            rep_share_2016 = CBG_DICT_2016.get(cbg_str, 0.5)
-            weighted_rep_2020 += rep_share_2020 * visitor_count
-            weighted_rep_2016 += rep_share_2016 * visitor_count
-            matched_visitors += visitor_count
-
-    if matched_visitors == 0:
-        return np.nan, np.nan, total_visitors, 0
-
-    rep_lean_2020 = weighted_rep_2020 / matched_visitors
-    rep_lean_2016 = weighted_rep_2016 / matched_visitors
-
-    return rep_lean_2020, rep_lean_2016, total_visitors, matched_visitors
-
-
-def process_chunk(chunk_data):
-    """Process a chunk of rows."""
-    results = []
-
-    for _, row in chunk_data.iterrows():
-        rep_lean_2020, rep_lean_2016, total_visitors, matched_visitors = compute_partisan_lean_for_row(
-            row['visitor_home_cbgs']
-        )
-
-        if total_visitors == 0:
-            continue
-
-        pct_matched = (matched_visitors / total_visitors * 100) if total_visitors > 0 else np.nan
-
-        result_row = {
-            'placekey': row['placekey'],
-            'date_range_start': row['date_range_start'],
-            'brand': row['brand'],
-            'top_category': row['top_category'],
-            'sub_category': row['sub_category'],
-            'naics_code': row['naics_code'],
-            'city': row['city'],
-            'region': row['region'],
-            'poi_cbg': row['poi_cbg'],
-            'cbsa_title': row.get('cbsa_title'),
-            'parent_placekey': row['parent_placekey'],
-            'median_dwell': row['median_dwell'],
-            'rep_lean_2020': rep_lean_2020,
-            'rep_lean_2016': rep_lean_2016,
-            'total_visitors': total_visitors,
-            'matched_visitors': matched_visitors,
-            'pct_visitors_matched': pct_matched
-        }
-
-        results.append(result_row)
-
-    return results
+def cbg_lookup_inputs():
+    """Files the CBG lookup is read from (memory-mapped columns or the parquet)."""
+    if (CBG_LOOKUP_DIR / "geoids.npy").exists():
+        return sorted(CBG_LOOKUP_DIR.glob("*.npy"))
+    return [CBG_LOOKUP_PATH]
 
 
 def process_state(state):
@@ -180,15 +93,10 @@ def process_state(state):
         logger.error(f"{state}: Failed to load input data: {e}")
         return False
 
-    logger.info(f"{state}: Computing partisan lean using vectorized apply...")
-
-    df['_result'] = df['visitor_home_cbgs'].apply(compute_partisan_lean_for_row)
+    logger.info(f"{state}: Computing partisan lean with CSR batch engine...")
 
-    df['rep_lean_2020'] = df['_result'].apply(lambda x: x[0])
-    df['rep_lean_2016'] = df['_result'].apply(lambda x: x[1])
-    df['total_visitors'] = df['_result'].apply(lambda x: x[2])
-    df['matched_visitors'] = df['_result'].apply(lambda x: x[3])
-    df = df.drop(columns=['_result'])
+    results = compute_partisan_lean_batch(df['visitor_home_cbgs'], CBG_GEOIDS, CBG_REP_SHARES)
+    df = pd.concat([df, results], axis=1)
 
     df = df[df['total_visitors'] > 0].copy()
 
@@ -239,12 +147,23 @@ def main():
         logger.error(f"Invalid state code: {state}")
         sys.exit(1)
 
+    manifest = StageManifest(MANIFEST_DIR, code_version(__file__, partisan_lean_engine.__file__))
+    input_file = FILTERED_DATA_DIR / state / f"advan_{state}_filtered.parquet"
+    output_file = OUTPUT_DIR / f"{state}.parquet"
+    inputs = [input_file] + cbg_lookup_inputs()
+    if input_file.exists() and manifest.is_current(state, inputs, [output_file]):
+        logger.info(f"{state}: Inputs unchanged since last run, skipping")
+        sys.exit(0)
+
     if not load_cbg_lookup():
         logger.error("Failed to load CBG lookup")
         sys.exit(1)
 
     success = process_state(state)
 
+    if success and output_file.exists():
+        manifest.record(state, inputs, [output_file])
+
     if success:
         logger.info(f"Step 4 complete for {state}")
         sys.exit(0)
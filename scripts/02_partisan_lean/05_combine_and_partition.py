@@ -3,19 +3,38 @@
 Step 5: Combine all state outputs and partition by month.
 
 This script:
-1. Reads all state-level partisan lean files
-2. Combines into single national dataset
-3. Repartitions by month (YYYY-MM)
-4. Saves as individual month parquet files
+1. Scans all state-level partisan lean files as one pyarrow dataset
+2. Derives year_month (YYYY-MM) from the date_range_start string prefix
+3. Streams record batches into a hive-partitioned dataset in a single pass
+
+Each state file is read exactly once with column projection, instead of once
+per month. Output parquet files keep row-group statistics, and downstream
+readers can prune months by the year_month directory key.
+
+Reruns are incremental: a pipeline_manifest record per state file stores its
+fingerprint and the months it covers (OUTPUT_DIR/_manifest). Only year_month
+partitions touched by new, changed or removed state files are rewritten; the
+rest keep their files, so downstream stages see them as unchanged. A code
+change or a missing manifest rebuilds everything.
+
+Flat YYYY-MM.parquet files from the previous layout are deleted once the
+partitioned write succeeds, so directory globs never count a month twice.
 
 Output: /global/scratch/users/maxkagan/project_oakland/outputs/location_partisan_lean/national_full/
-Files: 2019-01.parquet through 2025-07.parquet
+Layout: year_month=2019-01/part-0.parquet through year_month=2025-07/part-0.parquet
 """
 
 import logging
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from pathlib import Path
+from collections import defaultdict
 import glob
+import shutil
+
+from pipeline_manifest import StageManifest, code_version
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,32 +44,91 @@ logger = logging.getLogger(__name__)
 
 INPUT_DIR = Path("/global/scratch/users/maxkagan/project_oakland/intermediate/advan_partisan")
 OUTPUT_DIR = Path("/global/scratch/users/maxkagan/project_oakland/outputs/location_partisan_lean/national_full")
+MANIFEST_DIR = OUTPUT_DIR / "_manifest"
+
+OUTPUT_COLUMNS = [
+    'placekey', 'date_range_start', 'brand', 'top_category', 'sub_category',
+    'naics_code', 'city', 'region', 'poi_cbg', 'cbsa_title', 'parent_placekey',
+    'median_dwell', 'rep_lean_2020', 'rep_lean_2016', 'total_visitors',
+    'matched_visitors', 'pct_visitors_matched'
+]
+
+BATCH_SIZE = 256 * 1024
+MAX_ROWS_PER_GROUP = 512 * 1024
+
+# Month files written by the pre-partitioning version of this step
+LEGACY_MONTH_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9].parquet"
+
+MONTH_PARTITIONING = ds.partitioning(pa.schema([('year_month', pa.string())]), flavor='hive')
+
+
+def year_month_array(date_range_start):
+    """YYYY-MM for each row, without parsing full datetimes."""
+    if pa.types.is_timestamp(date_range_start.type) or pa.types.is_date(date_range_start.type):
+        return pc.strftime(date_range_start, format='%Y-%m')
+    return pc.utf8_slice_codeunits(date_range_start.cast(pa.string()), 0, 7)
+
+
+def year_month_filter(date_type, months):
+    """Dataset filter expression keeping rows whose year_month is in months."""
+    field = ds.field('date_range_start')
+    if pa.types.is_timestamp(date_type) or pa.types.is_date(date_type):
+        year_month = pc.strftime(field, format='%Y-%m')
+    else:
+        year_month = pc.utf8_slice_codeunits(field.cast(pa.string()), 0, 7)
+    return pc.is_in(year_month, value_set=pa.array(sorted(months), pa.string()))
+
+
+def file_months(file_path):
+    """Set of year_month values in one state file (reads only date_range_start)."""
+    table = pq.read_table(file_path, columns=['date_range_start'])
+    return set(pc.unique(year_month_array(table['date_range_start'])).to_pylist())
+
+
+def state_unit(file_path):
+    """Manifest unit name for a state file."""
+    return f"state_{Path(file_path).stem}"
+
 
+def plan_rebuild(manifest, state_files):
+    """
+    Decide which months need rewriting.
 
-def get_unique_months(state_files):
-    """Scan all state files to find all unique months without loading full data."""
-    logger.info("Scanning files to identify all months...")
-    all_months = set()
+    Returns: (months, changed, removed) where months is None for a full
+    rebuild, else the set of affected year_month values; changed maps each new
+    or changed state file to its months (None when they will be collected
+    during a full rebuild); removed lists units of state files that are gone.
 
-    for file_path in state_files:
-        try:
-            df = pd.read_parquet(file_path, columns=['date_range_start'])
-            df['date_range_start'] = pd.to_datetime(df['date_range_start'])
-            months = df['date_range_start'].dt.strftime('%Y-%m').unique()
-            all_months.update(months)
-        except Exception as e:
-            logger.error(f"Failed to scan {file_path}: {e}")
-            return None
+    Only an empty manifest or a code change forces a full rebuild. A new
+    state file is handled like a changed one: just the months it covers.
+    """
+    current_units = {state_unit(f) for f in state_files}
+    stale = [f for f in state_files if not manifest.is_current(state_unit(f), [f])]
+    removed = [u for u in manifest.units() if u.startswith('state_') and u not in current_units]
 
-    return sorted(all_months)
+    records = [manifest.load(state_unit(f)) for f in stale] + [manifest.load(u) for u in removed]
+    full = not manifest.units() or any(
+        r is not None and r.get('code_version') != manifest.code_version for r in records)
+    if full:
+        return None, {f: None for f in state_files}, removed
+
+    months = set()
+    changed = {}
+    for f, record in zip(stale, records):
+        # record is None for a state file this stage has not seen before
+        if record is not None:
+            months |= set(record.get('months', []))
+        changed[f] = file_months(f)
+        months |= changed[f]
+    for record in records[len(stale):]:
+        months |= set(record.get('months', []))
+    return months, changed, removed
 
 
 def combine_and_partition():
-    """Combine all state files and partition by month (memory-efficient)."""
+    """Combine all state files and partition by month in one streaming pass."""
     logger.info("Starting Step 5: Combine and partition by month...")
 
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-
     state_files = sorted(glob.glob(str(INPUT_DIR / "*.parquet")))
     logger.info(f"Found {len(state_files)} state files")
 
@@ -58,66 +136,122 @@ def combine_and_partition():
         logger.error(f"No parquet files found in {INPUT_DIR}")
         return False
 
-    unique_months = get_unique_months(state_files)
-    if unique_months is None:
-        return False
-
-    logger.info(f"Found {len(unique_months)} unique months: {unique_months[0]} to {unique_months[-1]}")
-
-    total_rows = 0
+    # States with an all-null column (e.g. cbsa_title) were written with a null
+    # type; permissive unification promotes them to the other states' type.
+    schema = pa.unify_schemas([pq.read_schema(f) for f in state_files], promote_options='permissive')
+    dataset = ds.dataset(state_files, schema=schema, format='parquet')
+    columns = [c for c in OUTPUT_COLUMNS if c in dataset.schema.names]
+    missing = sorted(set(OUTPUT_COLUMNS) - set(columns))
+    if missing:
+        logger.warning(f"Columns missing from state files: {missing}")
+
+    manifest = StageManifest(MANIFEST_DIR, code_version(__file__))
+    affected_months, changed, removed = plan_rebuild(manifest, state_files)
+    if affected_months is None:
+        logger.info("Full rebuild (no manifest or code changed)")
+        scan_filter = None
+    elif not affected_months:
+        logger.info("All state files unchanged since last run, nothing to do")
+        return True
+    else:
+        logger.info(f"{len(changed)} changed and {len(removed)} removed state files affect "
+                    f"{len(affected_months)} months: {sorted(affected_months)}")
+        scan_filter = year_month_filter(dataset.schema.field('date_range_start').type, affected_months)
+
+    rows_by_month = defaultdict(int)
+    months_by_file = defaultdict(set)
     stats_accum = {
         'rep_lean_2020_sum': 0.0,
         'rep_lean_2016_sum': 0.0,
         'count': 0
     }
 
-    for month in unique_months:
-        logger.info(f"Processing month {month}...")
-        month_data_chunks = []
-
-        for file_path in state_files:
-            try:
-                df = pd.read_parquet(file_path)
-                df['date_range_start'] = pd.to_datetime(df['date_range_start'])
-                df['year_month'] = df['date_range_start'].dt.strftime('%Y-%m')
-
-                month_chunk = df[df['year_month'] == month].copy()
-                if len(month_chunk) > 0:
-                    month_chunk = month_chunk.drop(columns=['year_month'])
-                    month_data_chunks.append(month_chunk)
+    def month_batches():
+        for fragment in dataset.get_fragments():
+            for batch in fragment.to_batches(columns=columns, filter=scan_filter,
+                                             batch_size=BATCH_SIZE, schema=dataset.schema):
+                if batch.num_rows == 0:
+                    continue
+                year_month = year_month_array(batch.column('date_range_start'))
+
+                for month, count in zip(*pc.value_counts(year_month).flatten()):
+                    rows_by_month[month.as_py()] += count.as_py()
+                    months_by_file[fragment.path].add(month.as_py())
+                for year in ('2020', '2016'):
+                    col = f'rep_lean_{year}'
+                    if col in batch.schema.names:
+                        stats_accum[f'{col}_sum'] += pc.sum(batch.column(col)).as_py() or 0.0
+                stats_accum['count'] += batch.num_rows
+
+                yield pa.RecordBatch.from_arrays(
+                    batch.columns + [year_month],
+                    names=batch.schema.names + ['year_month']
+                )
+
+    output_schema = pa.schema(
+        [dataset.schema.field(c) for c in columns] + [pa.field('year_month', pa.string())]
+    )
 
-            except Exception as e:
-                logger.error(f"Failed to process {file_path} for month {month}: {e}")
-                return False
-
-        if not month_data_chunks:
-            logger.warning(f"  {month}: No data found")
-            continue
-
-        month_df = pd.concat(month_data_chunks, ignore_index=True)
-        total_rows += len(month_df)
-
-        stats_accum['rep_lean_2020_sum'] += month_df['rep_lean_2020'].sum()
-        stats_accum['rep_lean_2016_sum'] += month_df['rep_lean_2016'].sum()
-        stats_accum['count'] += len(month_df)
-
-        try:
-            output_file = OUTPUT_DIR / f"{month}.parquet"
-            month_df.to_parquet(output_file, index=False, compression='snappy')
-            logger.info(f"  {month}: {len(month_df):,} rows saved")
-        except Exception as e:
-            logger.error(f"Failed to save month {month}: {e}")
-            return False
+    try:
+        ds.write_dataset(
+            month_batches(),
+            OUTPUT_DIR,
+            schema=output_schema,
+            format='parquet',
+            partitioning=MONTH_PARTITIONING,
+            basename_template='part-{i}.parquet',
+            existing_data_behavior='delete_matching',
+            max_rows_per_group=MAX_ROWS_PER_GROUP,
+            file_options=ds.ParquetFileFormat().make_write_options(compression='snappy')
+        )
+    except Exception as e:
+        logger.error(f"Failed to write partitioned output: {e}")
+        return False
 
-        del month_df, month_data_chunks
+    # Months that lost all their rows (e.g. a removed state file) are not
+    # rewritten by write_dataset, so drop their old partitions explicitly.
+    # A full rebuild wrote every month that has rows, so any other partition
+    # on disk is gone.
+    if affected_months is None:
+        existing = {p.name.split('=', 1)[1] for p in OUTPUT_DIR.glob("year_month=*") if p.is_dir()}
+        emptied = existing - set(rows_by_month)
+    else:
+        emptied = affected_months - set(rows_by_month)
+    for month in sorted(emptied):
+        shutil.rmtree(OUTPUT_DIR / f"year_month={month}", ignore_errors=True)
+        logger.info(f"  {month}: no rows left, partition removed")
+
+    # The partitioned layout now holds every month; old flat files would double count
+    legacy_files = sorted(OUTPUT_DIR.glob(LEGACY_MONTH_GLOB))
+    for legacy_file in legacy_files:
+        legacy_file.unlink()
+    if legacy_files:
+        logger.info(f"Removed {len(legacy_files)} flat month files from the previous layout")
+
+    for f, months in changed.items():
+        if months is None:
+            months = months_by_file.get(f, set())
+        manifest.record(state_unit(f), [f], months=sorted(months))
+    for unit in removed:
+        manifest.invalidate(unit)
+
+    unique_months = sorted(rows_by_month)
+    if not unique_months:
+        logger.warning("No rows found in state files")
+        return True
+
+    logger.info(f"Wrote {len(unique_months)} months: {unique_months[0]} to {unique_months[-1]}")
+    for month in unique_months:
+        logger.info(f"  {month}: {rows_by_month[month]:,} rows saved")
 
+    total_rows = sum(rows_by_month.values())
     logger.info("Summary statistics:")
     logger.info(f"  Total POI-month observations: {total_rows:,}")
     if stats_accum['count'] > 0:
         logger.info(f"  Mean rep_lean_2020: {stats_accum['rep_lean_2020_sum'] / stats_accum['count']:.4f}")
         logger.info(f"  Mean rep_lean_2016: {stats_accum['rep_lean_2016_sum'] / stats_accum['count']:.4f}")
 
-    logger.info(f"Step 5 complete: {len(unique_months)} monthly files created in {OUTPUT_DIR}")
+    logger.info(f"Step 5 complete: {len(unique_months)} month partitions created in {OUTPUT_DIR}")
     return True
 
 
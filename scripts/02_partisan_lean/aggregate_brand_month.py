@@ -16,207 +16,260 @@ Output:
     - Partisan lean scores (brand_lean_2020, brand_lean_2016)
     - Aggregation metadata (n_pois, total_normalized_visits, n_states, n_cbsas)
     - Category info (top_category, sub_category, naics_code - mode across POIs)
+
+    Optional rollups from the same scan of each month (--rollups):
+    - brand_msa: brand × CBSA × month (POIs outside a CBSA are dropped)
+    - company:   company (rcid) × month, pooling all of a company's brands
+
+Implementation:
+    Each month is read with column projection and filtered in arrow before
+    conversion. Sums, nuniques and categorical modes are grouped pandas
+    kernels (modes from grouped value counts, ties broken by first occurrence
+    like Counter.most_common). Months run in parallel worker processes.
+
+Usage:
+    python3 aggregate_brand_month.py [--workers N] [--rollups brand brand_msa company]
 """
 
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 from pathlib import Path
-from collections import Counter
 import warnings
 
 warnings.filterwarnings('ignore')
 
 # Paths
-INPUT_DIR = Path('/global/scratch/users/maxkagan/measuring_stakeholder_ideology/outputs/national_with_normalized')
+INPUT_DIR = Path('/global/scratch/users/maxkagan/measuring_stakeholder_ideology/outputs/national_panel')
 ENTITY_RESOLUTION_PATH = Path('/global/scratch/users/maxkagan/measuring_stakeholder_ideology/outputs/entity_resolution/brand_matches_validated.parquet')
 OUTPUT_DIR = Path('/global/scratch/users/maxkagan/measuring_stakeholder_ideology/outputs/brand_month_aggregated')
 
 # Filter thresholds
 MIN_PCT_VISITORS_MATCHED = 0.95
 
+POI_COLUMNS = [
+    'placekey', 'brand', 'region', 'cbsa_title',
+    'top_category', 'sub_category', 'naics_code',
+    'rep_lean_2020', 'rep_lean_2016',
+    'normalized_visits_by_state_scaling', 'pct_visitors_matched',
+]
 
-def get_mode(values):
-    """Return most common value from a list, or None if empty."""
-    if not values:
-        return None
-    # Filter out None/NaN values
-    clean_values = [v for v in values if v is not None and (not isinstance(v, float) or not pd.isna(v))]
-    if not clean_values:
-        return None
-    counts = Counter(clean_values)
-    return counts.most_common(1)[0][0]
+BRAND_FIELDS = ['safegraph_brand_id', 'brand_n_locations', 'brand_naics']
+COMPANY_FIELDS = ['rcid', 'company_name', 'gvkey', 'ticker', 'company_naics']
+MODE_COLUMNS = ['top_category', 'sub_category', 'naics_code']
 
+# Rollup name → (group keys, constant fields carried with 'first', output file)
+ROLLUPS = {
+    'brand': (['brand_name'], BRAND_FIELDS + COMPANY_FIELDS,
+              'brand_month_partisan_lean.parquet'),
+    'brand_msa': (['brand_name', 'cbsa_title'], BRAND_FIELDS + COMPANY_FIELDS,
+                  'brand_msa_month_partisan_lean.parquet'),
+    'company': (['rcid'], ['company_name', 'gvkey', 'ticker', 'company_naics'],
+                'company_month_partisan_lean.parquet'),
+}
 
-def aggregate_single_month(df: pd.DataFrame, brand_lookup: pd.DataFrame) -> pd.DataFrame:
-    """
-    Aggregate POI-month data to brand-month level for a single month.
+BRAND_LOOKUP = None
 
-    Args:
-        df: POI-month dataframe with partisan lean data
-        brand_lookup: Entity resolution dataframe mapping brand -> company info
 
-    Returns:
-        Brand-month aggregated dataframe
+def grouped_mode(df: pd.DataFrame, keys: list, col: str) -> pd.Series:
     """
-    # Filter by pct_visitors_matched threshold
-    df = df[df['pct_visitors_matched'] >= MIN_PCT_VISITORS_MATCHED].copy()
+    Most common non-null value of col within each group.
 
-    # Filter to branded POIs only
-    df = df[df['brand'].notna()].copy()
-
-    if df.empty:
-        return pd.DataFrame()
-
-    # Join to entity resolution (inner join keeps only matched brands)
-    df = df.merge(brand_lookup, left_on='brand', right_on='brand_name', how='inner')
-
-    if df.empty:
-        return pd.DataFrame()
+    Ties go to the value seen first in the group, as Counter.most_common does.
+    """
+    values = df[keys + [col]].copy()
+    values['_pos'] = np.arange(len(values))
+    counts = values.groupby(keys + [col], sort=False, observed=True).agg(
+        _n=('_pos', 'size'), _first=('_pos', 'min')
+    ).reset_index()
+    counts = counts.sort_values(['_n', '_first'], ascending=[False, True], kind='stable')
+    return counts.drop_duplicates(subset=keys).set_index(keys)[col]
 
-    # Compute weighted components
-    df['weighted_lean_2020'] = df['rep_lean_2020'] * df['normalized_visits_by_state_scaling']
-    df['weighted_lean_2016'] = df['rep_lean_2016'] * df['normalized_visits_by_state_scaling']
 
-    # Aggregate by brand
-    agg = df.groupby('brand_name').agg(
+def aggregate_groups(df: pd.DataFrame, keys: list, constant_fields: list) -> pd.DataFrame:
+    """Visit-weighted leans, counts and categorical modes per group."""
+    grouped = df.groupby(keys, sort=False)
+    agg = grouped.agg(
         sum_weighted_lean_2020=('weighted_lean_2020', 'sum'),
         sum_weighted_lean_2016=('weighted_lean_2016', 'sum'),
         total_normalized_visits=('normalized_visits_by_state_scaling', 'sum'),
         n_pois=('placekey', 'nunique'),
         n_states=('region', 'nunique'),
         n_cbsas=('cbsa_title', 'nunique'),
-        top_category_list=('top_category', list),
-        sub_category_list=('sub_category', list),
-        naics_code_list=('naics_code', list),
-        year_month=('year_month', 'first'),
-        # Entity resolution fields (constant per brand)
-        safegraph_brand_id=('safegraph_brand_id', 'first'),
-        brand_n_locations=('brand_n_locations', 'first'),
-        brand_naics=('brand_naics', 'first'),
-        rcid=('rcid', 'first'),
-        company_name=('company_name', 'first'),
-        gvkey=('gvkey', 'first'),
-        ticker=('ticker', 'first'),
-        company_naics=('company_naics', 'first'),
-    ).reset_index()
+        **{field: (field, 'first') for field in constant_fields},
+    )
 
-    # Compute weighted averages
     agg['brand_lean_2020'] = agg['sum_weighted_lean_2020'] / agg['total_normalized_visits']
     agg['brand_lean_2016'] = agg['sum_weighted_lean_2016'] / agg['total_normalized_visits']
 
-    # Get mode for categorical columns
-    agg['top_category'] = agg['top_category_list'].apply(get_mode)
-    agg['sub_category'] = agg['sub_category_list'].apply(get_mode)
-    agg['naics_code'] = agg['naics_code_list'].apply(get_mode)
-
-    # Select and order output columns
-    output_cols = [
-        # Brand identifiers
-        'safegraph_brand_id',
-        'brand_name',
-        'brand_n_locations',
-        'brand_naics',
-        # Company identifiers
-        'rcid',
-        'company_name',
-        'gvkey',
-        'ticker',
-        'company_naics',
+    for col in MODE_COLUMNS:
+        agg[col] = grouped_mode(df, keys, col)
+
+    return agg.reset_index()
+
+
+def prepare_month(file_path: Path, brand_lookup: pd.DataFrame) -> pd.DataFrame:
+    """Read one month, apply the POI filters and join to entity resolution."""
+    table = pq.read_table(file_path, columns=POI_COLUMNS)
+    table = table.filter(
+        pc.and_(pc.greater_equal(table['pct_visitors_matched'], MIN_PCT_VISITORS_MATCHED),
+                pc.is_valid(table['brand']))
+    )
+    df = table.to_pandas()
+
+    if df.empty:
+        return df
+
+    # Inner join keeps only matched brands
+    df = df.merge(brand_lookup, left_on='brand', right_on='brand_name', how='inner')
+
+    df['weighted_lean_2020'] = df['rep_lean_2020'] * df['normalized_visits_by_state_scaling']
+    df['weighted_lean_2016'] = df['rep_lean_2016'] * df['normalized_visits_by_state_scaling']
+    return df
+
+
+def aggregate_single_month(file_path: Path, rollups=('brand',)) -> tuple:
+    """
+    Aggregate one month's POIs to every requested rollup level.
+
+    Args:
+        file_path: partisan_lean_YYYY-MM.parquet for the month
+        rollups: keys of ROLLUPS to compute from this scan
+
+    Returns:
+        Tuple (year_month, n_input, results): the month's YYYY-MM string, its
+        row count before filtering, and a dict mapping each rollup name to its
+        aggregated dataframe (empty when no POIs survive the filters)
+    """
+    year_month = file_path.stem.replace('partisan_lean_', '')
+    n_input = pq.read_metadata(file_path).num_rows
+    df = prepare_month(file_path, BRAND_LOOKUP)
+
+    results = {}
+    for name in rollups:
+        if df.empty:
+            results[name] = pd.DataFrame()
+            continue
+        keys, constant_fields, _ = ROLLUPS[name]
+        agg = aggregate_groups(df, keys, constant_fields)
+        if name == 'company':
+            agg = agg.rename(columns={'brand_lean_2020': 'company_lean_2020',
+                                      'brand_lean_2016': 'company_lean_2016'})
+        agg['year_month'] = year_month
+        results[name] = agg[output_columns(name)]
+
+    return year_month, n_input, results
+
+
+def output_columns(name: str) -> list:
+    """Ordered output columns for a rollup."""
+    if name == 'company':
+        identifiers = ['rcid', 'company_name', 'gvkey', 'ticker', 'company_naics']
+    else:
+        identifiers = [
+            # Brand identifiers
+            'safegraph_brand_id', 'brand_name', 'brand_n_locations', 'brand_naics',
+            # Company identifiers
+            'rcid', 'company_name', 'gvkey', 'ticker', 'company_naics',
+        ]
+        if name == 'brand_msa':
+            identifiers.append('cbsa_title')
+    lean_cols = ['company_lean_2020', 'company_lean_2016'] if name == 'company' \
+        else ['brand_lean_2020', 'brand_lean_2016']
+
+    return identifiers + [
         # Time
         'year_month',
         # Partisan lean (core output)
-        'brand_lean_2020',
-        'brand_lean_2016',
+        *lean_cols,
         # Aggregation metadata
-        'total_normalized_visits',
-        'n_pois',
-        'n_states',
-        'n_cbsas',
+        'total_normalized_visits', 'n_pois', 'n_states', 'n_cbsas',
         # Categories (mode across POIs)
-        'top_category',
-        'sub_category',
-        'naics_code',
+        *MODE_COLUMNS,
     ]
 
-    return agg[output_cols]
+
+def load_brand_lookup() -> pd.DataFrame:
+    """Entity resolution columns needed for the join and output."""
+    brand_lookup = pq.read_table(
+        ENTITY_RESOLUTION_PATH, columns=['brand_name'] + BRAND_FIELDS + COMPANY_FIELDS
+    ).to_pandas()
+    return brand_lookup
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Aggregate POI-month partisan lean to brand/company level')
+    parser.add_argument('--workers', type=int,
+                        default=min(8, int(os.environ.get('SLURM_CPUS_PER_TASK', multiprocessing.cpu_count()))),
+                        help='Months processed in parallel')
+    parser.add_argument('--rollups', nargs='+', choices=list(ROLLUPS), default=['brand'],
+                        help='Aggregation levels to emit from the same scan')
+    args = parser.parse_args()
+
+    global BRAND_LOOKUP
+
     print("=" * 60)
     print("Task 1.5: Brand-Month Aggregation")
     print("=" * 60)
 
     # Load entity resolution lookup
     print("\nLoading entity resolution data...")
-    brand_lookup = pq.read_table(ENTITY_RESOLUTION_PATH).to_pandas()
-    print(f"  Loaded {len(brand_lookup):,} matched brands")
-
-    # Keep columns needed for join and output
-    brand_lookup = brand_lookup[[
-        'safegraph_brand_id',
-        'brand_name',
-        'brand_n_locations',
-        'brand_naics',
-        'rcid',
-        'company_name',
-        'gvkey',
-        'ticker',
-        'company_naics',
-    ]].copy()
+    BRAND_LOOKUP = load_brand_lookup()
+    print(f"  Loaded {len(BRAND_LOOKUP):,} matched brands")
 
     # Get list of input files
     input_files = sorted(INPUT_DIR.glob('partisan_lean_*.parquet'))
-    print(f"\nFound {len(input_files)} monthly files to process")
-
-    # Process each month
-    all_results = []
-
-    for i, file_path in enumerate(input_files, 1):
-        year_month = file_path.stem.replace('partisan_lean_', '')
-        print(f"\n[{i:2d}/{len(input_files)}] Processing {year_month}...", end=' ')
-
-        # Load month data
-        df = pq.read_table(file_path).to_pandas()
-        n_input = len(df)
-
-        # Aggregate
-        result = aggregate_single_month(df, brand_lookup)
+    print(f"\nFound {len(input_files)} monthly files to process "
+          f"({args.workers} workers, rollups: {', '.join(args.rollups)})")
+
+    # Process months in parallel; fork shares BRAND_LOOKUP with the workers
+    all_results = {name: [] for name in args.rollups}
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx) as executor:
+        months = executor.map(aggregate_single_month, input_files, [args.rollups] * len(input_files))
+        for i, (year_month, n_input, results) in enumerate(months, 1):
+            brand_result = results.get('brand', next(iter(results.values())))
+            if not brand_result.empty:
+                print(f"[{i:2d}/{len(input_files)}] {year_month}: {n_input:,} POIs → {len(brand_result):,} groups")
+            else:
+                print(f"[{i:2d}/{len(input_files)}] {year_month}: {n_input:,} POIs → 0 groups (no matches)")
+            for name, result in results.items():
+                if not result.empty:
+                    all_results[name].append(result)
 
-        if not result.empty:
-            all_results.append(result)
-            print(f"{n_input:,} POIs → {len(result):,} brands")
-        else:
-            print(f"{n_input:,} POIs → 0 brands (no matches)")
-
-    # Combine all months
-    print("\n" + "=" * 60)
-    print("Combining results...")
-
-    final_df = pd.concat(all_results, ignore_index=True)
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    # Summary stats
-    n_brand_months = len(final_df)
-    n_unique_brands = final_df['brand_name'].nunique()
-    n_months = final_df['year_month'].nunique()
+    for name in args.rollups:
+        # Combine all months
+        print("\n" + "=" * 60)
+        print(f"Combining {name} results...")
 
-    print(f"\nFinal dataset:")
-    print(f"  {n_brand_months:,} brand-month observations")
-    print(f"  {n_unique_brands:,} unique brands")
-    print(f"  {n_months} months")
+        if not all_results[name]:
+            print("  No rows, nothing saved")
+            continue
+        final_df = pd.concat(all_results[name], ignore_index=True)
 
-    # Save output
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    output_path = OUTPUT_DIR / 'brand_month_partisan_lean.parquet'
+        keys = ROLLUPS[name][0]
+        print(f"\nFinal {name} dataset:")
+        print(f"  {len(final_df):,} {' × '.join(keys)} × month observations")
+        print(f"  {final_df[keys[0]].nunique():,} unique {keys[0]}")
+        print(f"  {final_df['year_month'].nunique()} months")
 
-    print(f"\nSaving to {output_path}...")
-    final_df.to_parquet(output_path, index=False)
+        output_path = OUTPUT_DIR / ROLLUPS[name][2]
+        print(f"\nSaving to {output_path}...")
+        final_df.to_parquet(output_path, index=False)
 
-    file_size_mb = output_path.stat().st_size / (1024 * 1024)
-    print(f"  File size: {file_size_mb:.1f} MB")
+        file_size_mb = output_path.stat().st_size / (1024 * 1024)
+        print(f"  File size: {file_size_mb:.1f} MB")
 
-    # Print sample
-    print("\nSample output (first 5 rows):")
-    print(final_df.head().to_string())
+        # Print sample
+        print("\nSample output (first 5 rows):")
+        print(final_df.head().to_string())
 
     print("\n" + "=" * 60)
     print("Done!")
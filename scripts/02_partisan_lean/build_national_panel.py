@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Build the final month-partitioned POI panel in one pass.
+
+compute_partisan_lean_direct.py already reads LATITUDE, LONGITUDE and
+NORMALIZED_VISITS_BY_STATE_SCALING from the raw files and carries them through
+to its per-file outputs. This stage streams those outputs into one parquet per
+month, so the panel with coordinates and normalized visits comes from a single
+read of the raw data.
+
+Replaces combine_partisan_outputs.py + extract_coordinates_v2.py +
+extract_normalized_visits.py + join_normalized_visits.py + join_coordinates.py,
+which re-read the raw corpus twice and ran two rounds of per-month merges.
+Coordinates are taken from each POI-month row itself, not a deduplicated
+placekey lookup.
+
+Reads:
+  - intermediate/partisan_lean_by_file/*.parquet (one per raw file)
+
+Outputs:
+  - outputs/national_panel/partisan_lean_YYYY-MM.parquet
+    (same layout and file names as the joined outputs in national_with_coords;
+    adds year, month, year_month)
+
+The panel has its own directory and manifest, so join_coordinates.py can
+still rebuild national_with_coords without either stage deleting the other's
+months as stale.
+
+The whole stage is skipped when no per-file output changed since the last run
+(OUTPUT_DIR/_manifest).
+
+Usage:
+    python3 build_national_panel.py
+"""
+
+import os
+import sys
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+from collections import defaultdict
+
+from pipeline_manifest import StageManifest, code_version
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    stream=sys.stdout
+)
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology")
+INPUT_DIR = PROJECT_DIR / "intermediate" / "partisan_lean_by_file"
+OUTPUT_DIR = PROJECT_DIR / "outputs" / "national_panel"
+MANIFEST_DIR = OUTPUT_DIR / "_manifest"
+PANEL_UNIT = "national_panel"
+
+REQUIRED_COLUMNS = ['placekey', 'date_range_start', 'latitude', 'longitude',
+                    'normalized_visits_by_state_scaling', 'rep_lean_2020']
+
+BATCH_SIZE = 256 * 1024
+
+
+def year_month_array(date_range_start):
+    """YYYY-MM for each row, without parsing full datetimes."""
+    if pa.types.is_timestamp(date_range_start.type) or pa.types.is_date(date_range_start.type):
+        return pc.strftime(date_range_start, format='%Y-%m')
+    return pc.utf8_slice_codeunits(date_range_start.cast(pa.string()), 0, 7)
+
+
+def add_period_columns(batch):
+    """Append year, month and year_month (the columns combine_partisan_outputs added)."""
+    year_month = year_month_array(batch.column('date_range_start'))
+    year = pc.cast(pc.utf8_slice_codeunits(year_month, 0, 4), pa.int32())
+    month = pc.cast(pc.utf8_slice_codeunits(year_month, 5, 7), pa.int32())
+    return pa.RecordBatch.from_arrays(
+        batch.columns + [year, month, year_month],
+        names=batch.schema.names + ['year', 'month', 'year_month']
+    )
+
+
+def build_panel(input_files):
+    """Stream every per-file output into one parquet per month."""
+    # Some files have all-null columns (e.g. cbsa_title) typed as null.
+    schema = pa.unify_schemas([pq.read_schema(f) for f in input_files], promote_options='permissive')
+    missing = [c for c in REQUIRED_COLUMNS if c not in schema.names]
+    if missing:
+        logger.error(f"Per-file outputs lack {missing}; rerun compute_partisan_lean_direct.py")
+        return None
+
+    dataset = ds.dataset([str(f) for f in input_files], schema=schema, format='parquet')
+    output_schema = schema.append(pa.field('year', pa.int32())) \
+                          .append(pa.field('month', pa.int32())) \
+                          .append(pa.field('year_month', pa.string()))
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    writers = {}
+    rows_by_month = defaultdict(int)
+    matched_coords = 0
+    matched_normalized = 0
+
+    try:
+        for batch in dataset.to_batches(batch_size=BATCH_SIZE):
+            if batch.num_rows == 0:
+                continue
+            batch = add_period_columns(batch)
+            table = pa.Table.from_batches([batch]).sort_by('year_month')
+            year_month = table.column('year_month')
+
+            matched_coords += table.num_rows - table.column('latitude').null_count
+            matched_normalized += table.num_rows - table.column('normalized_visits_by_state_scaling').null_count
+
+            # Sorted by month, so each month is one contiguous slice
+            offset = 0
+            for month, count in zip(*pc.value_counts(year_month).flatten()):
+                month, count = month.as_py(), count.as_py()
+                if month not in writers:
+                    tmp_path = OUTPUT_DIR / f"partisan_lean_{month}.parquet.tmp"
+                    writers[month] = pq.ParquetWriter(tmp_path, output_schema, compression='snappy')
+                writers[month].write_table(table.slice(offset, count))
+                rows_by_month[month] += count
+                offset += count
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for month in writers:
+        tmp_path = OUTPUT_DIR / f"partisan_lean_{month}.parquet.tmp"
+        os.replace(tmp_path, OUTPUT_DIR / f"partisan_lean_{month}.parquet")
+
+    return rows_by_month, matched_coords, matched_normalized
+
+
+def main():
+    logger.info("=" * 60)
+    logger.info("Building national POI-month panel")
+    logger.info("=" * 60)
+
+    input_files = sorted(INPUT_DIR.glob("*.parquet"))
+    logger.info(f"Found {len(input_files)} per-file partisan lean outputs")
+
+    if not input_files:
+        logger.error(f"No parquet files found in {INPUT_DIR}")
+        return 1
+    if len(input_files) < 2096:
+        logger.warning(f"Expected 2096 files, found {len(input_files)}. Some tasks may still be running.")
+
+    manifest = StageManifest(MANIFEST_DIR, code_version(__file__))
+    if manifest.is_current(PANEL_UNIT, input_files):
+        logger.info("Per-file outputs unchanged since last build, nothing to do")
+        return 0
+
+    result = build_panel(input_files)
+    if result is None:
+        return 1
+    rows_by_month, matched_coords, matched_normalized = result
+
+    # Months from a previous build that no longer have rows would otherwise linger
+    for stale in OUTPUT_DIR.glob("partisan_lean_*.parquet"):
+        if stale.stem.replace('partisan_lean_', '') not in rows_by_month:
+            stale.unlink()
+            logger.info(f"Removed stale {stale.name}")
+
+    manifest.record(PANEL_UNIT, input_files, months=sorted(rows_by_month))
+
+    total_rows = sum(rows_by_month.values())
+    for month in sorted(rows_by_month):
+        logger.info(f"  {month}: {rows_by_month[month]:,} rows")
+
+    logger.info("=" * 60)
+    logger.info(f"Complete! {len(rows_by_month)} months written")
+    logger.info(f"Total rows: {total_rows:,}")
+    if total_rows:
+        logger.info(f"Coordinate match rate: {matched_coords / total_rows * 100:.1f}%")
+        logger.info(f"Normalized visits match rate: {matched_normalized / total_rows * 100:.1f}%")
+    logger.info(f"Output directory: {OUTPUT_DIR}")
+    logger.info("=" * 60)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,14 +5,24 @@ Combine all partisan lean parquet files into final output.
 Reads all files from intermediate/partisan_lean_by_file/
 Outputs combined dataset partitioned by month.
 Generates summary diagnostics.
+
+Runs as DuckDB queries over the per-file outputs (panel_query.py): months are
+written in one multithreaded scan and diagnostics are SQL aggregates, so the
+combined panel is never loaded into memory.
+
+Superseded by build_national_panel.py, which also carries coordinates and
+normalized visits; kept for rebuilding older outputs.
 """
 
+import os
+import glob
+import shutil
 import logging
-import pandas as pd
-import numpy as np
 from pathlib import Path
 from datetime import datetime
 
+from panel_query import connect, register_files, sql_list
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
@@ -31,83 +41,102 @@ def count_input_files():
     return files
 
 
-def combine_files(files):
-    """Combine all parquet files into single DataFrame."""
-    logger.info("Reading and combining files...")
-
-    dfs = []
-    for i, f in enumerate(sorted(files)):
-        df = pd.read_parquet(f)
-        dfs.append(df)
-
-        if (i + 1) % 100 == 0:
-            logger.info(f"  Read {i + 1}/{len(files)} files")
-
-    logger.info("Concatenating all DataFrames...")
-    combined = pd.concat(dfs, ignore_index=True)
-    logger.info(f"Combined shape: {combined.shape}")
-
-    return combined
-
-
-def add_derived_columns(df):
-    """Add useful derived columns."""
-    logger.info("Adding derived columns...")
-
-    df['date_range_start'] = pd.to_datetime(df['date_range_start'])
-    df['year'] = df['date_range_start'].dt.year
-    df['month'] = df['date_range_start'].dt.month
-    df['year_month'] = df['date_range_start'].dt.to_period('M').astype(str)
-
-    return df
-
-
-def save_partitioned(df):
+def register_combined(con, files):
+    """
+    Register the per-file outputs as one view with derived period columns.
+
+    year, month and year_month come from the ISO date prefix of
+    date_range_start, so no timezone parsing is needed; date_range_start
+    itself is kept as delivered.
+    """
+    logger.info("Registering input files...")
+    register_files(con, sorted(files), 'by_file')
+    con.execute("""
+        CREATE OR REPLACE VIEW combined AS
+        SELECT *,
+               CAST(substr(CAST(date_range_start AS VARCHAR), 1, 4) AS INTEGER) AS year,
+               CAST(substr(CAST(date_range_start AS VARCHAR), 6, 2) AS INTEGER) AS month,
+               substr(CAST(date_range_start AS VARCHAR), 1, 7) AS year_month
+        FROM by_file
+    """)
+    n_rows = con.execute("SELECT COUNT(*) FROM combined").fetchone()[0]
+    logger.info(f"Combined rows: {n_rows:,}")
+    return n_rows
+
+
+def save_partitioned(con):
     """Save output partitioned by year-month."""
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
     logger.info("Saving partitioned by year-month...")
-    for ym, group in df.groupby('year_month'):
+    staging_dir = OUTPUT_DIR / "_staging"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # One multithreaded scan writes every month; DuckDB's hive layout is then
+    # renamed to the partisan_lean_YYYY-MM.parquet files downstream expects.
+    con.execute(f"""
+        COPY combined TO '{staging_dir}'
+        (FORMAT PARQUET, COMPRESSION SNAPPY, PARTITION_BY (year_month), WRITE_PARTITION_COLUMNS true)
+    """)
+
+    for month_dir in sorted(staging_dir.glob("year_month=*")):
+        ym = month_dir.name.split('=', 1)[1]
         output_path = OUTPUT_DIR / f"partisan_lean_{ym}.parquet"
-        group.to_parquet(output_path, index=False, compression='snappy')
-        logger.info(f"  {ym}: {len(group):,} rows")
+        parts = sorted(glob.glob(str(month_dir / "*.parquet")))
+        if len(parts) == 1:
+            os.replace(parts[0], output_path)
+        else:
+            con.execute(f"COPY (SELECT * FROM read_parquet({sql_list(parts)})) TO '{output_path}' (FORMAT PARQUET, COMPRESSION SNAPPY)")
+        n_rows = con.execute(f"SELECT COUNT(*) FROM read_parquet('{output_path}')").fetchone()[0]
+        logger.info(f"  {ym}: {n_rows:,} rows")
+    shutil.rmtree(staging_dir, ignore_errors=True)
 
     full_output = OUTPUT_DIR / "partisan_lean_national_full.parquet"
     logger.info(f"Saving full dataset to {full_output}...")
-    df.to_parquet(full_output, index=False, compression='snappy')
-    logger.info(f"Full dataset saved: {len(df):,} rows")
+    con.execute(f"COPY combined TO '{full_output}' (FORMAT PARQUET, COMPRESSION SNAPPY)")
+    n_rows = con.execute(f"SELECT COUNT(*) FROM read_parquet('{full_output}')").fetchone()[0]
+    logger.info(f"Full dataset saved: {n_rows:,} rows")
 
 
-def generate_diagnostics(df):
+def generate_diagnostics(con):
     """Generate summary diagnostics."""
     DIAGNOSTICS_DIR.mkdir(parents=True, exist_ok=True)
 
     logger.info("Generating diagnostics...")
 
+    overall = con.execute("""
+        SELECT COUNT(*), COUNT(DISTINCT placekey), COUNT(DISTINCT brand), COUNT(DISTINCT region),
+               MIN(date_range_start), MAX(date_range_start), COUNT(DISTINCT year_month),
+               COUNT(rep_lean_2020), AVG(rep_lean_2020), STDDEV_SAMP(rep_lean_2020),
+               MIN(rep_lean_2020), MEDIAN(rep_lean_2020), MAX(rep_lean_2020),
+               AVG(pct_visitors_matched), MEDIAN(pct_visitors_matched),
+               AVG(CASE WHEN pct_visitors_matched >= 90 THEN 1.0 ELSE 0.0 END) * 100
+        FROM combined
+    """).fetchone()
+
     diag = {
         'generated_at': datetime.now().isoformat(),
-        'total_rows': len(df),
-        'unique_pois': df['placekey'].nunique(),
-        'unique_brands': df['brand'].nunique(),
-        'states': df['region'].nunique(),
-        'date_range': f"{df['date_range_start'].min()} to {df['date_range_start'].max()}",
-        'months': df['year_month'].nunique(),
+        'total_rows': overall[0],
+        'unique_pois': overall[1],
+        'unique_brands': overall[2],
+        'states': overall[3],
+        'date_range': f"{overall[4]} to {overall[5]}",
+        'months': overall[6],
     }
 
-    rep_2020 = df['rep_lean_2020'].dropna()
     diag['rep_lean_2020'] = {
-        'count': len(rep_2020),
-        'mean': float(rep_2020.mean()),
-        'std': float(rep_2020.std()),
-        'min': float(rep_2020.min()),
-        'median': float(rep_2020.median()),
-        'max': float(rep_2020.max()),
+        'count': overall[7],
+        'mean': float(overall[8]),
+        'std': float(overall[9]),
+        'min': float(overall[10]),
+        'median': float(overall[11]),
+        'max': float(overall[12]),
     }
 
     diag['match_rate'] = {
-        'mean': float(df['pct_visitors_matched'].mean()),
-        'median': float(df['pct_visitors_matched'].median()),
-        'pct_above_90': float((df['pct_visitors_matched'] >= 90).mean() * 100),
+        'mean': float(overall[13]),
+        'median': float(overall[14]),
+        'pct_above_90': float(overall[15]),
     }
 
     logger.info("\n" + "=" * 60)
@@ -123,28 +152,34 @@ def generate_diagnostics(df):
     logger.info(f"Match rate mean: {diag['match_rate']['mean']:.1f}%")
     logger.info("=" * 60)
 
-    state_summary = df.groupby('region').agg({
-        'placekey': 'count',
-        'rep_lean_2020': 'mean',
-        'pct_visitors_matched': 'mean'
-    }).rename(columns={
-        'placekey': 'poi_months',
-        'rep_lean_2020': 'mean_rep_lean',
-        'pct_visitors_matched': 'mean_match_rate'
-    }).sort_values('poi_months', ascending=False)
+    state_summary = con.execute("""
+        SELECT region,
+               COUNT(placekey) AS poi_months,
+               AVG(rep_lean_2020) AS mean_rep_lean,
+               AVG(pct_visitors_matched) AS mean_match_rate
+        FROM combined
+        WHERE region IS NOT NULL
+        GROUP BY region
+        ORDER BY poi_months DESC
+    """).df().set_index('region')
 
     state_summary.to_csv(DIAGNOSTICS_DIR / 'state_summary.csv')
     logger.info(f"State summary saved to {DIAGNOSTICS_DIR / 'state_summary.csv'}")
 
-    brand_summary = df.groupby('brand').agg({
-        'placekey': 'count',
-        'rep_lean_2020': ['mean', 'std'],
-        'pct_visitors_matched': 'mean'
-    })
-    brand_summary.columns = ['poi_months', 'mean_rep_lean', 'std_rep_lean', 'mean_match_rate']
-    brand_summary = brand_summary.sort_values('poi_months', ascending=False)
-
-    brand_summary.head(500).to_csv(DIAGNOSTICS_DIR / 'brand_summary_top500.csv')
+    brand_summary = con.execute("""
+        SELECT brand,
+               COUNT(placekey) AS poi_months,
+               AVG(rep_lean_2020) AS mean_rep_lean,
+               STDDEV_SAMP(rep_lean_2020) AS std_rep_lean,
+               AVG(pct_visitors_matched) AS mean_match_rate
+        FROM combined
+        WHERE brand IS NOT NULL
+        GROUP BY brand
+        ORDER BY poi_months DESC
+        LIMIT 500
+    """).df().set_index('brand')
+
+    brand_summary.to_csv(DIAGNOSTICS_DIR / 'brand_summary_top500.csv')
     logger.info(f"Brand summary saved to {DIAGNOSTICS_DIR / 'brand_summary_top500.csv'}")
 
     return diag
@@ -162,12 +197,13 @@ def main():
         logger.error("No input files found!")
         return 1
 
-    df = combine_files(files)
-    df = add_derived_columns(df)
+    con = connect()
+    register_combined(con, files)
 
-    save_partitioned(df)
+    save_partitioned(con)
 
-    generate_diagnostics(df)
+    generate_diagnostics(con)
+    con.close()
 
     logger.info("Combine step complete!")
     return 0
@@ -2,22 +2,41 @@
 """
 Efficient single-pass partisan lean computation.
 
-Processes ONE csv.gz file directly, computing partisan lean for all POIs.
-Designed for SLURM array jobs (2,096 tasks, one per file).
+Processes csv.gz files directly, computing partisan lean for all POIs.
+Designed for SLURM array jobs: either one file per task, or a range/shard of
+the file list per task with lookups loaded once and shared with a forked
+process pool.
 
 Usage:
     python3 compute_partisan_lean_direct.py <file_index>
+    python3 compute_partisan_lean_direct.py --range START END [--workers N]
+    python3 compute_partisan_lean_direct.py --shard I --num-shards N [--workers N]
 
-    file_index: 1-based line number in file_list.txt
+    file_index, START, END: 1-based line numbers in file_list.txt (END inclusive)
+    --shard I of N takes every Nth file starting at line I
+
+Files whose output parquet already exists and has a readable footer are skipped.
+Files with no visitor rows get a zero-row parquet, so they count as done too.
+
+Outputs keep latitude, longitude and normalized_visits_by_state_scaling, so
+build_national_panel.py can assemble the final monthly panel without
+re-reading the raw files.
 """
 
+import os
 import sys
-import json
+import time
 import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 from pathlib import Path
 
+from partisan_lean_engine import compute_partisan_lean_batch, open_cbg_lookup
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
@@ -27,6 +46,7 @@ logger = logging.getLogger(__name__)
 PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology")
 FILE_LIST_PATH = PROJECT_DIR / "inputs" / "advan_file_list.txt"
 CBG_LOOKUP_PATH = PROJECT_DIR / "inputs" / "cbg_partisan_lean_national_both_years.parquet"
+CBG_LOOKUP_DIR = PROJECT_DIR / "inputs" / "cbg_partisan_lean_lookup"
 CBSA_CROSSWALK_PATH = PROJECT_DIR / "inputs" / "cbsa_crosswalk.parquet"
 OUTPUT_DIR = PROJECT_DIR / "intermediate" / "partisan_lean_by_file"
 
@@ -39,20 +59,18 @@ COLUMNS_TO_READ = [
     'NORMALIZED_VISITS_BY_STATE_SCALING'
 ]
 
-CBG_DICT_2020 = {}
-CBG_DICT_2016 = {}
+CBG_GEOIDS = None
+CBG_REP_SHARES = {}
 CBSA_LOOKUP = {}
 
 
 def load_lookups():
-    """Load CBG partisan lean and CBSA lookups into global dicts."""
-    global CBG_DICT_2020, CBG_DICT_2016, CBSA_LOOKUP
+    """Load CBG partisan lean arrays and CBSA lookup into globals."""
+    global CBG_GEOIDS, CBG_REP_SHARES, CBSA_LOOKUP
 
     logger.info("Loading CBG lookup...")
-    cbg_df = pd.read_parquet(CBG_LOOKUP_PATH)
-    CBG_DICT_2020 = dict(zip(cbg_df['GEOID'], cbg_df['two_party_rep_share_2020']))
-    CBG_DICT_2016 = dict(zip(cbg_df['GEOID'], cbg_df['two_party_rep_share_2016']))
-    logger.info(f"Loaded {len(CBG_DICT_2020):,} CBGs")
+    CBG_GEOIDS, CBG_REP_SHARES = open_cbg_lookup(CBG_LOOKUP_DIR, CBG_LOOKUP_PATH)
+    logger.info(f"Loaded {len(CBG_GEOIDS):,} CBGs (years: {', '.join(CBG_REP_SHARES)})")
 
     if CBSA_CROSSWALK_PATH.exists():
         logger.info("Loading CBSA crosswalk...")
@@ -61,64 +79,6 @@ def load_lookups():
         logger.info(f"Loaded {len(CBSA_LOOKUP):,} county→CBSA mappings")
 
 
-def parse_visitor_cbgs(visitor_cbgs_json):
-    """Parse VISITOR_HOME_CBGS JSON to dict. Handles double-encoded JSON."""
-    if pd.isna(visitor_cbgs_json) or visitor_cbgs_json is None:
-        return {}
-    if isinstance(visitor_cbgs_json, dict):
-        return visitor_cbgs_json
-    try:
-        parsed = json.loads(visitor_cbgs_json)
-        if isinstance(parsed, str):
-            parsed = json.loads(parsed)
-        return parsed if isinstance(parsed, dict) else {}
-    except (json.JSONDecodeError, TypeError):
-        return {}
-
-
-def compute_partisan_lean(visitor_cbgs_json):
-    """
-    Compute weighted partisan lean from visitor CBGs.
-
-    Returns: (rep_lean_2020, rep_lean_2016, total_visitors, matched_visitors)
-    """
-    visitor_cbgs = parse_visitor_cbgs(visitor_cbgs_json)
-
-    if not visitor_cbgs:
-        return np.nan, np.nan, 0, 0
-
-    total_visitors = 0
-    matched_visitors = 0
-    weighted_2020 = 0.0
-    weighted_2016 = 0.0
-
-    for cbg_geoid, count in visitor_cbgs.items():
-        try:
-            count = int(count)
-        except (ValueError, TypeError):
-            continue
-
-        cbg_str = str(cbg_geoid).zfill(12)
-        total_visitors += count
-
-        if cbg_str in CBG_DICT_2020:
-            rep_2020 = CBG_DICT_2020[cbg_str]
-            rep_2016 = CBG_DICT_2016.get(cbg_str, 0.5)
-            weighted_2020 += rep_2020 * count
-            weighted_2016 += rep_2016 * count
-            matched_visitors += count
-
-    if matched_visitors == 0:
-        return np.nan, np.nan, total_visitors, 0
-
-    return (
-        weighted_2020 / matched_visitors,
-        weighted_2016 / matched_visitors,
-        total_visitors,
-        matched_visitors
-    )
-
-
 def process_file(file_path: Path):
     """Process a single csv.gz file and compute partisan lean for all POIs."""
     logger.info(f"Reading {file_path.name}...")
@@ -127,7 +87,8 @@ def process_file(file_path: Path):
         file_path,
         compression='gzip',
         usecols=lambda c: c in COLUMNS_TO_READ,
-        dtype={'POI_CBG': str, 'PLACEKEY': str, 'NAICS_CODE': str}
+        dtype={'POI_CBG': str, 'PLACEKEY': str, 'NAICS_CODE': str,
+               'LATITUDE': float, 'LONGITUDE': float, 'NORMALIZED_VISITS_BY_STATE_SCALING': float}
     )
     logger.info(f"Read {len(df):,} rows")
 
@@ -146,12 +107,8 @@ def process_file(file_path: Path):
         df['cbsa_title'] = None
 
     logger.info("Computing partisan lean...")
-    results = df['visitor_home_cbgs'].apply(compute_partisan_lean)
-
-    df['rep_lean_2020'] = results.apply(lambda x: x[0])
-    df['rep_lean_2016'] = results.apply(lambda x: x[1])
-    df['total_visitors'] = results.apply(lambda x: x[2])
-    df['matched_visitors'] = results.apply(lambda x: x[3])
+    results = compute_partisan_lean_batch(df['visitor_home_cbgs'], CBG_GEOIDS, CBG_REP_SHARES)
+    df = pd.concat([df, results], axis=1)
     df['pct_visitors_matched'] = np.where(
         df['total_visitors'] > 0,
         (df['matched_visitors'] / df['total_visitors']) * 100,
@@ -166,20 +123,126 @@ def process_file(file_path: Path):
     return df
 
 
-def main():
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <file_index>")
-        sys.exit(1)
+def output_path_for(file_path: Path) -> Path:
+    """Output parquet path for a raw csv.gz file."""
+    return OUTPUT_DIR / file_path.name.replace('.csv.gz', '.parquet')
 
+
+def output_is_valid(output_path: Path) -> bool:
+    """True if the output exists and its parquet footer can be read."""
+    if not output_path.exists():
+        return False
     try:
-        file_index = int(sys.argv[1])
-    except ValueError:
-        logger.error(f"Invalid file index: {sys.argv[1]}")
-        sys.exit(1)
+        pq.read_metadata(output_path)
+        return True
+    except Exception:
+        return False
+
+
+def write_output(df, output_path: Path):
+    """Write via rename; df None (nothing read) becomes a zero-row, zero-column parquet."""
+    if df is None:
+        df = pd.DataFrame()
+    tmp_path = output_path.with_suffix('.parquet.tmp')
+    df.to_parquet(tmp_path, index=False, compression='snappy')
+    os.replace(tmp_path, output_path)
+
+
+def run_file(file_path: Path) -> dict:
+    """Process one file end to end and return throughput stats."""
+    start = time.time()
+    input_mb = file_path.stat().st_size / 1e6
+    stats = {'file': file_path.name, 'rows': 0, 'input_mb': input_mb, 'seconds': 0.0, 'status': 'ok'}
+
+    try:
+        df = process_file(file_path)
+        # Empty files still get an output so resumed runs skip them
+        write_output(df, output_path_for(file_path))
+        if df is None or len(df) == 0:
+            stats['status'] = 'empty'
+        else:
+            stats['rows'] = len(df)
+    except Exception as e:
+        logger.error(f"Failed on {file_path.name}: {e}")
+        stats['status'] = 'failed'
+
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def log_throughput(stats: dict):
+    """Log rows/sec and compressed MB/sec for one processed file."""
+    secs = max(stats['seconds'], 1e-9)
+    logger.info(f"{stats['file']}: {stats['status']}, {stats['rows']:,} rows in {stats['seconds']:.1f}s "
+                f"({stats['rows'] / secs:,.0f} rows/s, {stats['input_mb'] / secs:.1f} MB/s)")
+
+
+def run_many(file_paths, n_workers: int):
+    """Process many files with one lookup load and a forked worker pool."""
+    pending = [p for p in file_paths if not output_is_valid(output_path_for(p))]
+    logger.info(f"{len(file_paths)} files assigned, {len(file_paths) - len(pending)} already done, "
+                f"{len(pending)} to process with {n_workers} workers")
+    if not pending:
+        return True
+
+    load_lookups()
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    # fork: workers inherit the loaded lookups copy-on-write instead of reloading
+    start = time.time()
+    all_stats = []
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+        for stats in executor.map(run_file, pending):
+            log_throughput(stats)
+            all_stats.append(stats)
+
+    elapsed = max(time.time() - start, 1e-9)
+    total_rows = sum(s['rows'] for s in all_stats)
+    total_mb = sum(s['input_mb'] for s in all_stats)
+    failed = [s['file'] for s in all_stats if s['status'] == 'failed']
+    logger.info(f"Done: {len(all_stats)} files, {total_rows:,} rows, {total_mb:,.0f} MB in {elapsed:.0f}s "
+                f"({total_rows / elapsed:,.0f} rows/s, {total_mb / elapsed:.1f} MB/s overall)")
+    if failed:
+        logger.error(f"{len(failed)} files failed: {failed[:10]}")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute partisan lean directly from raw Advan files')
+    parser.add_argument('file_index', nargs='?', type=int, help='1-based line in file_list.txt')
+    parser.add_argument('--range', nargs=2, type=int, metavar=('START', 'END'),
+                        help='Process lines START..END (1-based, inclusive)')
+    parser.add_argument('--shard', type=int, help='1-based shard index (e.g. SLURM_ARRAY_TASK_ID)')
+    parser.add_argument('--num-shards', type=int, help='Total number of shards')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('SLURM_CPUS_PER_TASK', multiprocessing.cpu_count())),
+                        help='Worker processes for multi-file mode')
+    args = parser.parse_args()
 
     with open(FILE_LIST_PATH) as f:
         file_list = [line.strip() for line in f]
 
+    if args.range or args.shard is not None:
+        if args.range:
+            first, last = args.range
+            if first < 1 or last > len(file_list) or first > last:
+                logger.error(f"Range {first}-{last} out of bounds (1-{len(file_list)})")
+                sys.exit(1)
+            selected = file_list[first - 1:last]
+        else:
+            if not args.num_shards or args.shard < 1 or args.shard > args.num_shards:
+                logger.error(f"Invalid shard {args.shard} of {args.num_shards}")
+                sys.exit(1)
+            selected = file_list[args.shard - 1::args.num_shards]
+        success = run_many([Path(p) for p in selected], args.workers)
+        sys.exit(0 if success else 1)
+
+    if args.file_index is None:
+        parser.error("file_index is required unless --range or --shard is given")
+
+    file_index = args.file_index
+
     if file_index < 1 or file_index > len(file_list):
         logger.error(f"File index {file_index} out of range (1-{len(file_list)})")
         sys.exit(1)
@@ -191,15 +254,14 @@ def main():
 
     df = process_file(file_path)
 
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    output_path = output_path_for(file_path)
+    write_output(df, output_path)
+
     if df is None or len(df) == 0:
-        logger.warning("No output data")
+        logger.warning(f"No output data, wrote empty {output_path.name}")
         sys.exit(0)
 
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    output_name = file_path.name.replace('.csv.gz', '.parquet')
-    output_path = OUTPUT_DIR / output_name
-
-    df.to_parquet(output_path, index=False, compression='snappy')
     logger.info(f"Saved to {output_path}")
 
     if df['rep_lean_2020'].notna().any():
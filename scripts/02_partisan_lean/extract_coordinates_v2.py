@@ -5,6 +5,9 @@ Optimized version with parallel processing and chunked output.
 
 Creates a deduplicated lookup table: placekey → (latitude, longitude)
 
+Superseded by build_national_panel.py, which reads these columns in the
+partisan lean pass; kept for rebuilding older outputs.
+
 Usage:
     python3 extract_coordinates_v2.py [--workers N] [--chunk-size N]
 
@@ -7,6 +7,9 @@ to join back to existing partisan lean data.
 
 Designed for SLURM array jobs (one task per file).
 
+Superseded by build_national_panel.py, which reads these columns in the
+partisan lean pass; kept for rebuilding older outputs.
+
 Usage:
     python3 extract_normalized_visits.py <file_index>
 """
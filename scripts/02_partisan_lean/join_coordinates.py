@@ -9,6 +9,13 @@ Reads:
 Outputs:
   - outputs/national_with_coords/*.parquet (79 monthly files with lat/lon added)
 
+Superseded by build_national_panel.py, which reads these columns in the
+partisan lean pass and writes outputs/national_panel; kept for rebuilding
+older outputs.
+
+Months whose input file and the coordinates lookup are unchanged since the
+last run (OUTPUT_DIR/_manifest) are skipped.
+
 Usage:
     python3 join_coordinates.py
 """
@@ -18,6 +25,8 @@ from pathlib import Path
 import logging
 import sys
 
+from pipeline_manifest import StageManifest, code_version
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -29,6 +38,7 @@ PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideolog
 COORDS_PATH = PROJECT_DIR / "outputs" / "poi_coordinates.parquet"
 INPUT_DIR = PROJECT_DIR / "outputs" / "national_with_normalized"
 OUTPUT_DIR = PROJECT_DIR / "outputs" / "national_with_coords"
+MANIFEST_DIR = OUTPUT_DIR / "_manifest"
 
 
 def main():
@@ -41,17 +51,26 @@ def main():
         logger.error("Run extract_coordinates.py first")
         return 1
 
-    logger.info("Loading coordinates lookup...")
-    coords_df = pd.read_parquet(COORDS_PATH)
-    logger.info(f"Loaded {len(coords_df):,} POI coordinates")
-
-    monthly_files = sorted(INPUT_DIR.glob("partisan_lean_*.parquet"))
-    logger.info(f"Found {len(monthly_files)} monthly files to process")
+    all_files = sorted(INPUT_DIR.glob("partisan_lean_*.parquet"))
+    logger.info(f"Found {len(all_files)} monthly files")
 
-    if not monthly_files:
+    if not all_files:
         logger.error(f"No monthly files found in {INPUT_DIR}")
         return 1
 
+    manifest = StageManifest(MANIFEST_DIR, code_version(__file__))
+    monthly_files = [
+        f for f in all_files
+        if not manifest.is_current(f.stem, [f, COORDS_PATH], [OUTPUT_DIR / f.name])
+    ]
+    logger.info(f"{len(all_files) - len(monthly_files)} unchanged, {len(monthly_files)} to process")
+    if not monthly_files:
+        return 0
+
+    logger.info("Loading coordinates lookup...")
+    coords_df = pd.read_parquet(COORDS_PATH)
+    logger.info(f"Loaded {len(coords_df):,} POI coordinates")
+
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
     total_rows = 0
@@ -76,6 +95,7 @@ def main():
 
         output_path = OUTPUT_DIR / f.name
         merged.to_parquet(output_path, index=False, compression='snappy')
+        manifest.record(f.stem, [f, COORDS_PATH], [output_path])
 
         total_rows += initial_rows
         total_matched += matched
@@ -4,6 +4,12 @@ Join extracted NORMALIZED_VISITS_BY_STATE_SCALING to existing partisan lean data
 
 Run AFTER extract_normalized_visits.py array job completes.
 
+Superseded by build_national_panel.py, which reads these columns in the
+partisan lean pass; kept for rebuilding older outputs.
+
+Incremental: month files whose partisan lean input and the normalized visits
+files are unchanged since the last run (OUTPUT_DIR/_manifest) are skipped.
+
 Usage:
     python3 join_normalized_visits.py
 """
@@ -19,6 +25,7 @@ print("Importing concurrent.futures...", flush=True)
 from concurrent.futures import ProcessPoolExecutor
 print("Importing pyarrow...", flush=True)
 import pyarrow.parquet as pq
+from pipeline_manifest import StageManifest, code_version
 print("All imports complete", flush=True)
 
 logging.basicConfig(
@@ -33,6 +40,11 @@ PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideolog
 NORMALIZED_DIR = PROJECT_DIR / "intermediate" / "normalized_visits_by_file"
 PARTISAN_DIR = PROJECT_DIR / "outputs" / "national"
 OUTPUT_DIR = PROJECT_DIR / "outputs" / "national_with_normalized"
+MANIFEST_DIR = OUTPUT_DIR / "_manifest"
+
+# Shared unit covering all normalized visits files; month units depend on its
+# record file, so any change to the normalized inputs reprocesses every month.
+NORMALIZED_UNIT = "_normalized_inputs"
 
 
 def load_all_normalized_visits():
@@ -85,14 +97,29 @@ def process_month(month_file: Path, normalized_df: pd.DataFrame):
 def main():
     print("=== Joining Normalized Visits to Partisan Lean Data ===", flush=True)
 
-    normalized_df = load_all_normalized_visits()
+    manifest = StageManifest(MANIFEST_DIR, code_version(__file__))
+    normalized_files = sorted(NORMALIZED_DIR.glob("*.parquet"))
+    if not manifest.is_current(NORMALIZED_UNIT, normalized_files):
+        manifest.record(NORMALIZED_UNIT, normalized_files)
+    normalized_record = manifest.record_path(NORMALIZED_UNIT)
 
     month_files = sorted(PARTISAN_DIR.glob("partisan_lean_*.parquet"))
     logger.info(f"Found {len(month_files)} monthly partisan lean files")
 
+    pending = [
+        f for f in month_files
+        if not manifest.is_current(f.stem, [f, normalized_record], [OUTPUT_DIR / f.name])
+    ]
+    logger.info(f"{len(month_files) - len(pending)} months unchanged, {len(pending)} to process")
+    if not pending:
+        return
+
+    normalized_df = load_all_normalized_visits()
+
     results = []
-    for month_file in month_files:
+    for month_file in pending:
         result = process_month(month_file, normalized_df)
+        manifest.record(month_file.stem, [month_file, normalized_record], [OUTPUT_DIR / month_file.name])
         results.append(result)
 
     logger.info("\n=== Summary ===")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+DuckDB query layer over the national POI-month panel.
+
+Registers the panel's parquet files as a view so analyses can aggregate with
+SQL instead of looping over months with pd.read_parquet + pd.concat. DuckDB
+scans the files multithreaded, pushes column projections and filters into the
+parquet reader, and spills to disk when an aggregation exceeds memory_limit,
+so only query results are materialized in pandas.
+
+Understands both panel layouts:
+  - hive partitions from 05_combine_and_partition.py
+    (year_month=YYYY-MM/part-*.parquet; year_month becomes a column and
+    filters on it prune whole directories)
+  - flat monthly files (partisan_lean_YYYY-MM.parquet) from
+    build_national_panel.py and the older combine/join scripts
+
+Usage:
+    from panel_query import connect, register_panel
+
+    con = connect()
+    register_panel(con, PANEL_DIR)
+    df = con.execute("SELECT brand, AVG(rep_lean_2020) FROM panel "
+                     "WHERE year_month >= '2022-01' GROUP BY brand").df()
+"""
+
+import os
+import glob
+import logging
+from pathlib import Path
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+NATIONAL_FULL_DIR = Path("/global/scratch/users/maxkagan/project_oakland/outputs/location_partisan_lean/national_full")
+NATIONAL_PANEL_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology/outputs/national_panel")
+
+DEFAULT_MEMORY_LIMIT = '50GB'
+
+
+def connect(threads=None, memory_limit=None, temp_dir=None):
+    """
+    DuckDB connection configured for the cluster.
+
+    threads defaults to SLURM_CPUS_PER_TASK (or all cores); memory_limit to
+    DUCKDB_MEMORY_LIMIT or 50GB. temp_dir is where larger-than-memory
+    aggregations spill (defaults to $TMPDIR when set).
+    """
+    threads = threads or int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count() or 1))
+    memory_limit = memory_limit or os.environ.get('DUCKDB_MEMORY_LIMIT', DEFAULT_MEMORY_LIMIT)
+    temp_dir = temp_dir or os.environ.get('TMPDIR')
+
+    con = duckdb.connect()
+    con.execute(f"SET threads TO {int(threads)}")
+    con.execute(f"SET memory_limit = '{memory_limit}'")
+    if temp_dir:
+        con.execute(f"SET temp_directory = '{temp_dir}'")
+    # Row order is not needed for aggregations; lets scans run fully parallel
+    con.execute("SET preserve_insertion_order = false")
+    return con
+
+
+def panel_files(panel_dir):
+    """Parquet files making up the panel, and whether they are hive-partitioned."""
+    panel_dir = Path(panel_dir)
+    hive_files = sorted(glob.glob(str(panel_dir / "year_month=*" / "*.parquet")))
+    if hive_files:
+        return hive_files, True
+    # Excludes partisan_lean_national_full.parquet written next to the months
+    month_files = sorted(glob.glob(str(panel_dir / "partisan_lean_[0-9][0-9][0-9][0-9]-[0-9][0-9].parquet")))
+    if month_files:
+        return month_files, False
+    return sorted(glob.glob(str(panel_dir / "*.parquet"))), False
+
+
+def sql_list(paths):
+    """DuckDB list literal of quoted paths."""
+    return "[" + ", ".join("'" + str(p).replace("'", "''") + "'" for p in paths) + "]"
+
+
+def register_panel(con, panel_dir=NATIONAL_FULL_DIR, view='panel'):
+    """
+    Create (or replace) a view over the panel and return the number of files.
+
+    Files are read with union_by_name, so months written with slightly
+    different schemas (e.g. a column missing in early months) line up.
+    """
+    files, hive = panel_files(panel_dir)
+    if not files:
+        raise FileNotFoundError(f"No panel parquet files found in {panel_dir}")
+
+    options = "union_by_name = true"
+    if hive:
+        options += ", hive_partitioning = true"
+    con.execute(f"CREATE OR REPLACE VIEW {view} AS SELECT * FROM read_parquet({sql_list(files)}, {options})")
+    logger.info(f"Registered view '{view}' over {len(files)} parquet files in {panel_dir}")
+    return len(files)
+
+
+def register_files(con, files, view):
+    """Create (or replace) a view over an explicit list of parquet files."""
+    files = [str(f) for f in files]
+    if not files:
+        raise FileNotFoundError(f"No parquet files to register as '{view}'")
+    con.execute(f"CREATE OR REPLACE VIEW {view} AS SELECT * FROM read_parquet({sql_list(files)}, union_by_name = true)")
+    logger.info(f"Registered view '{view}' over {len(files)} parquet files")
+    return len(files)
+
+
+def panel_months(con, view='panel'):
+    """Sorted year_month values present in the view."""
+    rows = con.execute(f"SELECT DISTINCT year_month FROM {view} ORDER BY year_month").fetchall()
+    return [r[0] for r in rows]
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Vectorized partisan lean engine for VISITOR_HOME_CBGS.
+
+Replaces the per-row json.loads / zfill / dict-probe loop with a batch pass:
+  1. All visitor maps in a file are parsed at once into a CSR structure
+     (row offsets, int64 CBG ids, int32 visitor counts)
+  2. CBG ids are matched against a sorted int64 GEOID array with np.searchsorted
+  3. Per-POI totals and weighted leans are reduced with np.bincount
+
+CBG lookups come from the memory-mapped .npy columns written by
+01_02_election_data_setup.py (CBGLeanLookup), falling back to the parquet.
+
+Used by compute_partisan_lean_direct.py and 04_compute_partisan_lean.py.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# One "cbg": count pair. Tolerates the escaped quotes of double-encoded JSON
+# ("{\"060370001001\": 4}") so both encodings go through the same pass.
+PAIR_PATTERN = r'\\?"([^"\\]+)\\?"\s*:\s*(-?\d+)'
+PAIR_REGEX = re.compile(PAIR_PATTERN)
+
+UNMATCHED_CBG = -1
+
+
+def build_visitor_csr(visitor_cbgs: pd.Series) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse a column of VISITOR_HOME_CBGS JSON strings into CSR arrays.
+
+    Returns: (offsets, cbg_ids, counts)
+      offsets: int64, length n_rows + 1; row i owns [offsets[i], offsets[i+1])
+      cbg_ids: int64 GEOIDs (non-numeric keys such as Canadian codes become -1)
+      counts:  int32 visitor counts
+    """
+    text = visitor_cbgs.where(visitor_cbgs.map(lambda v: isinstance(v, str)), '')
+    text = text.astype(str)
+
+    pairs_per_row = text.str.count(PAIR_PATTERN).to_numpy(dtype=np.int64)
+    offsets = np.zeros(len(text) + 1, dtype=np.int64)
+    np.cumsum(pairs_per_row, out=offsets[1:])
+
+    # A single regex scan over the joined column keeps pairs in row order,
+    # so the per-row counts above line up with the flat arrays.
+    pairs = PAIR_REGEX.findall('\n'.join(text.tolist()))
+    if len(pairs) != offsets[-1]:
+        raise ValueError(f"Parsed {len(pairs):,} CBG pairs but expected {offsets[-1]:,}")
+
+    if not pairs:
+        return offsets, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+    keys, values = zip(*pairs)
+    keys = np.array(keys, dtype=object)
+    is_numeric = np.fromiter((k.isdigit() for k in keys), dtype=bool, count=len(keys))
+
+    cbg_ids = np.full(len(keys), UNMATCHED_CBG, dtype=np.int64)
+    if is_numeric.any():
+        cbg_ids[is_numeric] = keys[is_numeric].astype(np.int64)
+    counts = np.array(values, dtype=np.int64).astype(np.int32)
+
+    return offsets, cbg_ids, counts
+
+
+def load_cbg_arrays(lookup_path: Path) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Load the CBG partisan lean parquet as a sorted int64 GEOID array.
+
+    Returns: (geoids, rep_shares) where rep_shares maps election year
+    ('2020', '2016') to a float64 array aligned with geoids.
+    """
+    cbg_df = pd.read_parquet(lookup_path)
+    geoids = cbg_df['GEOID'].astype(str).str.zfill(12).astype(np.int64).to_numpy()
+    order = np.argsort(geoids, kind='stable')
+
+    rep_shares = {}
+    for col in cbg_df.columns:
+        if col.startswith('two_party_rep_share_'):
+            year = col.rsplit('_', 1)[-1]
+            rep_shares[year] = cbg_df[col].fillna(0.5).to_numpy(dtype=np.float64)[order]
+
+    return geoids[order], rep_shares
+
+
+def publish_lookup(lookup_dir: Path, columns: Dict[str, np.ndarray]) -> Path:
+    """
+    Write a complete set of lookup columns and switch lookup_dir to it atomically.
+
+    lookup_dir is a symlink to a versioned sibling directory. The columns
+    ({name}.npy) are written into a fresh version directory and the symlink is
+    then replaced via rename, so a reader resolves either the old set or the
+    new one, never a mix. The previous version is kept for readers that opened
+    it before the swap; older ones are removed. Returns the new version dir.
+    """
+    lookup_dir = Path(lookup_dir)
+    parent = lookup_dir.parent
+    parent.mkdir(parents=True, exist_ok=True)
+
+    version_dir = Path(tempfile.mkdtemp(prefix=f"{lookup_dir.name}.", dir=parent))
+    version_dir.chmod(0o755)
+    for name, array in columns.items():
+        np.save(version_dir / f"{name}.npy", array)
+
+    previous = lookup_dir.resolve() if lookup_dir.is_symlink() else None
+    if lookup_dir.is_dir() and not lookup_dir.is_symlink():
+        # Unversioned directory from before the symlink layout
+        shutil.rmtree(lookup_dir)
+
+    tmp_link = parent / f"{lookup_dir.name}.link.tmp"
+    tmp_link.unlink(missing_ok=True)
+    os.symlink(version_dir.name, tmp_link)
+    os.replace(tmp_link, lookup_dir)
+
+    for old in parent.glob(f"{lookup_dir.name}.*"):
+        if old.is_dir() and old.resolve() not in (version_dir.resolve(), previous):
+            shutil.rmtree(old, ignore_errors=True)
+    return version_dir
+
+
+class CBGLeanLookup:
+    """
+    Sorted CBG → rep share lookup backed by memory-mapped .npy columns.
+
+    Layout (written by 01_02_election_data_setup.py via publish_lookup):
+      geoids.npy           sorted int64 GEOIDs
+      rep_share_{year}.npy float64 rep share aligned with geoids.npy
+
+    Columns are opened with mmap_mode='r', so every process on a node shares
+    one copy through the page cache. The lookup_dir symlink is resolved once
+    on open, so all columns come from the same published version even if a
+    new one is swapped in meanwhile; reopen to see a newly added year.
+    """
+
+    def __init__(self, lookup_dir: Path):
+        self.link = Path(lookup_dir)
+        self._open()
+
+    def _open(self):
+        self.lookup_dir = self.link.resolve()
+        self.geoids = np.load(self.lookup_dir / "geoids.npy", mmap_mode='r')
+        self._shares: Dict[str, np.ndarray] = {}
+
+    def __len__(self):
+        return len(self.geoids)
+
+    @property
+    def years(self) -> List[str]:
+        """Election years in the opened version, newest first."""
+        years = [p.stem[len('rep_share_'):] for p in self.lookup_dir.glob("rep_share_*.npy")]
+        return sorted(years, reverse=True)
+
+    def rep_share(self, year: str) -> np.ndarray:
+        """Memory-mapped rep share column for one election year."""
+        year = str(year)
+        if year not in self._shares:
+            path = self.lookup_dir / f"rep_share_{year}.npy"
+            if not path.exists():
+                raise KeyError(f"No rep share column for {year} in {self.lookup_dir}")
+            shares = np.load(path, mmap_mode='r')
+            if len(shares) != len(self.geoids):
+                raise ValueError(f"{path.name} has {len(shares):,} rows, expected {len(self.geoids):,}")
+            self._shares[year] = shares
+        return self._shares[year]
+
+    @property
+    def rep_shares(self) -> Dict[str, np.ndarray]:
+        """
+        All year columns, in the form compute_partisan_lean_batch expects.
+
+        The dict is a snapshot of the years present now; it does not grow
+        when add_year publishes another column later.
+        """
+        return {year: self.rep_share(year) for year in self.years}
+
+    def lookup(self, cbg_ids: np.ndarray, year: str) -> np.ndarray:
+        """Rep share for each int64 CBG id (NaN where the CBG is not in the lookup)."""
+        cbg_ids = np.asarray(cbg_ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.geoids, cbg_ids), len(self.geoids) - 1)
+        found = self.geoids[pos] == cbg_ids
+        return np.where(found, self.rep_share(year)[pos], np.nan)
+
+    def add_year(self, year: str, geoids: np.ndarray, rep_share: np.ndarray, fill_value: float = 0.5):
+        """
+        Add (or replace) an election year column aligned to the existing GEOIDs.
+
+        CBGs absent from the new year get fill_value, matching the neutral
+        default used for zero-vote CBGs. The existing columns plus the new one
+        are published as a new version, and this lookup reopens it.
+        """
+        geoids = np.asarray(geoids, dtype=np.int64)
+        rep_share = np.asarray(rep_share, dtype=np.float64)
+        order = np.argsort(geoids, kind='stable')
+        geoids, rep_share = geoids[order], rep_share[order]
+
+        aligned = np.full(len(self.geoids), fill_value, dtype=np.float64)
+        pos = np.minimum(np.searchsorted(geoids, self.geoids), max(len(geoids) - 1, 0))
+        found = (geoids[pos] == self.geoids) if len(geoids) else np.zeros(len(self.geoids), dtype=bool)
+        aligned[found] = rep_share[pos[found]]
+
+        columns = {'geoids': self.geoids}
+        columns.update({f"rep_share_{y}": self.rep_share(y) for y in self.years if y != str(year)})
+        columns[f"rep_share_{year}"] = aligned
+        publish_lookup(self.link, columns)
+        self._open()
+
+
+def open_cbg_lookup(lookup_dir: Path, parquet_path: Path) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Load sorted GEOIDs and per-year rep shares, preferring the memory-mapped lookup.
+
+    Falls back to reading the parquet into process-local arrays when the
+    .npy lookup has not been generated yet.
+    """
+    if (Path(lookup_dir) / "geoids.npy").exists():
+        lookup = CBGLeanLookup(lookup_dir)
+        return lookup.geoids, lookup.rep_shares
+    return load_cbg_arrays(parquet_path)
+
+
+def compute_partisan_lean_batch(
+    visitor_cbgs: pd.Series,
+    geoids: np.ndarray,
+    rep_shares: Dict[str, np.ndarray],
+) -> pd.DataFrame:
+    """
+    Compute visitor-weighted partisan lean for every row of a file at once.
+
+    Returns a DataFrame aligned with visitor_cbgs containing rep_lean_{year}
+    for each year in rep_shares, total_visitors and matched_visitors. Rows with
+    no matched visitors get NaN leans, same as the per-row implementation.
+    """
+    offsets, cbg_ids, counts = build_visitor_csr(visitor_cbgs)
+    n_rows = len(offsets) - 1
+    row_idx = np.repeat(np.arange(n_rows), np.diff(offsets))
+
+    pos = np.searchsorted(geoids, cbg_ids)
+    pos = np.minimum(pos, max(len(geoids) - 1, 0))
+    matched = (geoids[pos] == cbg_ids) if len(geoids) else np.zeros(len(cbg_ids), dtype=bool)
+
+    weights = counts.astype(np.float64)
+    total = np.bincount(row_idx, weights=weights, minlength=n_rows)
+
+    matched_rows = row_idx[matched]
+    matched_weights = weights[matched]
+    matched_pos = pos[matched]
+    matched_total = np.bincount(matched_rows, weights=matched_weights, minlength=n_rows)
+
+    result = pd.DataFrame(index=visitor_cbgs.index)
+    has_match = matched_total > 0
+    for year, shares in rep_shares.items():
+        weighted = np.bincount(
+            matched_rows, weights=shares[matched_pos] * matched_weights, minlength=n_rows
+        )
+        lean = np.full(n_rows, np.nan)
+        np.divide(weighted, matched_total, out=lean, where=has_match)
+        result[f'rep_lean_{year}'] = lean
+
+    result['total_visitors'] = total.astype(np.int64)
+    result['matched_visitors'] = matched_total.astype(np.int64)
+
+    return result
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Incremental rebuild manifest shared by the 02_partisan_lean stages.
+
+Each stage keeps one JSON record per unit of work (a raw file, a state, a
+year_month partition) in its own manifest directory:
+
+  {
+    "unit": "CA",
+    "code_version": "3f2a9c1e07b4",       # hash of the stage script source
+    "inputs": [{"path", "size", "mtime", "hash"}, ...],
+    "outputs": ["/.../CA.parquet"],
+    "updated_at": "2026-01-14T09:12:44"
+  }
+
+A unit is current when its record exists, the code version matches, every
+output exists, and every input still matches. Inputs whose size and mtime are
+unchanged are trusted without rehashing. Touched-but-identical files are
+caught by the content hash, so re-downloading an unchanged delivery does not
+trigger a rebuild.
+
+One file per unit means concurrent SLURM array tasks never write the same
+file. Records are written via rename.
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+# Files larger than this are hashed from their size plus head and tail blocks.
+# Advan csv.gz files are ~1 GB each and are never modified in place, so a
+# sampled hash is enough to tell a re-delivered file from an unchanged one.
+FULL_HASH_MAX_BYTES = 64 * 1024 * 1024
+SAMPLE_BYTES = 4 * 1024 * 1024
+
+
+def code_version(*source_paths) -> str:
+    """Short hash of the given source files (pass the stage's __file__ and helper modules)."""
+    h = hashlib.sha256()
+    for path in source_paths:
+        h.update(Path(path).read_bytes())
+    return h.hexdigest()[:12]
+
+
+def content_hash(path) -> str:
+    """blake2b of the file, or of size + head + tail blocks for large files."""
+    path = Path(path)
+    size = path.stat().st_size
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if size <= FULL_HASH_MAX_BYTES:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        else:
+            h.update(str(size).encode())
+            h.update(f.read(SAMPLE_BYTES))
+            f.seek(size - SAMPLE_BYTES)
+            h.update(f.read(SAMPLE_BYTES))
+    return h.hexdigest()
+
+
+def fingerprint(path, previous: Optional[dict] = None) -> dict:
+    """Size, mtime and content hash of a file, reusing previous['hash'] if size/mtime match."""
+    path = Path(path)
+    st = path.stat()
+    record = {'path': str(path), 'size': st.st_size, 'mtime': st.st_mtime}
+    if previous and previous.get('size') == st.st_size and previous.get('mtime') == st.st_mtime:
+        record['hash'] = previous['hash']
+    else:
+        record['hash'] = content_hash(path)
+    return record
+
+
+class StageManifest:
+    """Per-unit input/output records for one pipeline stage."""
+
+    def __init__(self, manifest_dir, version: str):
+        self.manifest_dir = Path(manifest_dir)
+        self.code_version = version
+        self._fingerprints: Dict[str, dict] = {}
+
+    def record_path(self, unit: str) -> Path:
+        """JSON record file for a unit (usable as an input of a dependent unit)."""
+        safe = str(unit).replace('/', '__')
+        return self.manifest_dir / f"{safe}.json"
+
+    def load(self, unit: str) -> Optional[dict]:
+        """The stored record for a unit, or None."""
+        path = self.record_path(unit)
+        if not path.exists():
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def units(self) -> List[str]:
+        """All units with a stored record."""
+        if not self.manifest_dir.exists():
+            return []
+        return sorted(p.stem.replace('__', '/') for p in self.manifest_dir.glob("*.json"))
+
+    def _fingerprint(self, path, previous: Optional[dict] = None) -> dict:
+        key = str(path)
+        if key not in self._fingerprints:
+            self._fingerprints[key] = fingerprint(path, previous)
+        return self._fingerprints[key]
+
+    def is_current(self, unit: str, inputs: Iterable, outputs: Iterable = ()) -> bool:
+        """True if the unit was built by this code version from exactly these inputs."""
+        record = self.load(unit)
+        if record is None or record.get('code_version') != self.code_version:
+            return False
+        if any(not Path(p).exists() for p in outputs):
+            return False
+
+        inputs = [str(p) for p in inputs]
+        stored = {r['path']: r for r in record.get('inputs', [])}
+        if set(inputs) != set(stored):
+            return False
+
+        for path in inputs:
+            if not Path(path).exists():
+                return False
+            if self._fingerprint(path, stored[path])['hash'] != stored[path]['hash']:
+                return False
+        return True
+
+    def changed_inputs(self, unit: str, inputs: Iterable) -> List[str]:
+        """Inputs that are new or differ from the unit's stored record."""
+        record = self.load(unit) or {}
+        stored = {r['path']: r for r in record.get('inputs', [])}
+        changed = []
+        for path in (str(p) for p in inputs):
+            previous = stored.get(path)
+            if previous is None or self._fingerprint(path, previous)['hash'] != previous['hash']:
+                changed.append(path)
+        return changed
+
+    def record(self, unit: str, inputs: Iterable, outputs: Iterable = (), **extra) -> dict:
+        """Store the unit's inputs, outputs and code version after a successful build."""
+        record = self.load(unit) or {}
+        stored = {r['path']: r for r in record.get('inputs', [])}
+        new_record = {
+            'unit': unit,
+            'code_version': self.code_version,
+            'inputs': [self._fingerprint(p, stored.get(str(p))) for p in inputs],
+            'outputs': [str(p) for p in outputs],
+            'updated_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        new_record.update(extra)
+
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        path = self.record_path(unit)
+        tmp_path = path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(new_record, f)
+        os.replace(tmp_path, path)
+        return new_record
+
+    def invalidate(self, unit: str):
+        """Drop a unit's record so it is rebuilt next run."""
+        self.record_path(unit).unlink(missing_ok=True)
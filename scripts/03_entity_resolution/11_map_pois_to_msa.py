@@ -19,6 +19,8 @@ import sys
 
 sys.path.insert(0, '/global/scratch/users/maxkagan/measuring_stakeholder_ideology/inputs')
 from paw_to_cbsa_crosswalk import CBSA_TO_PAW
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / '02_partisan_lean'))
+from panel_query import connect, register_panel
 
 logging.basicConfig(
     level=logging.INFO,
@@ -50,21 +52,19 @@ def build_placekey_cbg_lookup():
     """Build placekey → poi_cbg lookup from ALL partisan lean files."""
     logger.info("Building placekey → poi_cbg lookup from ALL partisan lean files...")
 
-    files = sorted(PARTISAN_LEAN_DIR.glob("partisan_lean_*.parquet"))
-    logger.info(f"Found {len(files)} partisan lean files")
-
-    all_lookups = []
-    for i, f in enumerate(files):
-        df = pd.read_parquet(f, columns=['placekey', 'poi_cbg'])
-        df = df.drop_duplicates(subset=['placekey'])
-        all_lookups.append(df)
-        if (i + 1) % 10 == 0:
-            logger.info(f"  Processed {i + 1}/{len(files)} files...")
-
-    logger.info("Concatenating and deduplicating...")
-    lookup = pd.concat(all_lookups, ignore_index=True)
-    lookup = lookup.drop_duplicates(subset=['placekey'])
-    logger.info(f"Lookup table: {len(lookup):,} unique placekeys with poi_cbg (from {len(files)} months)")
+    con = connect()
+    n_files = register_panel(con, PARTISAN_LEAN_DIR)
+
+    # poi_cbg from each placekey's earliest month, as the month-by-month
+    # drop_duplicates did, computed in one scan of two columns
+    lookup = con.execute("""
+        SELECT placekey, arg_min(poi_cbg, year_month) AS poi_cbg
+        FROM panel
+        WHERE placekey IS NOT NULL
+        GROUP BY placekey
+    """).df()
+    con.close()
+    logger.info(f"Lookup table: {len(lookup):,} unique placekeys with poi_cbg (from {n_files} months)")
 
     return lookup
 
@@ -15,9 +15,7 @@ Usage: python 12_singleton_phase1_features.py --msa columbus_oh
 """
 
 import argparse
-import json
 import os
-import time
 from pathlib import Path
 
 import numpy as np
@@ -29,15 +27,15 @@ if 'OPENAI_API_KEY' not in os.environ:
 
 from openai import OpenAI
 
+from embedding_store import EmbeddingStore
+
 PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology")
 POI_DIR = PROJECT_DIR / "outputs" / "entity_resolution" / "unbranded_pois_by_msa"
 PAW_FILE = PROJECT_DIR / "outputs" / "entity_resolution" / "paw_company_by_msa.parquet"
 OUTPUT_DIR = PROJECT_DIR / "outputs" / "singleton_matching"
-CACHE_DIR = OUTPUT_DIR / "embedding_cache"
 
 TOP_K = 50
 EMBEDDING_MODEL = "text-embedding-3-large"
-BATCH_SIZE = 2000
 
 
 def tokenize(s: str) -> set:
@@ -63,51 +61,6 @@ def contains_match(a: str, b: str) -> bool:
     return a_lower in b_lower or b_lower in a_lower
 
 
-def get_embeddings_batch(client: OpenAI, texts: list, model: str = EMBEDDING_MODEL) -> list:
-    """Get embeddings for a batch of texts."""
-    response = client.embeddings.create(input=texts, model=model)
-    return [item.embedding for item in response.data]
-
-
-def generate_embeddings(client: OpenAI, names: list, cache_file: Path, desc: str) -> np.ndarray:
-    """Generate embeddings with caching."""
-    print(f"  Generating embeddings for {len(names):,} {desc}...")
-
-    if cache_file.exists():
-        print(f"    Loading from cache: {cache_file.name}")
-        with open(cache_file, 'r') as f:
-            cached = json.load(f)
-        if len(cached) == len(names):
-            return np.array(cached)
-        print(f"    Cache size mismatch ({len(cached)} vs {len(names)}), regenerating...")
-
-    all_embeddings = []
-    total_batches = (len(names) + BATCH_SIZE - 1) // BATCH_SIZE
-
-    for i in range(0, len(names), BATCH_SIZE):
-        batch = names[i:i + BATCH_SIZE]
-        batch_num = i // BATCH_SIZE + 1
-
-        if batch_num % 5 == 0 or batch_num == total_batches:
-            print(f"    Batch {batch_num}/{total_batches}...")
-
-        try:
-            embeddings = get_embeddings_batch(client, batch)
-            all_embeddings.extend(embeddings)
-            time.sleep(0.1)
-        except Exception as e:
-            print(f"    Error on batch {batch_num}: {e}, retrying...")
-            time.sleep(5)
-            embeddings = get_embeddings_batch(client, batch)
-            all_embeddings.extend(embeddings)
-
-    with open(cache_file, 'w') as f:
-        json.dump(all_embeddings, f)
-    print(f"    Cached to {cache_file.name}")
-
-    return np.array(all_embeddings)
-
-
 def find_top_k_candidates(poi_embeddings: np.ndarray, company_embeddings: np.ndarray, k: int = TOP_K) -> tuple:
     """
     For each POI embedding, find top-K company candidates by cosine similarity.
@@ -184,7 +137,6 @@ def main():
     print("=" * 70)
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
     print("\n[1] Loading data...")
     poi_file = POI_DIR / f"{msa}.parquet"
@@ -223,11 +175,12 @@ def main():
     print("\n[2] Generating embeddings...")
     client = OpenAI()
 
-    poi_cache = CACHE_DIR / f"{msa}_poi_embeddings.json"
-    company_cache = CACHE_DIR / f"{msa}_company_embeddings.json"
+    store = EmbeddingStore(EMBEDDING_MODEL)
 
-    poi_embeddings = generate_embeddings(client, unique_poi_names, poi_cache, "POI names")
-    company_embeddings = generate_embeddings(client, unique_company_names, company_cache, "company names")
+    print(f"  POI names: {len(unique_poi_names):,}")
+    poi_embeddings = store.get_embeddings(unique_poi_names, client)
+    print(f"  Company names: {len(unique_company_names):,}")
+    company_embeddings = store.get_embeddings(unique_company_names, client)
 
     print("\n[3] Finding top-K candidates...")
     top_indices, top_sims = find_top_k_candidates(poi_embeddings, company_embeddings, TOP_K)
@@ -2,215 +2,129 @@
 """
 National singleton matching using trained logistic regression model.
 
-Processes one or more MSAs, using cached embeddings when available.
+Processes one or more MSAs. Embeddings come from the shared embedding store
+(embedding_store.py), so names embedded for any earlier MSA are reused.
 Generates crosswalk files mapping singleton POIs to PAW companies.
+
+MSAs run largest-first across a process pool; a new MSA starts only while the
+estimated memory of the running ones fits the job's memory budget. Each
+finished MSA is merged into processing_summary.parquet atomically, so an
+interrupted national run picks up where it stopped with --resume.
+
+Usage:
+    python3 16_singleton_national.py <msa1> [msa2] ...
+    python3 16_singleton_national.py --file msa_lists/large_msas.txt --workers 4 --resume
 """
 
 import os
-import sys
-import re
+import fcntl
+import pickle
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import pandas as pd
-import pickle
-import time
+import pyarrow.parquet as pq
 from pathlib import Path
-from typing import List, Dict, Tuple
-from rapidfuzz.distance import JaroWinkler
+from typing import Dict, List, Tuple
 
 from openai import OpenAI
 
+from ann_index import QUANT_MARGIN, THRESHOLD_BLOCK_BYTES, pair_scores, quantize_int8, threshold_pairs
+from embedding_store import EmbeddingStore, sanitize_name
+from name_features import FEATURES, blocking_keys, score_pairs
+
 PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology")
 POI_DIR = PROJECT_DIR / "outputs" / "entity_resolution" / "unbranded_pois_by_msa"
 PAW_FILE = PROJECT_DIR / "outputs" / "entity_resolution" / "paw_company_by_msa.parquet"
 MODEL_FILE = PROJECT_DIR / "outputs" / "singleton_matching" / "training_samples" / "columbus_oh_logit_model_v2.pkl"
-CACHE_DIR = PROJECT_DIR / "outputs" / "singleton_matching" / "embedding_cache_v2"
 OUTPUT_DIR = PROJECT_DIR / "outputs" / "singleton_matching" / "crosswalks"
 
 EMBEDDING_MODEL = "text-embedding-3-large"
 EMBEDDING_DIM = 3072
-BATCH_SIZE = 2000
 SIMILARITY_THRESHOLD = 0.50
 PREDICTION_THRESHOLD = 0.4
-
-
-def sanitize_name(name: str) -> str:
-    """Clean name for embedding API."""
-    if name is None or not isinstance(name, str):
-        return ""
-    name = name.strip()[:8000]
-    name = ''.join(c if c.isprintable() or c in ' \t' else ' ' for c in name)
-    return ' '.join(name.split())
-
-
-def normalize_name(name: str) -> str:
-    """Normalize name for Jaro-Winkler comparison."""
-    name = name.lower().strip()
-
-    suffixes = [
-        r'\s+inc\.?$', r'\s+llc\.?$', r'\s+corp\.?$', r'\s+co\.?$',
-        r'\s+ltd\.?$', r'\s+lp\.?$', r'\s+llp\.?$', r'\s+pllc\.?$',
-        r'\s+pc\.?$', r'\s+pa\.?$', r'\s+company$', r'\s+incorporated$',
-        r'\s+corporation$', r'\s+limited$'
-    ]
-    for suffix in suffixes:
-        name = re.sub(suffix, '', name, flags=re.IGNORECASE)
-
-    title_patterns = [
-        (r'd\s*\.?\s*d\s*\.?\s*s\.?', 'dds'),
-        (r'm\s*\.?\s*d\.?', 'md'),
-        (r'd\s*\.?\s*o\.?', 'do'),
-        (r'p\s*\.?\s*a\.?', 'pa'),
-        (r'd\s*\.?\s*v\s*\.?\s*m\.?', 'dvm'),
-        (r'd\s*\.?\s*c\.?', 'dc'),
-    ]
-    for pattern, replacement in title_patterns:
-        name = re.sub(pattern, replacement, name, flags=re.IGNORECASE)
-
-    name = re.sub(r"['\"]", '', name)
-    name = re.sub(r'\s+', ' ', name)
-
-    return name.strip()
-
-
-class EmbeddingCache:
-    """Manages cached embeddings with incremental updates."""
-
-    def __init__(self, msa: str):
-        self.msa = msa
-        self.names_file = CACHE_DIR / f"{msa}_names.npy"
-        self.emb_file = CACHE_DIR / f"{msa}_embeddings.npy"
-        self.cache: Dict[str, np.ndarray] = {}
-        self._load_cache()
-
-    def _load_cache(self):
-        """Load existing cache from numpy files."""
-        if self.names_file.exists() and self.emb_file.exists():
-            names = np.load(self.names_file, allow_pickle=True)
-            embeddings = np.load(self.emb_file)
-            for name, emb in zip(names, embeddings):
-                self.cache[name] = emb
-            print(f"    Loaded {len(self.cache):,} cached embeddings")
-
-    def save_cache(self):
-        """Save cache to numpy files."""
-        CACHE_DIR.mkdir(parents=True, exist_ok=True)
-        names = np.array(list(self.cache.keys()), dtype=object)
-        embeddings = np.array([self.cache[n] for n in names], dtype=np.float16)
-        np.save(self.names_file, names)
-        np.save(self.emb_file, embeddings)
-        print(f"    Saved {len(self.cache):,} embeddings to cache")
-
-    def get_embeddings(self, names: List[str], client: OpenAI) -> np.ndarray:
-        """Get embeddings, using cache when available."""
-        names_to_embed = [n for n in names if n not in self.cache]
-        cached_count = len(names) - len(names_to_embed)
-
-        if cached_count > 0:
-            print(f"    Cache hit: {cached_count:,}, need to embed: {len(names_to_embed):,}")
-
-        if names_to_embed:
-            new_embeddings = self._embed_batch(names_to_embed, client)
-            for name, emb in zip(names_to_embed, new_embeddings):
-                self.cache[name] = emb.astype(np.float16)
-            self.save_cache()
-
-        return np.array([self.cache[n] for n in names], dtype=np.float32)
-
-    def _embed_batch(self, names: List[str], client: OpenAI) -> np.ndarray:
-        """Embed names in batches with retry logic."""
-        all_embeddings = []
-        total_batches = (len(names) + BATCH_SIZE - 1) // BATCH_SIZE
-
-        for i in range(0, len(names), BATCH_SIZE):
-            batch = names[i:i + BATCH_SIZE]
-            batch_num = i // BATCH_SIZE + 1
-
-            if batch_num % 10 == 0 or batch_num == total_batches:
-                print(f"      Embedding batch {batch_num}/{total_batches}...")
-
-            for attempt in range(3):
-                try:
-                    response = client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
-                    embeddings = [item.embedding for item in response.data]
-                    all_embeddings.extend(embeddings)
-                    time.sleep(0.1)
-                    break
-                except Exception as e:
-                    print(f"      Attempt {attempt+1} failed: {e}")
-                    time.sleep(5 * (attempt + 1))
-            else:
-                raise RuntimeError(f"Failed to embed batch {batch_num}")
-
-        return np.array(all_embeddings)
+# Only score pairs sharing a blocking key: None, 'first_token' or 'metaphone'.
+# Blocking drops true matches whose first words differ, so it is off by default.
+BLOCKING_KEY = None
+# Search int8 codes of the float16 store vectors (4x less memory than float32),
+# retrieving at SIMILARITY_THRESHOLD - QUANT_MARGIN and then re-scoring exactly
+QUANTIZED_SEARCH = True
+
+# Memory estimate of the candidate pairs: pairs above SIMILARITY_THRESHOLD per
+# company (acts as a top-k; set high, raise it if workers get OOM-killed) times
+# the bytes each pair costs from threshold_pairs through the model
+CANDIDATES_PER_COMPANY = 200
+PAIR_ROW_BYTES = (
+    2 * (4 + 4 + 2)            # int32 index pairs + float16 scores, before and after sorting
+    + 4 + 1                    # exact float32 similarity and keep mask
+    + 4 * 8                    # name object arrays for score_pairs and the candidates frame
+    + 2 * 8 * len(FEATURES)    # float64 feature columns, copied once by concat
+    + 8 + 8                    # match_prob and predicted_match
+)
+
+# Set in main() before workers are forked
+MODEL = None
+COMPANIES_BY_MSA: Dict[str, List[str]] = {}
+CLIENT = None
 
 
 def compute_features(poi_names: List[str], company_names: List[str],
                      poi_emb: np.ndarray, company_emb: np.ndarray) -> pd.DataFrame:
     """Compute candidate pairs and features using vectorized operations."""
 
-    # Normalize embeddings for cosine similarity
-    poi_norm = poi_emb / np.linalg.norm(poi_emb, axis=1, keepdims=True)
-    company_norm = company_emb / np.linalg.norm(company_emb, axis=1, keepdims=True)
-
-    # Compute similarity matrix
-    print(f"    Computing similarity matrix ({len(poi_names):,} x {len(company_names):,})...")
-    similarity_matrix = poi_norm @ company_norm.T
-
-    # Find candidates above threshold
-    poi_idx, company_idx = np.where(similarity_matrix >= SIMILARITY_THRESHOLD)
-    similarities = similarity_matrix[poi_idx, company_idx]
+    # Normalize embeddings for cosine similarity (as int8 codes + row scales)
+    if QUANTIZED_SEARCH:
+        poi_norm, poi_scales = quantize_int8(poi_emb)
+        company_norm, company_scales = quantize_int8(company_emb)
+        search_threshold = SIMILARITY_THRESHOLD - QUANT_MARGIN
+    else:
+        poi_norm = poi_emb / np.linalg.norm(poi_emb, axis=1, keepdims=True)
+        company_norm = company_emb / np.linalg.norm(company_emb, axis=1, keepdims=True)
+        poi_scales = company_scales = None
+        search_threshold = SIMILARITY_THRESHOLD
+
+    # Stream POI blocks against the companies, keeping only pairs above threshold
+    poi_keys = company_keys = None
+    if BLOCKING_KEY:
+        poi_keys = blocking_keys(poi_names, BLOCKING_KEY)
+        company_keys = blocking_keys(company_names, BLOCKING_KEY)
+    blocks = f" within {BLOCKING_KEY} blocks" if BLOCKING_KEY else ""
+    print(f"    Searching {len(poi_names):,} x {len(company_names):,} pairs{blocks}...")
+    poi_idx, company_idx, _ = threshold_pairs(poi_norm, company_norm, search_threshold,
+                                              query_keys=poi_keys, database_keys=company_keys,
+                                              query_scales=poi_scales, database_scales=company_scales)
+
+    # Exact float32 similarities for the surviving pairs (the search keeps float16)
+    if QUANTIZED_SEARCH:
+        similarities = pair_scores(poi_emb, company_emb, poi_idx, company_idx, normalize=True)
+        keep = similarities >= SIMILARITY_THRESHOLD
+        poi_idx, company_idx, similarities = poi_idx[keep], company_idx[keep], similarities[keep]
+    else:
+        similarities = pair_scores(poi_norm, company_norm, poi_idx, company_idx)
 
     print(f"    Found {len(poi_idx):,} candidate pairs above {SIMILARITY_THRESHOLD} threshold")
 
     if len(poi_idx) == 0:
         return pd.DataFrame()
 
-    # Build candidate dataframe
-    candidates = pd.DataFrame({
-        'poi_name': [poi_names[i] for i in poi_idx],
-        'company_name': [company_names[i] for i in company_idx],
-        'cos_sim': similarities
-    })
-
-    # Compute string similarity features
+    # String similarity features, each unique name normalized once
     print(f"    Computing string similarity features...")
+    poi_names = np.asarray(poi_names, dtype=object)
+    company_names = np.asarray(company_names, dtype=object)
+    features = score_pairs(poi_names[poi_idx], company_names[company_idx], similarities)
 
-    candidates['jaro_winkler'] = candidates.apply(
-        lambda r: JaroWinkler.similarity(r['poi_name'], r['company_name']),
-        axis=1
-    )
-
-    poi_norm_names = [normalize_name(n) for n in candidates['poi_name']]
-    company_norm_names = [normalize_name(n) for n in candidates['company_name']]
-    candidates['jaro_winkler_norm'] = [
-        JaroWinkler.similarity(p, c)
-        for p, c in zip(poi_norm_names, company_norm_names)
-    ]
-
-    def token_jaccard(a: str, b: str) -> float:
-        tokens_a = set(a.lower().split())
-        tokens_b = set(b.lower().split())
-        if not tokens_a or not tokens_b:
-            return 0.0
-        return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
-
-    candidates['token_jaccard'] = candidates.apply(
-        lambda r: token_jaccard(r['poi_name'], r['company_name']),
-        axis=1
-    )
-
-    candidates['contains_match'] = candidates.apply(
-        lambda r: float(
-            r['poi_name'].lower() in r['company_name'].lower() or
-            r['company_name'].lower() in r['poi_name'].lower()
-        ),
-        axis=1
-    )
+    candidates = pd.DataFrame({
+        'poi_name': poi_names[poi_idx],
+        'company_name': company_names[company_idx],
+    })
+    candidates = pd.concat([candidates, features], axis=1)
 
     return candidates
 
 
-def process_msa(msa: str, paw_df: pd.DataFrame, model, client: OpenAI) -> Tuple[int, int]:
+def process_msa(msa: str, company_names_raw: List[str], model, client: OpenAI) -> Tuple[int, int]:
     """Process a single MSA and generate crosswalk."""
 
     print(f"\n{'='*60}")
@@ -228,22 +142,21 @@ def process_msa(msa: str, paw_df: pd.DataFrame, model, client: OpenAI) -> Tuple[
     poi_names = [sanitize_name(n) for n in poi_names_raw if sanitize_name(n)]
     print(f"  POI names: {len(poi_names):,}")
 
-    # Load company names for this MSA
-    paw_msa = paw_df[paw_df['msa'] == msa]
-    if len(paw_msa) == 0:
+    # Company names for this MSA (partitioned once in main)
+    if not company_names_raw:
         print(f"  WARNING: No PAW companies for this MSA, skipping")
         return 0, 0
 
-    company_names_raw = paw_msa['company_name'].unique().tolist()
     company_names = [sanitize_name(n) for n in company_names_raw if sanitize_name(n)]
     print(f"  Company names: {len(company_names):,}")
 
     # Get embeddings
     print(f"  Getting embeddings...")
-    cache = EmbeddingCache(msa)
+    store = EmbeddingStore(EMBEDDING_MODEL)
 
     all_names = list(set(poi_names + company_names))
-    all_embeddings = cache.get_embeddings(all_names, client)
+    all_embeddings = store.get_embeddings(all_names, client,
+                                          dtype=np.float16 if QUANTIZED_SEARCH else np.float32)
 
     name_to_idx = {n: i for i, n in enumerate(all_names)}
     poi_emb = all_embeddings[[name_to_idx[n] for n in poi_names]]
@@ -258,9 +171,7 @@ def process_msa(msa: str, paw_df: pd.DataFrame, model, client: OpenAI) -> Tuple[
 
     # Apply model
     print(f"  Applying trained model...")
-    feature_cols = ['cos_sim', 'jaro_winkler', 'jaro_winkler_norm',
-                    'token_jaccard', 'contains_match']
-    X = candidates[feature_cols].values
+    X = candidates[FEATURES].values
 
     candidates['match_prob'] = model.predict_proba(X)[:, 1]
     candidates['predicted_match'] = (candidates['match_prob'] >= PREDICTION_THRESHOLD).astype(int)
@@ -287,50 +198,187 @@ def process_msa(msa: str, paw_df: pd.DataFrame, model, client: OpenAI) -> Tuple[
     return len(poi_names), n_matched
 
 
-def main(msas: List[str]):
+def partition_companies(paw_df: pd.DataFrame, msas: List[str]) -> Dict[str, List[str]]:
+    """Unique company names per MSA, from one groupby over the PAW table."""
+    paw_df = paw_df[paw_df['msa'].isin(msas)]
+    return {msa: group.unique().tolist() for msa, group in paw_df.groupby('msa')['company_name']}
+
+
+def estimate_memory_gb(msa: str, n_companies: int) -> float:
+    """
+    Rough peak memory of process_msa: copies of the name embeddings (store
+    output, POI/company slices and their normalized or int8 copies), one
+    score block, and the candidate pairs with their feature frame
+    (n_companies x CANDIDATES_PER_COMPANY pairs of PAIR_ROW_BYTES each).
+    """
+    poi_file = POI_DIR / f"{msa}.parquet"
+    n_pois = pq.read_metadata(poi_file).num_rows if poi_file.exists() else 0
+    # float16 output and slices + int8 codes, vs three float32 copies
+    bytes_per_value = 2 + 2 + 1 if QUANTIZED_SEARCH else 3 * 4
+    embedding_bytes = (n_pois + n_companies) * EMBEDDING_DIM * bytes_per_value
+    n_pairs = n_companies * min(n_pois, CANDIDATES_PER_COMPANY)
+    return (embedding_bytes + THRESHOLD_BLOCK_BYTES + n_pairs * PAIR_ROW_BYTES) / 1024 ** 3
+
+
+def memory_budget_gb() -> float:
+    """Memory available to this job: SLURM allocation if set, else physical memory."""
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_NODE']) / 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+def update_summary(results: List[dict]):
+    """Merge results into processing_summary.parquet atomically (safe across array tasks)."""
+    summary_file = OUTPUT_DIR / "processing_summary.parquet"
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(OUTPUT_DIR / "processing_summary.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        results_df = pd.DataFrame(results)
+        if summary_file.exists():
+            existing = pd.read_parquet(summary_file)
+            results_df = pd.concat([existing, results_df]).drop_duplicates(subset=['msa'], keep='last')
+        tmp_file = summary_file.with_name(summary_file.name + '.tmp')
+        results_df.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, summary_file)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def completed_msas() -> set:
+    """MSAs recorded as successful whose crosswalk is on disk."""
+    summary_file = OUTPUT_DIR / "processing_summary.parquet"
+    if not summary_file.exists():
+        return set()
+    summary = pd.read_parquet(summary_file)
+    done = summary[summary['status'] == 'success']
+    # MSAs without matches write no crosswalk
+    return {row.msa for row in done.itertuples()
+            if row.n_matched == 0 or (OUTPUT_DIR / f"{row.msa}_singleton_crosswalk.parquet").exists()}
+
+
+def error_result(msa: str, message: str) -> dict:
+    """Summary row for an MSA that failed (rerun by --resume)."""
+    return {
+        'msa': msa,
+        'n_pois': 0,
+        'n_matched': 0,
+        'match_rate': 0,
+        'status': f'error: {message[:100]}'
+    }
+
+
+def run_msa(msa: str) -> dict:
+    """Worker: process one MSA and return its summary row."""
+    global CLIENT
+    if CLIENT is None:
+        CLIENT = OpenAI()
+    try:
+        n_pois, n_matched = process_msa(msa, COMPANIES_BY_MSA.get(msa, []), MODEL, CLIENT)
+        return {
+            'msa': msa,
+            'n_pois': n_pois,
+            'n_matched': n_matched,
+            'match_rate': n_matched / n_pois if n_pois > 0 else 0,
+            'status': 'success'
+        }
+    except Exception as e:
+        print(f"  ERROR ({msa}): {e}")
+        return error_result(msa, str(e))
+
+
+def schedule(msas: List[str], workers: int, budget_gb: float) -> List[dict]:
+    """
+    Run MSAs largest-first across a process pool.
+
+    A new MSA starts only while the estimated memory of the running ones fits
+    in budget_gb (an MSA larger than the budget runs alone). Each result is
+    written to the summary as soon as it finishes.
+
+    If a worker dies (e.g. OOM-killed), the pool is broken: every MSA that was
+    running on it is recorded as an error and a fresh pool takes the rest of
+    the queue.
+    """
+    estimates = {msa: estimate_memory_gb(msa, len(COMPANIES_BY_MSA.get(msa, []))) for msa in msas}
+    queue = sorted(msas, key=lambda m: estimates[m], reverse=True)
+    print(f"  Largest: {queue[0]} (~{estimates[queue[0]]:.1f} GB), budget {budget_gb:.0f} GB, "
+          f"up to {workers} workers")
+
+    results = []
+    running = {}
+    ctx = multiprocessing.get_context('fork')
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+    try:
+        while queue or running:
+            in_use = sum(estimates[m] for m in running.values())
+            # Largest MSA that fits next to the running ones
+            for msa in list(queue):
+                if len(running) >= workers:
+                    break
+                if not running or in_use + estimates[msa] <= budget_gb:
+                    running[executor.submit(run_msa, msa)] = msa
+                    in_use += estimates[msa]
+                    queue.remove(msa)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            while finished:
+                for future in finished:
+                    msa = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        print(f"  ERROR ({msa}): worker process died (out of memory?)")
+                        result = error_result(msa, 'worker process died (out of memory?)')
+                        broken = True
+                    results.append(result)
+                    update_summary([result])
+                    print(f"  [{len(results)}/{len(msas)}] {msa}: {result['status']}, "
+                          f"{result['n_matched']:,}/{result['n_pois']:,} matched")
+                # A dead worker fails every future of the pool; collect them all
+                finished = wait(running)[0] if broken else set()
+
+            if broken:
+                executor.shutdown(wait=True)
+                print(f"  Restarting worker pool, {len(queue)} MSAs left")
+                executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+    finally:
+        executor.shutdown(wait=True)
+    return results
+
+
+def main(msas: List[str], workers: int = 1, memory_gb: float = None, resume: bool = False):
     """Process multiple MSAs."""
+    global MODEL, COMPANIES_BY_MSA
 
     print("=" * 70)
     print("National Singleton Matching")
     print("=" * 70)
+
+    if resume:
+        done = completed_msas()
+        skipped = [m for m in msas if m in done]
+        msas = [m for m in msas if m not in done]
+        print(f"Resuming: skipping {len(skipped)} MSAs already in the summary")
     print(f"MSAs to process: {len(msas)}")
+    if not msas:
+        return
 
     # Load model
     print(f"\nLoading trained model from {MODEL_FILE.name}...")
     with open(MODEL_FILE, 'rb') as f:
         model_dict = pickle.load(f)
-        model = model_dict['model']
+        MODEL = model_dict['model']
     print(f"  Features: {model_dict.get('features', 'N/A')}")
 
-    # Load PAW data
+    # Load PAW data once and split it by MSA
     print(f"Loading PAW company data...")
-    paw_df = pd.read_parquet(PAW_FILE)
+    paw_df = pd.read_parquet(PAW_FILE, columns=['msa', 'company_name'])
     print(f"  Total companies: {len(paw_df):,}")
+    COMPANIES_BY_MSA = partition_companies(paw_df, msas)
+    del paw_df
 
-    # Initialize OpenAI client
-    client = OpenAI()
-
-    # Process each MSA
-    results = []
-    for msa in msas:
-        try:
-            n_pois, n_matched = process_msa(msa, paw_df, model, client)
-            results.append({
-                'msa': msa,
-                'n_pois': n_pois,
-                'n_matched': n_matched,
-                'match_rate': n_matched / n_pois if n_pois > 0 else 0,
-                'status': 'success'
-            })
-        except Exception as e:
-            print(f"  ERROR: {e}")
-            results.append({
-                'msa': msa,
-                'n_pois': 0,
-                'n_matched': 0,
-                'match_rate': 0,
-                'status': f'error: {str(e)[:100]}'
-            })
+    # Workers are forked after MODEL and COMPANIES_BY_MSA are set
+    budget_gb = memory_gb or memory_budget_gb()
+    results = schedule(msas, max(1, workers), budget_gb)
 
     # Summary
     print("\n" + "=" * 70)
@@ -348,25 +396,26 @@ def main(msas: List[str]):
         overall_rate = successful['n_matched'].sum() / successful['n_pois'].sum()
         print(f"Overall match rate: {100*overall_rate:.1f}%")
 
-    # Save results summary
-    summary_file = OUTPUT_DIR / "processing_summary.parquet"
-    if summary_file.exists():
-        existing = pd.read_parquet(summary_file)
-        results_df = pd.concat([existing, results_df]).drop_duplicates(subset=['msa'], keep='last')
-    results_df.to_parquet(summary_file, index=False)
-    print(f"\nSummary saved to {summary_file}")
+    print(f"\nSummary saved to {OUTPUT_DIR / 'processing_summary.parquet'}")
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python 16_singleton_national.py <msa1> [msa2] ...")
-        print("   or: python 16_singleton_national.py --file <msa_list.txt>")
-        sys.exit(1)
-
-    if sys.argv[1] == '--file':
-        with open(sys.argv[2], 'r') as f:
-            msas = [line.strip() for line in f if line.strip()]
-    else:
-        msas = sys.argv[1:]
-
-    main(msas)
+    parser = argparse.ArgumentParser(description='National singleton matching')
+    parser.add_argument('msas', nargs='*', help='MSAs to process')
+    parser.add_argument('--file', type=Path, help='File with one MSA per line')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)) // 4 or 1,
+                        help='MSAs processed in parallel (default: cpus / 4)')
+    parser.add_argument('--memory-gb', type=float, help='Memory budget (default: SLURM allocation)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip MSAs already recorded as successful in processing_summary.parquet')
+    args = parser.parse_args()
+
+    msas = list(args.msas)
+    if args.file:
+        with open(args.file, 'r') as f:
+            msas += [line.strip() for line in f if line.strip()]
+    if not msas:
+        parser.error("give MSAs or --file <msa_list.txt>")
+
+    main(list(dict.fromkeys(msas)), workers=args.workers, memory_gb=args.memory_gb, resume=args.resume)
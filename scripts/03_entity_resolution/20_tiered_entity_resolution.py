@@ -4,22 +4,47 @@ Tiered Entity Resolution: SafeGraph Brands → PAW Companies
 
 Three-tier matching strategy:
   Tier 1: Direct ticker matching (highest confidence)
-  Tier 2: Parent brand inheritance (high confidence)
+  Tier 2: Parent brand inheritance, following multi-level parent chains (high confidence)
   Tier 3: Semantic + Jaro-Winkler fuzzy matching (medium confidence)
 
-For Tier 3, prioritizes PAW companies with tickers/gvkeys.
-
-Usage: python 20_tiered_entity_resolution.py
+For Tier 3, prioritizes PAW companies with tickers/gvkeys. Top-K company
+candidates come from a persistent IVF index over the company embeddings
+(ann_index.py, saved under embedding_cache/ and reused across runs);
+set USE_ANN_INDEX = False for exact brute-force search. Tune TIER3_NPROBE
+with `python3 ann_index.py benchmark`. With QUANTIZE_INDEX the index holds
+int8 codes and the best TOP_K * RERANK_OVERSAMPLE candidates are re-scored
+exactly against the float16 company embeddings (`python3 ann_index.py
+benchmark-quantized` compares it with the float32 path). String features for all candidates
+of a chunk are scored in one batch (name_features.py).
+
+Embeddings come from the shared store (embedding_store.py). To reuse the
+existing positional company cache, import it once:
+    python3 embedding_store.py import-array --model text-embedding-3-small \\
+        --names paw_companies_for_matching.parquet --column company_name \\
+        --embeddings embedding_cache/company_embeddings.npy
+
+Delta mode (--delta) re-runs Tiers 1 and 2 (cheap joins) but matches only
+new or changed brands in Tier 3, plus unchanged brands against new or changed
+PAW companies, and carries every other Tier 3 result over from the previous
+brand_matches_tiered.parquet. Row hashes of the previous inputs are kept in
+brand_matches_tiered_brands.parquet / _companies.parquet. Changing the
+embedding model, TOP_K or TIER3_THRESHOLD forces a full run.
+
+Usage:
+    python 20_tiered_entity_resolution.py
+    python 20_tiered_entity_resolution.py --delta
 """
 
-import json
 import os
-import time
+import argparse
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import jellyfish
+
+from ann_index import RERANK_OVERSAMPLE, exact_top_k, load_or_build_index
+from embedding_store import EmbeddingStore
+from name_features import score_pairs
 
 if 'OPENAI_API_KEY' not in os.environ:
     raise ValueError("OPENAI_API_KEY environment variable not set")
@@ -29,40 +54,38 @@ from openai import OpenAI
 PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology")
 INPUT_DIR = PROJECT_DIR / "inputs"
 OUTPUT_DIR = PROJECT_DIR / "outputs" / "entity_resolution"
-CACHE_DIR = OUTPUT_DIR / "embedding_cache"  # Use existing cache with 535K company embeddings
+CACHE_DIR = OUTPUT_DIR / "embedding_cache"
+# IVF index files are saved next to this path (company_embeddings.ivf.*)
+COMPANY_INDEX_PATH = CACHE_DIR / "company_embeddings.npy"
 
 SAFEGRAPH_BRANDS = INPUT_DIR / "safegraph_brand_info" / "brand-info-spend-patterns.parquet"
 PAW_COMPANIES = OUTPUT_DIR / "paw_companies_for_matching.parquet"
 
 # Use text-embedding-3-small to match existing cached embeddings
 EMBEDDING_MODEL = "text-embedding-3-small"
-EMBEDDING_DIM = 1536
-BATCH_SIZE = 2000
 TOP_K = 20
 TIER3_THRESHOLD = 0.75
-
-
-def tokenize(s: str) -> set:
-    """Tokenize string into lowercase word set."""
-    return set(s.lower().split())
-
-
-def token_jaccard(a: str, b: str) -> float:
-    """Jaccard similarity on word tokens."""
-    tokens_a = tokenize(a)
-    tokens_b = tokenize(b)
-    if not tokens_a or not tokens_b:
-        return 0.0
-    intersection = len(tokens_a & tokens_b)
-    union = len(tokens_a | tokens_b)
-    return intersection / union if union > 0 else 0.0
-
-
-def contains_match(a: str, b: str) -> bool:
-    """Check if one string is contained in the other."""
-    a_lower = a.lower()
-    b_lower = b.lower()
-    return a_lower in b_lower or b_lower in a_lower
+USE_ANN_INDEX = True
+TIER3_NPROBE = 32
+QUANTIZE_INDEX = True
+
+# --delta bookkeeping, written next to the output after every run
+BRAND_STATE_FILE = OUTPUT_DIR / "brand_matches_tiered_brands.parquet"
+COMPANY_STATE_FILE = OUTPUT_DIR / "brand_matches_tiered_companies.parquet"
+# A brand or company counts as changed when any of these fields changes
+BRAND_HASH_COLUMNS = ['BRAND_NAME', 'STOCK_SYMBOL', 'NAICS_CODE', 'PARENT_SAFEGRAPH_BRAND_ID']
+COMPANY_HASH_COLUMNS = ['rcid', 'company_name', 'gvkey', 'ticker', 'has_ticker', 'has_gvkey',
+                        'final_parent_company', 'final_parent_company_rcid']
+# Above this share of changed brands a delta run is no faster than a full one
+DELTA_MAX_FRACTION = 0.5
+# Tier 2 follows parent brand chains up to this many levels (guards against cycles)
+MAX_PARENT_LEVELS = 10
+
+TIER3_COLUMNS = [
+    'SAFEGRAPH_BRAND_ID', 'BRAND_NAME', 'STOCK_SYMBOL', 'NAICS_CODE', 'rcid', 'company_name', 'gvkey',
+    'is_verified', 'final_parent_company', 'final_parent_company_rcid', 'match_tier', 'match_method',
+    'confidence', 'cos_sim', 'jaro_winkler', 'jaro_winkler_norm', 'token_jaccard', 'contains_match',
+]
 
 
 def normalize_name(name: str) -> str:
@@ -74,87 +97,6 @@ def normalize_name(name: str) -> str:
     return ' '.join(name.split())
 
 
-def get_embeddings_batch(client: OpenAI, texts: list) -> list:
-    """Get embeddings for a batch of texts."""
-    response = client.embeddings.create(input=texts, model=EMBEDDING_MODEL)
-    return [item.embedding for item in response.data]
-
-
-def load_cached_embeddings(cache_file: Path, expected_count: int) -> np.ndarray:
-    """Load embeddings from cache file (supports both .npy and .json formats)."""
-    npy_file = cache_file.with_suffix('.npy')
-    json_file = cache_file.with_suffix('.json')
-
-    # Try numpy format first (faster)
-    if npy_file.exists():
-        print(f"    Loading from numpy cache: {npy_file.name}")
-        data = np.load(npy_file)
-        if len(data) == expected_count:
-            return data.astype(np.float32)
-        print(f"    Cache size mismatch ({len(data)} vs {expected_count})")
-
-    # Try JSON format (existing cache)
-    if json_file.exists():
-        print(f"    Loading from JSON cache: {json_file.name}")
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-        if len(data) == expected_count:
-            print(f"    Loaded {len(data):,} embeddings, converting to numpy...")
-            return np.array(data, dtype=np.float32)
-        print(f"    Cache size mismatch ({len(data)} vs {expected_count})")
-
-    return None
-
-
-def generate_embeddings(client: OpenAI, names: list, cache_file: Path, desc: str) -> np.ndarray:
-    """Generate embeddings with caching. Checks for existing cache first."""
-    print(f"  Processing embeddings for {len(names):,} {desc}...")
-
-    CACHE_DIR.mkdir(parents=True, exist_ok=True)
-
-    # Check for existing cache
-    cached = load_cached_embeddings(cache_file, len(names))
-    if cached is not None:
-        print(f"    Using cached embeddings ({len(cached):,} x {cached.shape[1]} dimensions)")
-        return cached
-
-    print(f"    No valid cache found, generating new embeddings...")
-    all_embeddings = []
-    total_batches = (len(names) + BATCH_SIZE - 1) // BATCH_SIZE
-
-    for i in range(0, len(names), BATCH_SIZE):
-        batch = names[i:i + BATCH_SIZE]
-        batch_num = i // BATCH_SIZE + 1
-
-        if batch_num % 5 == 0 or batch_num == total_batches:
-            print(f"    Batch {batch_num}/{total_batches}...")
-
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                embeddings = get_embeddings_batch(client, batch)
-                all_embeddings.extend(embeddings)
-                time.sleep(0.1)
-                break
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    wait_time = 2 ** attempt * 5
-                    print(f"    Error on batch {batch_num}: {e}, retry {attempt + 1}/{max_retries} in {wait_time}s...")
-                    time.sleep(wait_time)
-                else:
-                    print(f"    Failed batch {batch_num} after {max_retries} attempts: {e}")
-                    raise
-
-    embeddings_array = np.array(all_embeddings, dtype=np.float32)
-
-    # Save as numpy for future use
-    npy_file = cache_file.with_suffix('.npy')
-    np.save(npy_file, embeddings_array)
-    print(f"    Cached to {npy_file.name}")
-
-    return embeddings_array
-
-
 def tier1_ticker_matching(sg: pd.DataFrame, paw: pd.DataFrame) -> pd.DataFrame:
     """Tier 1: Direct ticker matching."""
     print("\n" + "=" * 70)
@@ -190,59 +132,62 @@ def tier1_ticker_matching(sg: pd.DataFrame, paw: pd.DataFrame) -> pd.DataFrame:
 
 
 def tier2_parent_inheritance(sg: pd.DataFrame, tier1: pd.DataFrame) -> pd.DataFrame:
-    """Tier 2: Parent brand inheritance."""
+    """
+    Tier 2: Parent brand inheritance.
+
+    Each brand inherits the Tier 1 match of its nearest ancestor, following
+    PARENT_SAFEGRAPH_BRAND_ID through up to MAX_PARENT_LEVELS levels. Every
+    step is one vectorized lookup for all brands still unresolved.
+    """
     print("\n" + "=" * 70)
     print("TIER 2: Parent Brand Inheritance")
     print("=" * 70)
 
-    tier1_brand_ids = set(tier1['SAFEGRAPH_BRAND_ID'].unique())
+    tier1_brand_ids = tier1['SAFEGRAPH_BRAND_ID'].unique()
 
-    sg_with_parent = sg[
-        sg['PARENT_SAFEGRAPH_BRAND_ID'].notna() &
-        (sg['PARENT_SAFEGRAPH_BRAND_ID'] != '') &
-        (~sg['SAFEGRAPH_BRAND_ID'].isin(tier1_brand_ids))
-    ].copy()
+    has_parent = sg['PARENT_SAFEGRAPH_BRAND_ID'].notna() & (sg['PARENT_SAFEGRAPH_BRAND_ID'] != '')
+    parent_of = sg.loc[has_parent].drop_duplicates('SAFEGRAPH_BRAND_ID', keep='last').set_index(
+        'SAFEGRAPH_BRAND_ID')['PARENT_SAFEGRAPH_BRAND_ID']
 
+    sg_with_parent = sg[has_parent & ~sg['SAFEGRAPH_BRAND_ID'].isin(tier1_brand_ids)]
     print(f"  Brands with parent (not in Tier 1): {len(sg_with_parent)}")
 
-    tier1_parent_map = tier1.set_index('SAFEGRAPH_BRAND_ID')[
-        ['rcid', 'company_name', 'gvkey', 'final_parent_company', 'final_parent_company_rcid']
-    ].to_dict('index')
-
-    tier2_records = []
-    for _, row in sg_with_parent.iterrows():
-        parent_id = row['PARENT_SAFEGRAPH_BRAND_ID']
-        if parent_id in tier1_parent_map:
-            parent_match = tier1_parent_map[parent_id]
-            tier2_records.append({
-                'SAFEGRAPH_BRAND_ID': row['SAFEGRAPH_BRAND_ID'],
-                'BRAND_NAME': row['BRAND_NAME'],
-                'STOCK_SYMBOL': row['STOCK_SYMBOL'],
-                'NAICS_CODE': row['NAICS_CODE'],
-                'rcid': parent_match['rcid'],
-                'company_name': parent_match['company_name'],
-                'gvkey': parent_match['gvkey'],
-                'final_parent_company': parent_match['final_parent_company'],
-                'final_parent_company_rcid': parent_match['final_parent_company_rcid'],
-                'match_tier': 2,
-                'match_method': 'parent_inheritance',
-                'confidence': 0.95,
-                'parent_brand_id': parent_id
-            })
-
-    tier2 = pd.DataFrame(tier2_records)
-    print(f"  Tier 2 matches: {len(tier2)} brands")
+    # Walk every chain up one level per step until it reaches a Tier 1 brand
+    ancestor = sg_with_parent['PARENT_SAFEGRAPH_BRAND_ID'].to_numpy(dtype=object)
+    levels = np.ones(len(ancestor), dtype=np.int64)
+    for _ in range(MAX_PARENT_LEVELS - 1):
+        unresolved = pd.notna(ancestor) & ~pd.Series(ancestor).isin(tier1_brand_ids).to_numpy()
+        if not unresolved.any():
+            break
+        ancestor[unresolved] = pd.Series(ancestor[unresolved]).map(parent_of).to_numpy(dtype=object)
+        levels[unresolved] += 1
+
+    inherited = sg_with_parent[[
+        'SAFEGRAPH_BRAND_ID', 'BRAND_NAME', 'STOCK_SYMBOL', 'NAICS_CODE', 'PARENT_SAFEGRAPH_BRAND_ID'
+    ]].assign(ancestor_brand_id=ancestor, parent_levels=levels)
+    tier1_matches = tier1.drop_duplicates('SAFEGRAPH_BRAND_ID', keep='last')[[
+        'SAFEGRAPH_BRAND_ID', 'rcid', 'company_name', 'gvkey', 'final_parent_company', 'final_parent_company_rcid'
+    ]].rename(columns={'SAFEGRAPH_BRAND_ID': 'ancestor_brand_id'})
+    tier2 = inherited.merge(tier1_matches, on='ancestor_brand_id', how='inner')
+
+    tier2 = tier2.rename(columns={'PARENT_SAFEGRAPH_BRAND_ID': 'parent_brand_id'})
+    tier2['match_tier'] = 2
+    tier2['match_method'] = 'parent_inheritance'
+    tier2['confidence'] = 0.95
+    tier2 = tier2[[
+        'SAFEGRAPH_BRAND_ID', 'BRAND_NAME', 'STOCK_SYMBOL', 'NAICS_CODE',
+        'rcid', 'company_name', 'gvkey', 'final_parent_company', 'final_parent_company_rcid',
+        'match_tier', 'match_method', 'confidence', 'parent_brand_id', 'ancestor_brand_id', 'parent_levels'
+    ]]
+
+    n_indirect = int((tier2['parent_levels'] > 1).sum())
+    print(f"  Tier 2 matches: {len(tier2)} brands ({n_indirect} through more than one parent level)")
 
     return tier2
 
 
-def tier3_fuzzy_matching(sg: pd.DataFrame, paw: pd.DataFrame,
-                          matched_brand_ids: set, client: OpenAI) -> pd.DataFrame:
-    """Tier 3: Semantic + Jaro-Winkler fuzzy matching."""
-    print("\n" + "=" * 70)
-    print("TIER 3: Semantic + Jaro-Winkler Fuzzy Matching")
-    print("=" * 70)
-
+def tier3_inputs(sg: pd.DataFrame, paw: pd.DataFrame, matched_brand_ids: set) -> tuple:
+    """Brands left for Tier 3 (with cleaned names) and the PAW companies to match against."""
     sg_unmatched = sg[~sg['SAFEGRAPH_BRAND_ID'].isin(matched_brand_ids)].copy()
     print(f"  Unmatched brands to process: {len(sg_unmatched)}")
 
@@ -251,31 +196,29 @@ def tier3_fuzzy_matching(sg: pd.DataFrame, paw: pd.DataFrame,
 
     # Match against ALL PAW companies, not just verified ones
     # PAW has employee ideology data for private companies too
-    # IMPORTANT: Keep exact same order as parquet to match existing cached embeddings
     paw_all = paw.copy()
     paw_all['company_name_clean'] = paw_all['company_name'].apply(normalize_name)
-    # Don't filter - keep same count as cache (535,165)
 
     print(f"  Total PAW companies for matching: {len(paw_all)}")
+    return sg_unmatched, paw_all
 
-    brand_names = sg_unmatched['brand_name_clean'].tolist()
-    company_names = paw_all['company_name'].tolist()  # Use original names, not normalized, for cache
 
-    # Use existing cache file names (company_embeddings.json has 535K embeddings)
-    brand_cache = CACHE_DIR / "safegraph_brand_embeddings"  # New cache for SafeGraph brands
-    company_cache = CACHE_DIR / "company_embeddings"  # Existing 535K company cache
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / (norms + 1e-10)
 
-    brand_embeddings = generate_embeddings(client, brand_names, brand_cache, "SafeGraph brand names")
-    company_embeddings = generate_embeddings(client, company_names, company_cache, "PAW company names")
 
-    print("\n  Finding top-K candidates and computing features...")
-
-    brand_norms = np.linalg.norm(brand_embeddings, axis=1, keepdims=True)
-    company_norms = np.linalg.norm(company_embeddings, axis=1, keepdims=True)
-    brand_normalized = brand_embeddings / (brand_norms + 1e-10)
-    company_normalized = company_embeddings / (company_norms + 1e-10)
+def tier3_best_matches(brand_names: list, brand_normalized: np.ndarray,
+                       company_names_arr: np.ndarray, search) -> pd.DataFrame:
+    """
+    Best-scoring candidate per brand at or above TIER3_THRESHOLD.
 
-    tier3_records = []
+    search(chunk) returns (top_k_sims, top_k_ids) for a chunk of normalized
+    brand embeddings. Returns one row per matched brand with brand_idx and
+    company_idx (positions in brand_names / company_names_arr), the string
+    features and combined_score.
+    """
+    best_parts = []
     chunk_size = 500
 
     for start in range(0, len(brand_names), chunk_size):
@@ -283,78 +226,277 @@ def tier3_fuzzy_matching(sg: pd.DataFrame, paw: pd.DataFrame,
         if start % 2000 == 0:
             print(f"    Processing brands {start:,}-{end:,} / {len(brand_names):,}...")
 
-        chunk = brand_normalized[start:end]
-        similarities = np.dot(chunk, company_normalized.T)
-
-        for i, sim_row in enumerate(similarities):
-            brand_idx = start + i
-            brand_name = brand_names[brand_idx]
-            brand_row = sg_unmatched.iloc[brand_idx]
-
-            top_k_idx = np.argpartition(sim_row, -TOP_K)[-TOP_K:]
-            top_k_idx = top_k_idx[np.argsort(sim_row[top_k_idx])[::-1]]
-
-            best_match = None
-            best_score = 0
-
-            for company_idx in top_k_idx:
-                company_name = company_names[company_idx]
-                cos_sim = float(sim_row[company_idx])
-
-                jw_sim = jellyfish.jaro_winkler_similarity(brand_name.lower(), company_name.lower())
-                jw_norm = jellyfish.jaro_winkler_similarity(
-                    normalize_name(brand_name).lower(),
-                    normalize_name(company_name).lower()
-                )
-                tj = token_jaccard(brand_name, company_name)
-                contains = 1.0 if contains_match(brand_name, company_name) else 0.0
-
-                combined_score = (0.4 * cos_sim + 0.3 * jw_norm + 0.2 * tj + 0.1 * contains)
-
-                if combined_score > best_score:
-                    best_score = combined_score
-                    best_match = {
-                        'company_idx': company_idx,
-                        'company_name': company_name,
-                        'cos_sim': cos_sim,
-                        'jaro_winkler': jw_sim,
-                        'jaro_winkler_norm': jw_norm,
-                        'token_jaccard': tj,
-                        'contains_match': contains,
-                        'combined_score': combined_score
-                    }
-
-            if best_match and best_match['combined_score'] >= TIER3_THRESHOLD:
-                company_row = paw_all.iloc[best_match['company_idx']]
-                is_verified = (company_row['has_ticker'] == 1) or (company_row['has_gvkey'] == 1)
-                tier3_records.append({
-                    'SAFEGRAPH_BRAND_ID': brand_row['SAFEGRAPH_BRAND_ID'],
-                    'BRAND_NAME': brand_row['BRAND_NAME'],
-                    'STOCK_SYMBOL': brand_row['STOCK_SYMBOL'],
-                    'NAICS_CODE': brand_row['NAICS_CODE'],
-                    'rcid': company_row['rcid'],
-                    'company_name': company_row['company_name'],
-                    'gvkey': company_row['gvkey'] if pd.notna(company_row['gvkey']) else None,
-                    'is_verified': is_verified,
-                    'final_parent_company': company_row['final_parent_company'] if 'final_parent_company' in company_row.index else None,
-                    'final_parent_company_rcid': company_row['final_parent_company_rcid'] if 'final_parent_company_rcid' in company_row.index else None,
-                    'match_tier': 3,
-                    'match_method': 'semantic_fuzzy',
-                    'confidence': best_match['combined_score'],
-                    'cos_sim': best_match['cos_sim'],
-                    'jaro_winkler': best_match['jaro_winkler'],
-                    'jaro_winkler_norm': best_match['jaro_winkler_norm'],
-                    'token_jaccard': best_match['token_jaccard'],
-                    'contains_match': best_match['contains_match']
-                })
-
-    tier3 = pd.DataFrame(tier3_records)
+        top_k_sims, top_k_ids = search(brand_normalized[start:end])
+
+        # Score every (brand, candidate) pair of the chunk in one batch
+        pair_rows, pair_ranks = np.nonzero(top_k_ids >= 0)
+        if len(pair_rows) == 0:
+            continue
+        pair_companies = top_k_ids[pair_rows, pair_ranks]
+        features = score_pairs(
+            [brand_names[start + i] for i in pair_rows],
+            company_names_arr[pair_companies],
+            top_k_sims[pair_rows, pair_ranks].astype(np.float64),
+            normalize=lambda name: normalize_name(name).lower(),
+            lowercase_jw=True,
+        )
+        features['combined_score'] = (0.4 * features['cos_sim'] + 0.3 * features['jaro_winkler_norm'] +
+                                      0.2 * features['token_jaccard'] + 0.1 * features['contains_match'])
+        features['brand_idx'] = start + pair_rows
+        features['company_idx'] = pair_companies
+
+        # Best candidate per brand; idxmax keeps the first (highest-ranked) of ties
+        best_rows = features.loc[features.groupby('brand_idx', sort=False)['combined_score'].idxmax()]
+        best_parts.append(best_rows[best_rows['combined_score'] >= TIER3_THRESHOLD])
+
+    if not best_parts:
+        return pd.DataFrame(columns=['brand_idx', 'company_idx', 'combined_score'])
+    return pd.concat(best_parts, ignore_index=True)
+
+
+def tier3_records(sg_unmatched: pd.DataFrame, paw_all: pd.DataFrame, best: pd.DataFrame) -> pd.DataFrame:
+    """Output rows for the best matches (brand_idx/company_idx index sg_unmatched/paw_all)."""
+    if len(best) == 0:
+        return pd.DataFrame(columns=TIER3_COLUMNS)
+
+    brands = sg_unmatched.iloc[best['brand_idx'].to_numpy(dtype=np.int64)].reset_index(drop=True)
+    companies = paw_all.iloc[best['company_idx'].to_numpy(dtype=np.int64)].reset_index(drop=True)
+    best = best.reset_index(drop=True)
+
+    def company_column(column):
+        return companies[column] if column in companies.columns else None
+
+    tier3 = pd.DataFrame({
+        'SAFEGRAPH_BRAND_ID': brands['SAFEGRAPH_BRAND_ID'],
+        'BRAND_NAME': brands['BRAND_NAME'],
+        'STOCK_SYMBOL': brands['STOCK_SYMBOL'],
+        'NAICS_CODE': brands['NAICS_CODE'],
+        'rcid': companies['rcid'],
+        'company_name': companies['company_name'],
+        'gvkey': companies['gvkey'],
+        'is_verified': (companies['has_ticker'] == 1) | (companies['has_gvkey'] == 1),
+        'final_parent_company': company_column('final_parent_company'),
+        'final_parent_company_rcid': company_column('final_parent_company_rcid'),
+        'match_tier': 3,
+        'match_method': 'semantic_fuzzy',
+        'confidence': best['combined_score'],
+        'cos_sim': best['cos_sim'],
+        'jaro_winkler': best['jaro_winkler'],
+        'jaro_winkler_norm': best['jaro_winkler_norm'],
+        'token_jaccard': best['token_jaccard'],
+        'contains_match': best['contains_match'],
+    })
+    return tier3[TIER3_COLUMNS]
+
+
+def row_hashes(df: pd.DataFrame, columns: list) -> np.ndarray:
+    """uint64 hash of each row over the given columns (those present)."""
+    present = [c for c in columns if c in df.columns]
+    return pd.util.hash_pandas_object(df[present].astype(str), index=False).to_numpy(dtype=np.uint64)
+
+
+def tier3_state(sg_unmatched: pd.DataFrame, brand_hash: np.ndarray, matched_hash: np.ndarray,
+                company_hash: np.ndarray) -> tuple:
+    """
+    Inputs of this Tier 3 run for the next --delta run: every scored brand
+    with its row hash and the hash of the company it matched (0 if none),
+    and the hash of every PAW company.
+    """
+    brand_state = pd.DataFrame({
+        'SAFEGRAPH_BRAND_ID': sg_unmatched['SAFEGRAPH_BRAND_ID'].to_numpy(),
+        'brand_hash': brand_hash,
+        'company_hash': matched_hash,
+        'config': tier3_config(),
+    })
+    company_state = pd.DataFrame({'company_hash': np.unique(company_hash)})
+    return brand_state, company_state
+
+
+def matched_hashes(n_brands: int, best: pd.DataFrame, company_hash: np.ndarray) -> np.ndarray:
+    """Hash of the matched company for each brand position (0 = no match)."""
+    matched = np.zeros(n_brands, dtype=np.uint64)
+    matched[best['brand_idx'].to_numpy(dtype=np.int64)] = company_hash[best['company_idx'].to_numpy(dtype=np.int64)]
+    return matched
+
+
+def tier3_config() -> str:
+    """Settings that change Tier 3 results; a --delta run needs them unchanged."""
+    return f"{EMBEDDING_MODEL}|top_k={TOP_K}|threshold={TIER3_THRESHOLD}"
+
+
+def load_tier3_state():
+    """Previous output and Tier 3 state, or None if a delta run is not possible."""
+    output_file = OUTPUT_DIR / "brand_matches_tiered.parquet"
+    if not (output_file.exists() and BRAND_STATE_FILE.exists() and COMPANY_STATE_FILE.exists()):
+        print("  No previous run state found, running in full")
+        return None
+    brand_state = pd.read_parquet(BRAND_STATE_FILE)
+    if len(brand_state) and (brand_state['config'] != tier3_config()).any():
+        print("  Tier 3 settings changed since the previous run, running in full")
+        return None
+    previous = pd.read_parquet(output_file)
+    return previous[previous['match_tier'] == 3], brand_state, pd.read_parquet(COMPANY_STATE_FILE)
+
+
+def tier3_fuzzy_matching(sg: pd.DataFrame, paw: pd.DataFrame,
+                          matched_brand_ids: set, client: OpenAI) -> tuple:
+    """
+    Tier 3: Semantic + Jaro-Winkler fuzzy matching.
+
+    Returns (tier3, brand_state, company_state); the state lets the next
+    run match only what changed (tier3_delta_matching).
+    """
+    print("\n" + "=" * 70)
+    print("TIER 3: Semantic + Jaro-Winkler Fuzzy Matching")
+    print("=" * 70)
+
+    sg_unmatched, paw_all = tier3_inputs(sg, paw, matched_brand_ids)
+
+    brand_names = sg_unmatched['brand_name_clean'].tolist()
+    company_names = paw_all['company_name'].tolist()  # Original names, as embedded so far
+
+    # Shared store keyed by name, so row order no longer has to match the parquet
+    store = EmbeddingStore(EMBEDDING_MODEL)
+    print(f"  Embeddings for {len(brand_names):,} SafeGraph brand names...")
+    brand_embeddings = store.get_embeddings(brand_names, client)
+    print(f"  Embeddings for {len(company_names):,} PAW company names...")
+    # A quantized index re-ranks from float16 rows, so skip the float32 copy
+    company_dtype = np.float16 if USE_ANN_INDEX and QUANTIZE_INDEX else np.float32
+    company_embeddings = store.get_embeddings(company_names, client, dtype=company_dtype)
+
+    print("\n  Finding top-K candidates and computing features...")
+
+    brand_normalized = normalize_embeddings(brand_embeddings)
+
+    # The index holds its own normalized copy (memory-mapped), so the full
+    # normalized company matrix is only built for exact search
+    if USE_ANN_INDEX:
+        company_index = load_or_build_index(COMPANY_INDEX_PATH, company_embeddings, quantize=QUANTIZE_INDEX)
+        rerank = company_embeddings if QUANTIZE_INDEX else None
+
+        def search(chunk):
+            return company_index.search(chunk, TOP_K, nprobe=TIER3_NPROBE,
+                                        rerank=rerank, oversample=RERANK_OVERSAMPLE)
+    else:
+        company_normalized = normalize_embeddings(company_embeddings)
+
+        def search(chunk):
+            return exact_top_k(chunk, company_normalized, TOP_K)
+
+    company_names_arr = np.asarray(company_names, dtype=object)
+    best = tier3_best_matches(brand_names, brand_normalized, company_names_arr, search)
+    tier3 = tier3_records(sg_unmatched, paw_all, best)
     print(f"  Tier 3 matches: {len(tier3)} brands")
 
-    return tier3
+    company_hash = row_hashes(paw_all, COMPANY_HASH_COLUMNS)
+    state = tier3_state(sg_unmatched, row_hashes(sg_unmatched, BRAND_HASH_COLUMNS),
+                        matched_hashes(len(sg_unmatched), best, company_hash), company_hash)
+    return (tier3,) + state
 
 
-def main():
+def tier3_delta_matching(sg: pd.DataFrame, paw: pd.DataFrame, matched_brand_ids: set,
+                         client: OpenAI, previous_state: tuple) -> tuple:
+    """
+    Tier 3 for only what changed since the previous run.
+
+      - new or changed brands, and brands whose previous match is no longer
+        in PAW, are matched against every company (exact search)
+      - unchanged brands are matched against new or changed companies only,
+        replacing their previous match when a new company scores higher
+      - all other brands keep their previous Tier 3 result
+
+    Top-K is taken per search, so a new company can in rare cases displace
+    a brand's previous candidate differently than a full run would. Falls
+    back to a full run when more than DELTA_MAX_FRACTION of brands changed.
+    """
+    print("\n" + "=" * 70)
+    print("TIER 3: Semantic + Jaro-Winkler Fuzzy Matching (delta)")
+    print("=" * 70)
+
+    previous_tier3, previous_brands, previous_companies = previous_state
+    sg_unmatched, paw_all = tier3_inputs(sg, paw, matched_brand_ids)
+
+    brand_hash = row_hashes(sg_unmatched, BRAND_HASH_COLUMNS)
+    company_hash = row_hashes(paw_all, COMPANY_HASH_COLUMNS)
+
+    # A brand is unchanged if it was scored last time with identical fields
+    # (nullable UInt64 so unmatched rows do not turn the hashes into floats)
+    previous_brands = previous_brands.drop_duplicates(['SAFEGRAPH_BRAND_ID', 'brand_hash'])
+    previous_brands = previous_brands.astype({'company_hash': 'UInt64'})
+    lookup = pd.DataFrame({'SAFEGRAPH_BRAND_ID': sg_unmatched['SAFEGRAPH_BRAND_ID'].to_numpy(),
+                           'brand_hash': brand_hash})
+    lookup = lookup.merge(previous_brands[['SAFEGRAPH_BRAND_ID', 'brand_hash', 'company_hash']],
+                          on=['SAFEGRAPH_BRAND_ID', 'brand_hash'], how='left')
+    unchanged = lookup['company_hash'].notna().to_numpy()
+    matched_hash = lookup['company_hash'].fillna(0).to_numpy(dtype=np.uint64)
+    match_gone = unchanged & (matched_hash != 0) & ~np.isin(matched_hash, company_hash)
+    rescore = ~unchanged | match_gone
+    new_companies = ~np.isin(company_hash, previous_companies['company_hash'].to_numpy())
+
+    print(f"  Brands: {int(unchanged.sum()):,} unchanged, {int((~unchanged).sum()):,} new or changed, "
+          f"{int(match_gone.sum()):,} whose match left PAW")
+    print(f"  PAW companies: {int(new_companies.sum()):,} new or changed")
+
+    if rescore.mean() > DELTA_MAX_FRACTION:
+        print(f"  More than {DELTA_MAX_FRACTION:.0%} of brands changed, running in full")
+        return tier3_fuzzy_matching(sg, paw, matched_brand_ids, client)
+
+    brand_names = sg_unmatched['brand_name_clean'].tolist()
+    company_names_arr = np.asarray(paw_all['company_name'].tolist(), dtype=object)
+    store = EmbeddingStore(EMBEDDING_MODEL)
+    rescore_idx = np.flatnonzero(rescore)
+    recheck_idx = np.flatnonzero(~rescore) if new_companies.any() else np.zeros(0, dtype=np.int64)
+    best_parts = []
+
+    if len(rescore_idx):
+        print(f"\n  Matching {len(rescore_idx):,} brands against all {len(paw_all):,} companies...")
+        brand_normalized = normalize_embeddings(
+            store.get_embeddings([brand_names[i] for i in rescore_idx], client))
+        company_normalized = normalize_embeddings(store.get_embeddings(company_names_arr.tolist(), client))
+        best = tier3_best_matches([brand_names[i] for i in rescore_idx], brand_normalized, company_names_arr,
+                                  lambda chunk: exact_top_k(chunk, company_normalized, TOP_K))
+        best['brand_idx'] = rescore_idx[best['brand_idx'].to_numpy(dtype=np.int64)]
+        best_parts.append(best)
+        del company_normalized
+
+    if len(recheck_idx):
+        new_idx = np.flatnonzero(new_companies)
+        print(f"\n  Matching {len(recheck_idx):,} unchanged brands against "
+              f"{len(new_idx):,} new companies...")
+        brand_normalized = normalize_embeddings(
+            store.get_embeddings([brand_names[i] for i in recheck_idx], client))
+        new_normalized = normalize_embeddings(store.get_embeddings(company_names_arr[new_idx].tolist(), client))
+        best = tier3_best_matches([brand_names[i] for i in recheck_idx], brand_normalized,
+                                  company_names_arr[new_idx],
+                                  lambda chunk: exact_top_k(chunk, new_normalized, TOP_K))
+        best['brand_idx'] = recheck_idx[best['brand_idx'].to_numpy(dtype=np.int64)]
+        best['company_idx'] = new_idx[best['company_idx'].to_numpy(dtype=np.int64)]
+
+        # Keep a new company only where it beats the brand's previous match
+        previous_conf = previous_tier3.drop_duplicates('SAFEGRAPH_BRAND_ID').set_index(
+            'SAFEGRAPH_BRAND_ID')['confidence']
+        brand_ids = sg_unmatched['SAFEGRAPH_BRAND_ID'].to_numpy()[best['brand_idx'].to_numpy(dtype=np.int64)]
+        prior = pd.Series(brand_ids).map(previous_conf).fillna(-np.inf).to_numpy()
+        best_parts.append(best[best['combined_score'].to_numpy() > prior])
+
+    new_best = pd.concat(best_parts, ignore_index=True) if best_parts else \
+        pd.DataFrame(columns=['brand_idx', 'company_idx', 'combined_score'])
+    new_records = tier3_records(sg_unmatched, paw_all, new_best)
+
+    # Previous results for brands that were neither re-matched nor improved
+    keep = ~rescore & (matched_hash != 0)
+    keep[new_best['brand_idx'].to_numpy(dtype=np.int64)] = False
+    keep_ids = sg_unmatched['SAFEGRAPH_BRAND_ID'].to_numpy()[keep]
+    kept = previous_tier3[previous_tier3['SAFEGRAPH_BRAND_ID'].isin(keep_ids)].reindex(columns=TIER3_COLUMNS)
+    tier3 = pd.concat([kept, new_records], ignore_index=True) if len(new_records) else kept.reset_index(drop=True)
+
+    print(f"  Tier 3 matches: {len(tier3)} brands ({len(kept):,} carried over, {len(new_records):,} new)")
+
+    matched = np.where(keep, matched_hash, matched_hashes(len(sg_unmatched), new_best, company_hash))
+    return (tier3,) + tier3_state(sg_unmatched, brand_hash, matched, company_hash)
+
+
+def main(delta: bool = False):
     print("=" * 70)
     print("TIERED ENTITY RESOLUTION: SafeGraph Brands → PAW Companies")
     print("=" * 70)
@@ -376,7 +518,11 @@ def main():
     matched_brand_ids = set(tier1['SAFEGRAPH_BRAND_ID'].unique()) | set(tier2['SAFEGRAPH_BRAND_ID'].unique() if len(tier2) > 0 else [])
 
     client = OpenAI()
-    tier3 = tier3_fuzzy_matching(sg, paw, matched_brand_ids, client)
+    previous_state = load_tier3_state() if delta else None
+    if previous_state is not None:
+        tier3, brand_state, company_state = tier3_delta_matching(sg, paw, matched_brand_ids, client, previous_state)
+    else:
+        tier3, brand_state, company_state = tier3_fuzzy_matching(sg, paw, matched_brand_ids, client)
 
     print("\n" + "=" * 70)
     print("COMBINING RESULTS")
@@ -392,6 +538,8 @@ def main():
 
     output_file = OUTPUT_DIR / "brand_matches_tiered.parquet"
     all_matches.to_parquet(output_file, index=False)
+    brand_state.to_parquet(BRAND_STATE_FILE, index=False)
+    company_state.to_parquet(COMPANY_STATE_FILE, index=False)
     print(f"\n  Saved to: {output_file}")
 
     print("\n" + "=" * 70)
@@ -418,4 +566,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Tiered SafeGraph brand → PAW company matching')
+    parser.add_argument('--delta', action='store_true',
+                        help='Only match brands and companies that changed since the previous run')
+    args = parser.parse_args()
+    main(delta=args.delta)
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""
+Inverted-file (IVF) approximate nearest neighbor index for name embeddings.
+
+Replaces brute-force cosine search against all PAW company embeddings with a
+coarse-quantized search that only scores the vectors in the few clusters
+closest to each query. Pure numpy, CPU only, so it builds offline on any node.
+
+Index layout (saved next to the embedding cache, e.g. company_embeddings.npy):
+  {stem}.ivf.npz          centroids (n_lists x dim), list offsets, row ids in
+                          list order, and a fingerprint of the source matrix
+  {stem}.ivf_vectors.npy  unit-normalized float32 vectors in list order,
+                          memory-mapped at search time; int8 codes for a
+                          quantized index (per-row scales go in the .npz)
+
+Search:
+  1. Score the query against the centroids and take the nprobe best lists
+  2. Score the query against every vector in those lists, list by list for
+     the whole query batch (each list is one contiguous slice)
+  3. Keep the k best per query
+
+Vectors are normalized exactly as the matching scripts normalize them, so the
+returned similarities equal brute force; only recall depends on nprobe. Use
+the benchmark to pick nprobe for a target recall:
+
+    python3 ann_index.py build company_embeddings.npy
+    python3 ann_index.py benchmark company_embeddings.npy \\
+        --queries safegraph_brand_embeddings.npy --k 20 --nprobe 8 16 32 64
+
+int8 retrieval: quantize_int8 stores each unit row as int8 codes plus one
+float32 scale (a quarter of float32 memory). Candidates are retrieved from the
+codes and the survivors re-scored exactly against the float16 embeddings,
+either the k * oversample best (IVFIndex.search(rerank=...)) or every pair
+above threshold - QUANT_MARGIN (threshold_pairs with scales, then
+pair_scores). Compare against the float32 path with:
+
+    python3 ann_index.py benchmark-quantized company_embeddings.npy \\
+        --queries safegraph_brand_embeddings.npy --k 20 --threshold 0.80
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+DEFAULT_NPROBE = 32
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 200_000
+ASSIGN_CHUNK = 8192
+# Largest block of the score matrix threshold_pairs materializes at once
+THRESHOLD_BLOCK_BYTES = 512 * 1024 ** 2
+# Rows of an int8 database converted to float32 at a time
+THRESHOLD_DB_CHUNK = 16384
+# int8 retrieval keeps this many times k candidates for exact re-ranking
+RERANK_OVERSAMPLE = 4
+# int8 threshold scans retrieve at threshold - QUANT_MARGIN, then re-score exactly
+# (int8 cosine error is ~1e-3 for 3072-dim unit vectors; the margin is generous)
+QUANT_MARGIN = 0.02
+
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    """Unit-normalize rows in float32 (same epsilon as the matching scripts)."""
+    x = np.asarray(x, dtype=np.float32)
+    return x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-10)
+
+
+def quantize_int8(x: np.ndarray, chunk_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-row int8 quantization of unit-normalized rows.
+
+    Rows are normalized chunk by chunk from any float dtype, so a float16
+    matrix is never upcast whole. Returns (codes int8, scales float32) with
+    row ~= codes * scale.
+    """
+    codes = np.empty(x.shape, dtype=np.int8)
+    scales = np.empty(len(x), dtype=np.float32)
+    for start in range(0, len(x), chunk_size):
+        rows = normalize_rows(x[start:start + chunk_size])
+        scale = np.abs(rows).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        codes[start:start + chunk_size] = np.rint(rows / scale[:, None])
+        scales[start:start + chunk_size] = scale
+    return codes, scales
+
+
+def dense_rows(matrix: np.ndarray, scales: Optional[np.ndarray], rows) -> np.ndarray:
+    """float32 rows of a plain or int8-quantized matrix (rows: slice or index array)."""
+    block = np.asarray(matrix[rows], dtype=np.float32)
+    if scales is not None:
+        block *= scales[rows][:, None]
+    return block
+
+
+def matrix_fingerprint(x: np.ndarray) -> str:
+    """Cheap content fingerprint: shape plus a strided sample of rows."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(x.shape).encode())
+    step = max(1, len(x) // 1000)
+    h.update(np.ascontiguousarray(x[::step], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def default_n_lists(n_vectors: int) -> int:
+    """About 4 * sqrt(n) lists, rounded to a power of two (2048 for 535K companies)."""
+    target = max(1, int(4 * np.sqrt(n_vectors)))
+    return int(min(n_vectors, 2 ** int(round(np.log2(target)))))
+
+
+def exact_top_k(queries: np.ndarray, database: np.ndarray, k: int,
+                chunk_size: int = 500) -> Tuple[np.ndarray, np.ndarray]:
+    """Brute-force top-k by inner product (rows sorted by descending score)."""
+    k = min(k, len(database))
+    all_scores = np.empty((len(queries), k), dtype=np.float32)
+    all_ids = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), chunk_size):
+        sims = queries[start:start + chunk_size] @ database.T
+        idx = np.argpartition(sims, -k, axis=1)[:, -k:]
+        scores = np.take_along_axis(sims, idx, axis=1)
+        order = np.argsort(-scores, axis=1)
+        all_ids[start:start + chunk_size] = np.take_along_axis(idx, order, axis=1)
+        all_scores[start:start + chunk_size] = np.take_along_axis(scores, order, axis=1)
+    return all_scores, all_ids
+
+
+def _scan_block(queries, database, threshold, block_bytes, query_rows=None, database_rows=None,
+                query_scales=None, database_scales=None):
+    """Above-threshold pairs of queries[query_rows] x database[database_rows], one block at a time."""
+    n_queries = len(queries) if query_rows is None else len(query_rows)
+    n_database = len(database) if database_rows is None else len(database_rows)
+    # Quantized databases are converted to float32 a chunk at a time
+    db_chunk = n_database if database_scales is None else min(n_database, THRESHOLD_DB_CHUNK)
+    block = max(1, block_bytes // (4 * max(1, db_chunk)))
+    hits = []
+    for q_start in range(0, n_queries, block):
+        q_sel = slice(q_start, q_start + block) if query_rows is None else query_rows[q_start:q_start + block]
+        q_block = dense_rows(queries, query_scales, q_sel)
+        for d_start in range(0, n_database, max(1, db_chunk)):
+            d_sel = slice(d_start, d_start + db_chunk) if database_rows is None \
+                else database_rows[d_start:d_start + db_chunk]
+            sims = q_block @ dense_rows(database, database_scales, d_sel).T
+            q, d = np.nonzero(sims >= threshold)
+            scores = sims[q, d].astype(np.float16)
+            q = (q + q_start) if query_rows is None else q_sel[q]
+            d = (d + d_start) if database_rows is None else d_sel[d]
+            hits.append((q.astype(np.int32), d.astype(np.int32), scores))
+    return hits
+
+
+def threshold_pairs(queries: np.ndarray, database: np.ndarray, threshold: float,
+                    query_keys=None, database_keys=None,
+                    block_bytes: int = THRESHOLD_BLOCK_BYTES,
+                    query_scales: Optional[np.ndarray] = None,
+                    database_scales: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Every (query, database) pair with inner product >= threshold.
+
+    Streams query blocks sized so no block of scores exceeds block_bytes and
+    keeps only the hits, as int32 indices and float16 scores, instead of the
+    full len(queries) x len(database) matrix. With query_keys/database_keys
+    (one blocking key per row), only pairs sharing a key are scored. With
+    query_scales/database_scales the matrices are int8 codes from
+    quantize_int8 and are converted to float32 block by block.
+
+    Returns (query_idx, database_idx, scores) ordered by query, then database
+    row, the same order as np.nonzero on the full matrix.
+    """
+    scales = dict(query_scales=query_scales, database_scales=database_scales)
+    if query_keys is None or database_keys is None:
+        hits = _scan_block(queries, database, threshold, block_bytes, **scales)
+    else:
+        keys, codes = np.unique(np.concatenate([np.asarray(query_keys, dtype=object),
+                                                np.asarray(database_keys, dtype=object)]).astype(str),
+                                return_inverse=True)
+        q_codes, d_codes = codes[:len(queries)], codes[len(queries):]
+        q_order = np.argsort(q_codes, kind='stable')
+        d_order = np.argsort(d_codes, kind='stable')
+        q_bounds = np.searchsorted(q_codes[q_order], np.arange(len(keys) + 1))
+        d_bounds = np.searchsorted(d_codes[d_order], np.arange(len(keys) + 1))
+        hits = []
+        for key in np.flatnonzero((np.diff(q_bounds) > 0) & (np.diff(d_bounds) > 0)):
+            hits += _scan_block(queries, database, threshold, block_bytes,
+                                query_rows=q_order[q_bounds[key]:q_bounds[key + 1]],
+                                database_rows=d_order[d_bounds[key]:d_bounds[key + 1]], **scales)
+
+    if not hits:
+        return np.zeros(0, np.int32), np.zeros(0, np.int32), np.zeros(0, np.float16)
+    query_idx = np.concatenate([h[0] for h in hits])
+    database_idx = np.concatenate([h[1] for h in hits])
+    scores = np.concatenate([h[2] for h in hits])
+    if len(hits) > 1:
+        order = np.lexsort((database_idx, query_idx))
+        query_idx, database_idx, scores = query_idx[order], database_idx[order], scores[order]
+    return query_idx, database_idx, scores
+
+
+def pair_scores(queries: np.ndarray, database: np.ndarray, query_idx: np.ndarray,
+                database_idx: np.ndarray, normalize: bool = False,
+                chunk_size: int = 100_000) -> np.ndarray:
+    """
+    Exact float32 inner product of each (query_idx[i], database_idx[i]) pair.
+
+    Only the rows of each chunk are converted to float32, so the matrices
+    can stay float16 (or memory-mapped). normalize=True gives cosine
+    similarity for rows that are not unit-normalized.
+    """
+    scores = np.empty(len(query_idx), dtype=np.float32)
+    for start in range(0, len(query_idx), chunk_size):
+        q = np.asarray(queries[query_idx[start:start + chunk_size]], dtype=np.float32)
+        d = np.asarray(database[database_idx[start:start + chunk_size]], dtype=np.float32)
+        if normalize:
+            q, d = normalize_rows(q), normalize_rows(d)
+        scores[start:start + chunk_size] = np.einsum('ij,ij->i', q, d)
+    return scores
+
+
+def rerank_top_k(queries: np.ndarray, database: np.ndarray, ids: np.ndarray,
+                 k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top-k among candidate ids (m x K', -1 = none) by float32 cosine.
+
+    queries are unit-normalized; database rows (e.g. float16 embeddings from
+    the store) are normalized as they are gathered.
+    """
+    q_idx, rank = np.nonzero(ids >= 0)
+    exact = np.full(ids.shape, -np.inf, dtype=np.float32)
+    exact[q_idx, rank] = pair_scores(queries, database, q_idx, ids[q_idx, rank], normalize=True)
+    order = np.argsort(-exact, axis=1, kind='stable')[:, :k]
+    scores = np.take_along_axis(exact, order, axis=1)
+    top_ids = np.take_along_axis(ids, order, axis=1)
+    top_ids[~np.isfinite(scores)] = -1
+    return scores, top_ids
+
+
+def spherical_kmeans(x: np.ndarray, n_lists: int, n_iter: int, seed: int) -> np.ndarray:
+    """Cosine k-means on unit vectors; returns unit-normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), n_lists, replace=False)].copy()
+    for it in range(n_iter):
+        assign = assign_lists(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=n_lists)
+        empty = counts == 0
+        # Re-seed empty clusters from random points so every list is used
+        if empty.any():
+            sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def assign_lists(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Nearest centroid (by inner product) for each row."""
+    assign = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), ASSIGN_CHUNK):
+        chunk = np.asarray(x[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        assign[start:start + ASSIGN_CHUNK] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+class IVFIndex:
+    """IVF index over unit-normalized embeddings; see module docstring."""
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, list_ids: np.ndarray,
+                 vectors: np.ndarray, fingerprint: str, scales: Optional[np.ndarray] = None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.list_ids = list_ids
+        self.vectors = vectors
+        self.fingerprint = fingerprint
+        # Per-row scales when vectors are int8 codes (quantize_int8)
+        self.scales = scales
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    @property
+    def quantized(self) -> bool:
+        return self.scales is not None
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_lists: Optional[int] = None,
+              n_iter: int = KMEANS_ITERATIONS, sample: int = KMEANS_SAMPLE, seed: int = 0,
+              quantize: bool = False) -> 'IVFIndex':
+        """
+        Train centroids on a sample, then assign every vector to a list.
+
+        quantize=True stores the list vectors as int8 codes with per-row
+        scales (a quarter of the float32 size); pair with search(rerank=...).
+        """
+        # Quantized builds never hold a normalized float32 copy of the matrix;
+        # the nearest centroid does not depend on a row's norm
+        x = embeddings if quantize else normalize_rows(embeddings)
+        n_lists = n_lists or default_n_lists(len(x))
+
+        rng = np.random.default_rng(seed)
+        train = x if len(x) <= sample else x[rng.choice(len(x), sample, replace=False)]
+        centroids = spherical_kmeans(normalize_rows(train), n_lists, n_iter, seed)
+
+        assign = assign_lists(x, centroids)
+        list_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=offsets[1:])
+
+        fingerprint = matrix_fingerprint(embeddings)
+        if quantize:
+            codes, scales = quantize_int8(x[list_ids])
+            return cls(centroids, offsets, list_ids, codes, fingerprint, scales=scales)
+        return cls(centroids, offsets, list_ids, x[list_ids], fingerprint)
+
+    @staticmethod
+    def paths(embeddings_path: Path) -> Tuple[Path, Path]:
+        embeddings_path = Path(embeddings_path)
+        stem = embeddings_path.with_suffix('')
+        return stem.with_name(stem.name + '.ivf.npz'), stem.with_name(stem.name + '.ivf_vectors.npy')
+
+    def save(self, embeddings_path: Path):
+        """Write the index next to the embedding cache file (via rename)."""
+        meta_path, vectors_path = self.paths(embeddings_path)
+        meta = dict(centroids=self.centroids, offsets=self.offsets,
+                    list_ids=self.list_ids, fingerprint=self.fingerprint)
+        if self.quantized:
+            meta['scales'] = self.scales
+        for path, write in (
+            (vectors_path, lambda f: np.save(f, np.asarray(self.vectors))),
+            (meta_path, lambda f: np.savez(f, **meta)),
+        ):
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, embeddings_path: Path) -> Optional['IVFIndex']:
+        """Load a saved index, or None if it does not exist."""
+        meta_path, vectors_path = cls.paths(embeddings_path)
+        if not meta_path.exists() or not vectors_path.exists():
+            return None
+        meta = np.load(meta_path)
+        return cls(meta['centroids'], meta['offsets'], meta['list_ids'],
+                   np.load(vectors_path, mmap_mode='r'), str(meta['fingerprint']),
+                   scales=meta['scales'] if 'scales' in meta.files else None)
+
+    def search(self, queries: np.ndarray, k: int, nprobe: int = DEFAULT_NPROBE,
+               rerank: Optional[np.ndarray] = None,
+               oversample: int = RERANK_OVERSAMPLE) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Approximate top-k by cosine similarity for a batch of queries.
+
+        Args:
+            queries: (m, dim) unit-normalized query vectors
+            k: neighbors per query
+            nprobe: lists scanned per query (higher = better recall, slower)
+            rerank: source embedding matrix (any float dtype, e.g. float16
+                from the store). The k * oversample best candidates are
+                re-scored exactly against it and the k best kept, so
+                returned scores are float32 cosines even for an int8 index.
+            oversample: candidate multiplier when re-ranking
+
+        Returns:
+            (scores, ids), each (m, k), sorted by descending score; ids are
+            rows of the source matrix. Queries whose probed lists hold fewer
+            than k vectors are padded with score -inf and id -1.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if rerank is not None:
+            _, ids = self.search(queries, k * oversample, nprobe=nprobe)
+            return rerank_top_k(queries, rerank, ids, k)
+        m = len(queries)
+        nprobe = min(nprobe, self.n_lists)
+
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(coarse, -nprobe, axis=1)[:, -nprobe:]
+
+        # Group queries by list so each list is read and converted once per batch
+        probe_q = np.repeat(np.arange(m), nprobe)
+        probe_l = probes.ravel()
+        order = np.argsort(probe_l, kind='stable')
+        probe_q, probe_l = probe_q[order], probe_l[order]
+        bounds = np.flatnonzero(np.diff(probe_l)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(probe_l)]))
+
+        q_parts, id_parts, score_parts = [], [], []
+        for s, e in zip(starts, ends):
+            lst = probe_l[s]
+            lo, hi = self.offsets[lst], self.offsets[lst + 1]
+            if hi == lo:
+                continue
+            q = probe_q[s:e]
+            sims = dense_rows(self.vectors, self.scales, slice(lo, hi)) @ queries[q].T
+            q_parts.append(np.repeat(q, hi - lo))
+            id_parts.append(np.tile(np.arange(lo, hi), len(q)))
+            score_parts.append(sims.T.ravel())
+
+        scores_out = np.full((m, k), -np.inf, dtype=np.float32)
+        ids_out = np.full((m, k), -1, dtype=np.int64)
+        if not q_parts:
+            return scores_out, ids_out
+
+        cand_q = np.concatenate(q_parts)
+        cand_pos = np.concatenate(id_parts)
+        cand_score = np.concatenate(score_parts)
+
+        # Rank candidates within each query and keep the first k
+        order = np.lexsort((-cand_score, cand_q))
+        cand_q, cand_pos, cand_score = cand_q[order], cand_pos[order], cand_score[order]
+        first = np.searchsorted(cand_q, np.arange(m))
+        rank = np.arange(len(cand_q)) - first[cand_q]
+        keep = rank < k
+        scores_out[cand_q[keep], rank[keep]] = cand_score[keep]
+        ids_out[cand_q[keep], rank[keep]] = self.list_ids[cand_pos[keep]]
+        return scores_out, ids_out
+
+
+def load_or_build_index(embeddings_path: Path, embeddings: np.ndarray,
+                        n_lists: Optional[int] = None, quantize: bool = False) -> IVFIndex:
+    """Reuse the saved index if it was built from these embeddings, else build and save it."""
+    fingerprint = matrix_fingerprint(embeddings)
+    index = IVFIndex.load(embeddings_path)
+    if index is not None and index.fingerprint == fingerprint and index.quantized == quantize:
+        print(f"    Loaded {'int8 ' if quantize else ''}IVF index ({index.n_lists:,} lists, {len(index):,} vectors)")
+        return index
+
+    print(f"    Building {'int8 ' if quantize else ''}IVF index over {len(embeddings):,} vectors...")
+    start = time.time()
+    index = IVFIndex.build(embeddings, n_lists=n_lists, quantize=quantize)
+    index.save(embeddings_path)
+    print(f"    Built {index.n_lists:,} lists in {time.time() - start:.0f}s, saved next to {Path(embeddings_path).name}")
+    return index
+
+
+def benchmark(index: IVFIndex, database: np.ndarray, queries: np.ndarray, k: int, nprobes) -> list:
+    """Recall@k against exact search and query throughput for each nprobe."""
+    start = time.time()
+    _, exact_ids = exact_top_k(queries, database, k)
+    exact_secs = time.time() - start
+    print(f"  exact: {len(queries) / exact_secs:,.0f} queries/s")
+
+    results = []
+    for nprobe in nprobes:
+        start = time.time()
+        _, ids = index.search(queries, k, nprobe=nprobe)
+        secs = time.time() - start
+        hits = sum(len(set(a) & set(b)) for a, b in zip(ids, exact_ids))
+        recall = hits / exact_ids.size
+        top1 = float(np.mean(ids[:, 0] == exact_ids[:, 0]))
+        results.append({'nprobe': nprobe, 'recall_at_k': recall, 'top1_agreement': top1,
+                        'queries_per_sec': len(queries) / secs, 'speedup': exact_secs / secs})
+        print(f"  nprobe={nprobe:4d}: recall@{k}={recall:.4f}, top-1 agreement={top1:.4f}, "
+              f"{len(queries) / secs:,.0f} queries/s ({exact_secs / secs:.1f}x exact)")
+    return results
+
+
+def benchmark_quantized(embeddings: np.ndarray, queries: np.ndarray, k: int, nprobe: int,
+                        threshold: float, margin: float, oversample: int = RERANK_OVERSAMPLE) -> list:
+    """
+    Memory, speed and recall of int8 retrieval against the float32 path.
+
+    Top-k (brand matcher): exact float32, float32 IVF, int8 IVF, and int8 IVF
+    re-ranked against the float16 embeddings. Threshold pairs (singleton
+    matcher): float32 scan at threshold vs int8 scan at threshold - margin
+    followed by exact re-scoring.
+    """
+    database = normalize_rows(embeddings)
+    stored = np.asarray(embeddings, dtype=np.float16)
+    codes, scales = quantize_int8(stored)
+    results = []
+
+    def report(method, nbytes, secs, ids=None, exact_ids=None):
+        row = {'method': method, 'memory_mb': nbytes / 1e6, 'queries_per_sec': len(queries) / secs}
+        if exact_ids is not None:
+            row['recall_at_k'] = sum(len(set(a) & set(b)) for a, b in zip(ids, exact_ids)) / exact_ids.size
+            row['top1_agreement'] = float(np.mean(ids[:, 0] == exact_ids[:, 0]))
+        results.append(row)
+        recall = f", recall={row['recall_at_k']:.4f}, top-1={row['top1_agreement']:.4f}" if exact_ids is not None else ""
+        print(f"  {method:<28} {row['memory_mb']:9,.1f} MB  {row['queries_per_sec']:9,.0f} queries/s{recall}")
+
+    print(f"Top-{k} retrieval (nprobe={nprobe}, oversample={oversample}):")
+    start = time.time()
+    _, exact_ids = exact_top_k(queries, database, k)
+    report('exact float32', database.nbytes, time.time() - start)
+
+    for label, quantize, rerank in (('IVF float32', False, None), ('IVF int8', True, None),
+                                    ('IVF int8 + float16 rerank', True, stored)):
+        index = IVFIndex.build(embeddings, quantize=quantize)
+        start = time.time()
+        _, ids = index.search(queries, k, nprobe=nprobe, rerank=rerank, oversample=oversample)
+        nbytes = np.asarray(index.vectors).nbytes + (index.scales.nbytes if index.quantized else 0)
+        if rerank is not None:
+            nbytes += stored.nbytes
+        report(label, nbytes, time.time() - start, ids, exact_ids)
+
+    print(f"Threshold pairs (>= {threshold}, int8 margin {margin}):")
+    start = time.time()
+    exact_q, exact_d, _ = threshold_pairs(queries, database, threshold)
+    float_secs = time.time() - start
+    start = time.time()
+    query_codes, query_scales = quantize_int8(queries)
+    q, d, _ = threshold_pairs(query_codes, codes, threshold - margin,
+                              query_scales=query_scales, database_scales=scales)
+    keep = pair_scores(queries, stored, q, d, normalize=True) >= threshold
+    int8_secs = time.time() - start
+    found = set(zip(q[keep].tolist(), d[keep].tolist()))
+    recall = len(found & set(zip(exact_q.tolist(), exact_d.tolist()))) / max(1, len(exact_q))
+    print(f"  float32: {len(exact_q):,} pairs in {float_secs:.2f}s ({database.nbytes / 1e6:,.1f} MB)")
+    print(f"  int8:    {len(found):,} pairs in {int8_secs:.2f}s "
+          f"({(codes.nbytes + scales.nbytes) / 1e6:,.1f} MB), recall={recall:.4f}")
+    results.append({'method': 'threshold int8', 'memory_mb': (codes.nbytes + scales.nbytes) / 1e6,
+                    'pair_recall': recall, 'speedup': float_secs / int8_secs})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or benchmark an IVF index over an embedding cache')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build_p = sub.add_parser('build', help='Build and save the index next to the embeddings')
+    build_p.add_argument('embeddings', type=Path, help='.npy embedding matrix')
+    build_p.add_argument('--n-lists', type=int, help='Number of IVF lists (default ~4*sqrt(n))')
+
+    bench_p = sub.add_parser('benchmark', help='Recall vs exact search for several nprobe values')
+    bench_p.add_argument('embeddings', type=Path, help='.npy embedding matrix (database)')
+    bench_p.add_argument('--queries', type=Path, help='.npy query matrix (default: sample of the database)')
+    bench_p.add_argument('--sample', type=int, default=1000, help='Queries to evaluate')
+    bench_p.add_argument('--k', type=int, default=20)
+    bench_p.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128])
+
+    quant_p = sub.add_parser('benchmark-quantized', help='int8 retrieval vs the float32 path')
+    quant_p.add_argument('embeddings', type=Path, help='.npy embedding matrix (database)')
+    quant_p.add_argument('--queries', type=Path, help='.npy query matrix (default: sample of the database)')
+    quant_p.add_argument('--sample', type=int, default=1000, help='Queries to evaluate')
+    quant_p.add_argument('--k', type=int, default=20)
+    quant_p.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE)
+    quant_p.add_argument('--oversample', type=int, default=RERANK_OVERSAMPLE)
+    quant_p.add_argument('--threshold', type=float, default=0.80, help='Similarity threshold for pair recall')
+    quant_p.add_argument('--margin', type=float, default=QUANT_MARGIN,
+                         help='int8 retrieval threshold is lowered by this much')
+    args = parser.parse_args()
+
+    embeddings = np.load(args.embeddings)
+    print(f"Loaded {embeddings.shape[0]:,} x {embeddings.shape[1]} embeddings from {args.embeddings.name}")
+
+    if args.command == 'build':
+        start = time.time()
+        index = IVFIndex.build(embeddings, n_lists=args.n_lists)
+        index.save(args.embeddings)
+        print(f"Built {index.n_lists:,} lists in {time.time() - start:.0f}s")
+        return 0
+
+    rng = np.random.default_rng(0)
+    queries = np.load(args.queries) if args.queries else embeddings
+    queries = normalize_rows(queries[rng.choice(len(queries), min(args.sample, len(queries)), replace=False)])
+    print(f"Benchmarking {len(queries):,} queries, k={args.k}")
+
+    if args.command == 'benchmark-quantized':
+        benchmark_quantized(embeddings, queries, args.k, args.nprobe, args.threshold, args.margin,
+                            oversample=args.oversample)
+        return 0
+
+    database = normalize_rows(embeddings)
+    index = load_or_build_index(args.embeddings, embeddings)
+    benchmark(index, database, queries, args.k, args.nprobe)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
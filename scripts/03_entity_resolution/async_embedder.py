@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Concurrent embedding fetcher for the OpenAI embeddings API.
+
+Replaces one-request-at-a-time loops (a 2,000-name request, sleep 0.1s,
+linear retries) with asyncio:
+  - batches are packed by an estimated token budget as well as a name count,
+    so long names do not overflow the per-request token limit
+  - up to max_in_flight requests run at once
+  - an optional tokens-per-minute budget is shared by all requests
+  - 429s and transient errors back off exponentially (with jitter, honoring
+    Retry-After); a 429 pauses every worker, not just the one that hit it
+  - on_batch(texts, embeddings) runs as each batch completes, so callers can
+    checkpoint results (embedding_store.EmbeddingStore, EmbeddingCache)
+
+Works against any OpenAI-compatible endpoint. For offline runs and
+benchmarks, start fake_embedding_server.py and point the client at it:
+
+    python3 fake_embedding_server.py --port 8765 &
+    export OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake
+
+Usage:
+    from async_embedder import fetch_embeddings
+
+    embeddings = fetch_embeddings(names, "text-embedding-3-large",
+                                  max_in_flight=8, on_batch=checkpoint)
+"""
+
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Callable, List, Optional
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+MAX_BATCH_ITEMS = 2000
+# API limit is 300k tokens per request; stay under it when estimates are rough
+MAX_BATCH_TOKENS = 250_000
+MAX_IN_FLIGHT = int(os.environ.get('EMBED_MAX_IN_FLIGHT', 8))
+MAX_RETRIES = 8
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+
+_ENCODER = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count with tiktoken when installed, else a conservative byte estimate."""
+    global _ENCODER
+    if tiktoken is not None:
+        if _ENCODER is None:
+            _ENCODER = tiktoken.get_encoding("cl100k_base")
+        return len(_ENCODER.encode(text, disallowed_special=()))
+    return len(text.encode('utf-8')) // 3 + 1
+
+
+def make_batches(texts: List[str], max_items: int = MAX_BATCH_ITEMS,
+                 max_tokens: int = MAX_BATCH_TOKENS) -> List[tuple]:
+    """Split texts into (start, end, tokens) ranges within both limits."""
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        n = estimate_tokens(text)
+        if i > start and (i - start >= max_items or tokens + n > max_tokens):
+            batches.append((start, i, tokens))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(texts):
+        batches.append((start, len(texts), tokens))
+    return batches
+
+
+class TokenBudget:
+    """Sliding one-minute token budget shared by concurrent requests."""
+
+    def __init__(self, tokens_per_minute: Optional[int]):
+        self.limit = tokens_per_minute
+        self.spent = deque()
+        self.total = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        if not self.limit:
+            return
+        tokens = min(tokens, self.limit)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.spent and now - self.spent[0][0] >= 60:
+                    self.total -= self.spent.popleft()[1]
+                if self.total + tokens <= self.limit:
+                    self.spent.append((now, tokens))
+                    self.total += tokens
+                    return
+                await asyncio.sleep(60 - (now - self.spent[0][0]))
+
+
+def retry_after_seconds(error) -> Optional[float]:
+    """Retry-After from an API error response, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('retry-after') if hasattr(headers, 'get') else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_retryable(error) -> bool:
+    """Rate limits, timeouts, connection errors and 5xx responses."""
+    import openai
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class AsyncEmbedder:
+    """Runs batched embedding requests with bounded concurrency and backoff."""
+
+    def __init__(self, model: str, client=None, max_in_flight: int = MAX_IN_FLIGHT,
+                 tokens_per_minute: Optional[int] = None, max_retries: int = MAX_RETRIES):
+        from openai import AsyncOpenAI
+
+        # Retries are handled here so a 429 can pause every worker
+        self.client = client or AsyncOpenAI(max_retries=0)
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0}
+
+    async def _request(self, texts: List[str], tokens: int) -> np.ndarray:
+        import openai
+
+        for attempt in range(self.max_retries + 1):
+            # Wait out any pause set by another worker's 429
+            delay = self.resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.budget.acquire(tokens)
+            try:
+                self.stats['requests'] += 1
+                response = await self.client.embeddings.create(input=texts, model=self.model)
+                data = sorted(response.data, key=lambda item: item.index)
+                return np.array([item.embedding for item in data], dtype=np.float32)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                self.stats['retries'] += 1
+                wait_time = min(BACKOFF_MAX, BACKOFF_BASE ** attempt) * (0.5 + random.random())
+                wait_time = max(wait_time, retry_after_seconds(e) or 0.0)
+                if isinstance(e, openai.RateLimitError):
+                    self.stats['rate_limited'] += 1
+                    self.resume_at = max(self.resume_at, time.monotonic() + wait_time)
+                print(f"      {type(e).__name__} on a {len(texts)}-name batch, "
+                      f"retry {attempt + 1}/{self.max_retries} in {wait_time:.1f}s")
+                await asyncio.sleep(wait_time)
+
+    async def embed(self, texts: List[str], on_batch: Optional[Callable] = None) -> np.ndarray:
+        """Embeddings for texts in input order; on_batch runs as batches complete."""
+        self.resume_at = 0.0
+        self.budget = TokenBudget(self.tokens_per_minute)
+        batches = make_batches(texts)
+        results = [None] * len(batches)
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        done = 0
+
+        async def run(i, start, end, tokens):
+            nonlocal done
+            async with semaphore:
+                embeddings = await self._request(texts[start:end], tokens)
+            results[i] = embeddings
+            done += 1
+            if done % 10 == 0 or done == len(batches):
+                print(f"      Embedded {done}/{len(batches)} batches")
+            if on_batch is not None:
+                on_batch(texts[start:end], embeddings)
+
+        tasks = [asyncio.ensure_future(run(i, *batch)) for i, batch in enumerate(batches)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Batches that completed were already checkpointed; drop the rest
+            for task in tasks:
+                task.cancel()
+
+        if not results:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(results)
+
+
+def fetch_embeddings(texts: List[str], model: str, on_batch: Optional[Callable] = None,
+                     max_in_flight: int = MAX_IN_FLIGHT, tokens_per_minute: Optional[int] = None,
+                     api_key: Optional[str] = None, base_url: Optional[str] = None) -> np.ndarray:
+    """Synchronous entry point: embed texts concurrently and return them in order."""
+    async def main():
+        from openai import AsyncOpenAI
+
+        async with AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0) as client:
+            embedder = AsyncEmbedder(model, client=client, max_in_flight=max_in_flight,
+                                     tokens_per_minute=tokens_per_minute)
+            start = time.time()
+            embeddings = await embedder.embed(texts, on_batch=on_batch)
+            secs = time.time() - start
+            print(f"      {len(texts):,} names in {secs:.1f}s ({embedder.stats['requests']} requests, "
+                  f"{embedder.stats['retries']} retries, {embedder.stats['rate_limited']} rate limited)")
+            return embeddings
+
+    return asyncio.run(main())
@@ -5,24 +5,47 @@ Efficient embedding cache manager.
 Stores name → embedding mappings in efficient binary format.
 Supports incremental updates and cross-methodology reuse.
 
-Cache structure:
-  - {msa}_embeddings.parquet: [name, embedding] where embedding is numpy array
-  - Uses float16 to halve storage (minimal quality loss for similarity)
+Cache structure (per MSA, float16 to halve storage with minimal quality loss):
+  - {msa}_names.npy / {msa}_embeddings.npy: compacted base cache
+  - {msa}_shard_NNNNN_names.npy / _embeddings.npy: append-only shards, one
+    per save, holding only names added since the previous save
+  - {msa}_embeddings.parquet: legacy [name, embedding] format, read once and
+    converted to the base files
+
+Loading memory-maps every embedding matrix and indexes the names with a
+pandas Index, so nothing is copied until rows are requested. Saving writes a
+new shard instead of rewriting the cache. Merge shards back into the base with
+`python3 embedding_cache.py compact [msa ...]`.
+
+New runs use the shared store in embedding_store.py; import these per-MSA
+caches into it with `python3 embedding_store.py import-msa-cache`.
 """
 
 import os
+import re
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 from pathlib import Path
-from typing import Dict, List, Optional
-import time
+from typing import List
 
 from openai import OpenAI
 
+from embedding_store import embed_texts
+
 CACHE_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology/outputs/singleton_matching/embedding_cache_v2")
 EMBEDDING_MODEL = "text-embedding-3-large"
 EMBEDDING_DIM = 3072
-BATCH_SIZE = 2000
+# Embedded batches per shard while a long embedding run is in progress
+CHECKPOINT_BATCHES = 10
+
+
+def save_npy_atomic(path: Path, array: np.ndarray):
+    """np.save through a temp file so readers never see a partial file."""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
 
 
 class EmbeddingCache:
@@ -30,37 +53,106 @@ class EmbeddingCache:
 
     def __init__(self, msa: str):
         self.msa = msa
+        self.names_file = CACHE_DIR / f"{msa}_names.npy"
+        self.emb_file = CACHE_DIR / f"{msa}_embeddings.npy"
         self.cache_file = CACHE_DIR / f"{msa}_embeddings.parquet"
-        self.cache: Dict[str, np.ndarray] = {}
         self._load_cache()
 
-    def _load_cache(self):
-        """Load existing cache from disk."""
-        if self.cache_file.exists():
-            df = pd.read_parquet(self.cache_file)
-            for _, row in df.iterrows():
-                self.cache[row['name']] = np.array(row['embedding'], dtype=np.float16)
-            print(f"  Loaded {len(self.cache):,} cached embeddings from {self.cache_file.name}")
-
-    def save_cache(self):
-        """Save cache to disk in efficient format."""
-        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    def __len__(self):
+        return len(self.index)
 
-        records = [
-            {'name': name, 'embedding': emb.tolist()}
-            for name, emb in self.cache.items()
-        ]
-        df = pd.DataFrame(records)
-        df.to_parquet(self.cache_file, index=False)
+    def shard_paths(self) -> list:
+        """(names, embeddings) file pairs of every committed shard, in order."""
+        pattern = re.compile(rf"^{re.escape(self.msa)}_shard_(\d+)_names\.npy$")
+        shards = []
+        for path in CACHE_DIR.glob(f"{self.msa}_shard_*_names.npy"):
+            match = pattern.match(path.name)
+            if match:
+                emb_path = path.with_name(path.name.replace('_names.npy', '_embeddings.npy'))
+                shards.append((int(match.group(1)), path, emb_path))
+        return [(names, emb) for _, names, emb in sorted(shards)]
 
-        # Also save as numpy for even faster loading
-        names = list(self.cache.keys())
-        embeddings = np.array([self.cache[n] for n in names], dtype=np.float16)
-
-        np.save(CACHE_DIR / f"{self.msa}_names.npy", np.array(names, dtype=object))
-        np.save(CACHE_DIR / f"{self.msa}_embeddings.npy", embeddings)
-
-        print(f"  Saved {len(self.cache):,} embeddings to cache")
+    def _load_cache(self):
+        """Memory-map the base cache and shards and index their names."""
+        if not self.names_file.exists() and self.cache_file.exists():
+            self._convert_parquet()
+
+        self.segments = []
+        names = []
+        pairs = [(self.names_file, self.emb_file)] if self.names_file.exists() else []
+        for names_path, emb_path in pairs + self.shard_paths():
+            segment_names = np.load(names_path, allow_pickle=True)
+            self.segments.append(np.load(emb_path, mmap_mode='r'))
+            names.append(segment_names)
+
+        self.offsets = np.cumsum([0] + [len(n) for n in names])
+        all_names = pd.Index(np.concatenate(names) if names else np.array([], dtype=object))
+
+        # index position → row of the concatenated segments; keeps the first
+        # copy of any name saved twice
+        keep = ~all_names.duplicated()
+        self.index = all_names[keep]
+        self.rows = np.flatnonzero(keep)
+        if len(self.index):
+            print(f"  Loaded {len(self.index):,} cached embeddings from {len(self.segments)} files")
+
+    def _convert_parquet(self):
+        """Turn the legacy parquet cache into the base .npy files."""
+        table = pq.read_table(self.cache_file)
+        names = np.array(table.column('name').to_pylist(), dtype=object)
+        values = table.column('embedding').combine_chunks().flatten().to_numpy()
+        embeddings = values.astype(np.float16).reshape(len(names), -1)
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        save_npy_atomic(self.emb_file, embeddings)
+        save_npy_atomic(self.names_file, names)
+        print(f"  Converted {len(names):,} embeddings from {self.cache_file.name}")
+
+    def gather(self, rows: np.ndarray) -> np.ndarray:
+        """Rows of the concatenated cache, read segment by segment."""
+        dim = self.segments[0].shape[1] if self.segments else EMBEDDING_DIM
+        out = np.empty((len(rows), dim), dtype=np.float32)
+        segment_of = np.searchsorted(self.offsets, rows, side='right') - 1
+        for seg in np.unique(segment_of):
+            mask = segment_of == seg
+            local = rows[mask] - self.offsets[seg]
+            order = np.argsort(local)
+            block = np.empty((len(local), dim), dtype=np.float32)
+            block[order] = self.segments[seg][local[order]]
+            out[mask] = block
+        return out
+
+    def save_cache(self, names: List[str], embeddings: np.ndarray):
+        """Append names and their embeddings as a new shard."""
+        if len(names) == 0:
+            return
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        shards = self.shard_paths()
+        next_id = int(re.search(r'_shard_(\d+)_', shards[-1][0].name).group(1)) + 1 if shards else 0
+        names_path = CACHE_DIR / f"{self.msa}_shard_{next_id:05d}_names.npy"
+        emb_path = CACHE_DIR / f"{self.msa}_shard_{next_id:05d}_embeddings.npy"
+
+        # The names file commits the shard, so it is written last
+        save_npy_atomic(emb_path, np.asarray(embeddings, dtype=np.float16))
+        save_npy_atomic(names_path, np.array(names, dtype=object))
+
+        self.segments.append(np.load(emb_path, mmap_mode='r'))
+        self.rows = np.concatenate([self.rows, self.offsets[-1] + np.arange(len(names))])
+        self.offsets = np.append(self.offsets, self.offsets[-1] + len(names))
+        self.index = self.index.append(pd.Index(np.array(names, dtype=object)))
+        print(f"  Saved {len(names):,} embeddings to shard {next_id} ({len(self.index):,} cached)")
+
+    def compact(self):
+        """Merge base cache and shards into new base files and remove the shards."""
+        shards = self.shard_paths()
+        if not shards:
+            return
+        save_npy_atomic(self.emb_file, self.gather(self.rows).astype(np.float16))
+        save_npy_atomic(self.names_file, np.asarray(self.index, dtype=object))
+        for names_path, emb_path in shards:
+            names_path.unlink()
+            emb_path.unlink()
+        print(f"  Compacted {len(shards)} shards into {len(self.index):,} embeddings")
+        self._load_cache()
 
     def get_embeddings(self, names: List[str], client: OpenAI) -> np.ndarray:
         """
@@ -68,59 +160,38 @@ class EmbeddingCache:
         Only calls API for names not in cache.
         """
         # Identify which names need embedding
-        names_to_embed = [n for n in names if n not in self.cache]
-        cached_count = len(names) - len(names_to_embed)
+        positions = self.index.get_indexer(names)
+        names_to_embed = list(dict.fromkeys(n for n, p in zip(names, positions) if p < 0))
+        cached_count = len(names) - int((positions < 0).sum())
 
         if cached_count > 0:
             print(f"    Found {cached_count:,} in cache, need to embed {len(names_to_embed):,}")
 
-        # Embed missing names
+        # Embed missing names, saving a shard every CHECKPOINT_BATCHES batches
         if names_to_embed:
-            new_embeddings = self._embed_names(names_to_embed, client)
-            for name, emb in zip(names_to_embed, new_embeddings):
-                self.cache[name] = emb.astype(np.float16)
-
-            # Save incrementally
-            self.save_cache()
+            self._embed_names(names_to_embed, client)
+            positions = self.index.get_indexer(names)
 
         # Return embeddings in original order
-        return np.array([self.cache[n] for n in names], dtype=np.float32)
-
-    def _embed_names(self, names: List[str], client: OpenAI) -> np.ndarray:
-        """Call OpenAI API to embed names with progress saving."""
-        all_embeddings = []
-        total_batches = (len(names) + BATCH_SIZE - 1) // BATCH_SIZE
+        return self.gather(self.rows[positions])
 
-        for i in range(0, len(names), BATCH_SIZE):
-            batch = names[i:i + BATCH_SIZE]
-            batch_num = i // BATCH_SIZE + 1
+    def _embed_names(self, names: List[str], client: OpenAI):
+        """Call OpenAI API to embed names, saving progress as shards."""
+        pending = []
 
-            if batch_num % 5 == 0 or batch_num == total_batches:
-                print(f"      Batch {batch_num}/{total_batches}...")
+        def checkpoint(batch, embeddings):
+            pending.append((batch, embeddings))
+            if len(pending) >= CHECKPOINT_BATCHES:
+                flush()
 
-            success = False
-            for attempt in range(3):
-                try:
-                    response = client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
-                    embeddings = [item.embedding for item in response.data]
-                    all_embeddings.extend(embeddings)
-                    success = True
-                    time.sleep(0.1)
-                    break
-                except Exception as e:
-                    print(f"      Attempt {attempt+1} failed: {e}")
-                    time.sleep(5 * (attempt + 1))
+        def flush():
+            if pending:
+                self.save_cache([n for b, _ in pending for n in b],
+                                np.concatenate([e for _, e in pending]))
+                pending.clear()
 
-            if not success:
-                raise RuntimeError(f"Failed to embed batch {batch_num} after 3 attempts")
-
-            # Save progress every 10 batches
-            if batch_num % 10 == 0:
-                for name, emb in zip(names[i:i+len(batch)], embeddings):
-                    self.cache[name] = np.array(emb, dtype=np.float16)
-                self.save_cache()
-
-        return np.array(all_embeddings)
+        embed_texts(client, names, EMBEDDING_MODEL, on_batch=checkpoint)
+        flush()
 
 
 def convert_old_cache_to_new(msa: str):
@@ -221,8 +292,19 @@ def convert_old_cache_to_new(msa: str):
     print(f"  Embedding array size: {emb_size_mb:.1f} MB")
 
 
+def compact_caches(msas: List[str]):
+    """Compact the given MSAs' caches (all MSAs with shards if none given)."""
+    if not msas:
+        msas = sorted({p.name.split('_shard_')[0] for p in CACHE_DIR.glob("*_shard_*_names.npy")})
+    for msa in msas:
+        print(f"{msa}:")
+        EmbeddingCache(msa).compact()
+
+
 if __name__ == '__main__':
     import sys
     if len(sys.argv) > 1 and sys.argv[1] == 'convert':
         msa = sys.argv[2] if len(sys.argv) > 2 else 'columbus_oh'
         convert_old_cache_to_new(msa)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'compact':
+        compact_caches(sys.argv[2:])
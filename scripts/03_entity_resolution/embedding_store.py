@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Content-addressed embedding store shared by the entity-resolution scripts.
+
+One store per embedding model, keyed by a 64-bit hash of the sanitized name,
+so a name embedded for any MSA or script is never embedded (or loaded) twice.
+Replaces the per-script caches: JSON lists (12_singleton_phase1_features.py),
+positional .npy files that only work when the name order matches
+(20_tiered_entity_resolution.py) and the per-MSA name → vector caches
+(embedding_cache.py, 16_singleton_national.py).
+
+Layout (STORE_DIR/{model}/):
+  vectors.f16   append-only float16 matrix (rows x dim), memory-mapped on read
+  keys.u64      append-only uint64 name hash of each row; rows are committed
+                once their key is written, so a crash mid-append leaves only
+                an ignored tail
+  store.lock    flock taken while appending, so concurrent SLURM tasks can
+                share one store
+
+Lookups hash the requested names and binary-search a sorted copy of the keys;
+only the rows asked for are read from disk.
+
+Usage:
+    from embedding_store import EmbeddingStore
+
+    store = EmbeddingStore("text-embedding-3-large")
+    embeddings = store.get_embeddings(names, client)   # embeds only new names
+
+    python3 embedding_store.py stats
+    python3 embedding_store.py import-msa-cache [msa ...]
+    python3 embedding_store.py import-array --model text-embedding-3-small \\
+        --names paw_companies_for_matching.parquet --column company_name \\
+        --embeddings embedding_cache/company_embeddings.npy
+"""
+
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from async_embedder import fetch_embeddings
+
+PROJECT_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology")
+STORE_DIR = PROJECT_DIR / "outputs" / "embedding_store"
+MSA_CACHE_DIR = PROJECT_DIR / "outputs" / "singleton_matching" / "embedding_cache_v2"
+
+MODEL_DIMS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+}
+# Embedded batches held in memory before they are appended to the store
+CHECKPOINT_BATCHES = 10
+
+
+def sanitize_name(name: str) -> str:
+    """Clean name for embedding API."""
+    if name is None or not isinstance(name, str):
+        return ""
+    name = name.strip()[:8000]
+    name = ''.join(c if c.isprintable() or c in ' \t' else ' ' for c in name)
+    return ' '.join(name.split())
+
+
+def name_keys(names: List[str]) -> np.ndarray:
+    """64-bit blake2b hash of each (already sanitized) name."""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(n.encode('utf-8'), digest_size=8).digest(), 'little') for n in names),
+        dtype=np.uint64, count=len(names)
+    )
+
+
+def embed_texts(client, texts: List[str], model: str, on_batch=None) -> np.ndarray:
+    """
+    Embed texts with the concurrent fetcher (async_embedder.py), using the
+    client's API key and endpoint.
+
+    on_batch(texts, embeddings) is called as each batch completes, so callers
+    can checkpoint progress.
+    """
+    return fetch_embeddings(texts, model, on_batch=on_batch,
+                            api_key=client.api_key, base_url=str(client.base_url))
+
+
+class EmbeddingStore:
+    """Append-only, memory-mapped name → embedding store for one model."""
+
+    def __init__(self, model: str, root: Path = STORE_DIR, dim: Optional[int] = None):
+        self.model = model
+        self.dim = dim or MODEL_DIMS[model]
+        self.dir = Path(root) / model
+        self.vectors_file = self.dir / "vectors.f16"
+        self.keys_file = self.dir / "keys.u64"
+        self.lock_file = self.dir / "store.lock"
+        self.refresh()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float16).itemsize
+
+    def refresh(self):
+        """(Re)read the committed rows, including ones appended by other processes."""
+        keys = np.fromfile(self.keys_file, dtype='<u8') if self.keys_file.exists() else np.zeros(0, dtype='<u8')
+        n_vectors = self.vectors_file.stat().st_size // self.row_bytes if self.vectors_file.exists() else 0
+        n = min(len(keys), n_vectors)
+
+        self._keys = keys[:n]
+        self._order = np.argsort(self._keys, kind='stable')
+        self._sorted_keys = self._keys[self._order]
+        if n:
+            self._vectors = np.memmap(self.vectors_file, dtype=np.float16, mode='r', shape=(n, self.dim))
+        else:
+            self._vectors = np.zeros((0, self.dim), dtype=np.float16)
+
+    def _rows_for_keys(self, keys: np.ndarray) -> np.ndarray:
+        if len(self._sorted_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_keys, keys)
+        pos = np.minimum(pos, len(self._sorted_keys) - 1)
+        found = self._sorted_keys[pos] == keys
+        return np.where(found, self._order[pos], -1).astype(np.int64)
+
+    def rows(self, names: List[str]) -> np.ndarray:
+        """Row of each name in the store, -1 where missing."""
+        return self._rows_for_keys(name_keys([sanitize_name(n) for n in names]))
+
+    def missing(self, names: List[str]) -> List[str]:
+        """Distinct sanitized names not yet in the store, in first-seen order."""
+        clean = list(dict.fromkeys(sanitize_name(n) for n in names))
+        rows = self._rows_for_keys(name_keys(clean))
+        return [n for n, r in zip(clean, rows) if r < 0]
+
+    def get(self, names: List[str], dtype=np.float32) -> np.ndarray:
+        """Embeddings for names, in order. Raises KeyError if any is missing."""
+        rows = self.rows(names)
+        if (rows < 0).any():
+            raise KeyError(f"{int((rows < 0).sum()):,} names are not in the {self.model} store")
+        # Read rows in file order, then put them back in request order
+        order = np.argsort(rows, kind='stable')
+        out = np.empty((len(rows), self.dim), dtype=dtype)
+        out[order] = self._vectors[rows[order]]
+        return out
+
+    def add(self, names: List[str], embeddings: np.ndarray) -> int:
+        """Append embeddings for names not already stored; returns rows added."""
+        clean = [sanitize_name(n) for n in names]
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim or len(embeddings) != len(clean):
+            raise ValueError(f"Expected {len(clean)} x {self.dim} embeddings, got {embeddings.shape}")
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                keys = name_keys(clean)
+                new = self._rows_for_keys(keys) < 0
+                _, first = np.unique(keys, return_index=True)
+                unique = np.zeros(len(keys), dtype=bool)
+                unique[first] = True
+                keep = np.flatnonzero(new & unique)
+                if len(keep) == 0:
+                    return 0
+
+                n = len(self._keys)
+                # Drop any uncommitted tail left by an interrupted append
+                with open(self.vectors_file, 'ab') as f:
+                    f.truncate(n * self.row_bytes)
+                    f.write(np.ascontiguousarray(embeddings[keep], dtype=np.float16).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                with open(self.keys_file, 'ab') as f:
+                    f.truncate(n * 8)
+                    f.write(keys[keep].astype('<u8').tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.refresh()
+        return len(keep)
+
+    def get_embeddings(self, names: List[str], client, dtype=np.float32) -> np.ndarray:
+        """Embeddings for names, embedding (and storing) only those not yet stored."""
+        to_embed = self.missing(names)
+        cached_count = len(set(sanitize_name(n) for n in names)) - len(to_embed)
+        print(f"    {self.model} store: {cached_count:,} cached, need to embed {len(to_embed):,}")
+
+        if to_embed:
+            pending = []
+
+            def checkpoint(batch, embeddings):
+                pending.append((batch, embeddings))
+                if len(pending) >= CHECKPOINT_BATCHES:
+                    flush()
+
+            def flush():
+                if pending:
+                    self.add([n for b, _ in pending for n in b], np.concatenate([e for _, e in pending]))
+                    pending.clear()
+
+            embed_texts(client, to_embed, self.model, on_batch=checkpoint)
+            flush()
+            print(f"    Stored {len(to_embed):,} new embeddings ({len(self):,} total)")
+
+        return self.get(names, dtype=dtype)
+
+
+def import_embeddings(store: EmbeddingStore, names: List[str], embeddings: np.ndarray,
+                      chunk_size: int = 100_000) -> int:
+    """Add a positional (names, embeddings) pair to the store in chunks."""
+    added = 0
+    for i in range(0, len(names), chunk_size):
+        added += store.add(names[i:i + chunk_size], np.asarray(embeddings[i:i + chunk_size]))
+    return added
+
+
+def import_msa_caches(msas: List[str], chunk_size: int = 100_000) -> int:
+    """Import the per-MSA caches in embedding_cache_v2 (base files and shards)."""
+    from embedding_cache import EmbeddingCache
+
+    store = EmbeddingStore("text-embedding-3-large")
+    if not msas:
+        msas = sorted(p.name[:-len("_names.npy")] for p in MSA_CACHE_DIR.glob("*_names.npy")
+                      if '_shard_' not in p.name)
+
+    total = 0
+    for msa in msas:
+        cache = EmbeddingCache(msa)
+        if len(cache) == 0:
+            print(f"  {msa}: no cache, skipping")
+            continue
+        names = cache.index.tolist()
+        added = 0
+        for i in range(0, len(names), chunk_size):
+            added += store.add(names[i:i + chunk_size], cache.gather(cache.rows[i:i + chunk_size]))
+        total += added
+        print(f"  {msa}: {len(names):,} cached, {added:,} new to the store")
+    return total
+
+
+def load_names(path: Path, column: Optional[str]) -> List[str]:
+    """Names in cache order from a parquet column, .npy array or text file."""
+    if path.suffix == '.parquet':
+        import pandas as pd
+        return pd.read_parquet(path, columns=[column])[column].tolist()
+    if path.suffix == '.npy':
+        return np.load(path, allow_pickle=True).tolist()
+    return path.read_text().splitlines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or populate the shared embedding store')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('stats', help='Rows and size of each model store')
+
+    msa_p = sub.add_parser('import-msa-cache', help='Import per-MSA caches from embedding_cache_v2')
+    msa_p.add_argument('msas', nargs='*', help='MSAs to import (default: all)')
+
+    array_p = sub.add_parser('import-array', help='Import a positional embedding cache')
+    array_p.add_argument('--model', required=True, choices=list(MODEL_DIMS))
+    array_p.add_argument('--names', type=Path, required=True,
+                         help='Names in cache order (.parquet with --column, .npy, or one per line)')
+    array_p.add_argument('--column', help='Parquet column holding the names')
+    array_p.add_argument('--embeddings', type=Path, required=True, help='.npy or .json embedding list')
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        for model in MODEL_DIMS:
+            store = EmbeddingStore(model)
+            size_gb = store.vectors_file.stat().st_size / 1e9 if store.vectors_file.exists() else 0.0
+            print(f"{model}: {len(store):,} embeddings ({size_gb:.2f} GB)")
+        return 0
+
+    if args.command == 'import-msa-cache':
+        added = import_msa_caches(args.msas)
+        print(f"Added {added:,} embeddings")
+        return 0
+
+    names = load_names(args.names, args.column)
+    if args.embeddings.suffix == '.json':
+        with open(args.embeddings) as f:
+            embeddings = np.array(json.load(f), dtype=np.float32)
+    else:
+        embeddings = np.load(args.embeddings, mmap_mode='r')
+    if len(names) != len(embeddings):
+        print(f"Name count ({len(names):,}) does not match embeddings ({len(embeddings):,})")
+        return 1
+
+    added = import_embeddings(EmbeddingStore(args.model), names, embeddings)
+    print(f"Added {added:,} of {len(names):,} embeddings to the {args.model} store")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
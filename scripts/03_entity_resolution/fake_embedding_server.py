@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Deterministic local stand-in for the OpenAI embeddings endpoint.
+
+Serves POST /v1/embeddings with vectors derived from each text's character
+trigrams, so the same name always gets the same vector and similar names get
+similar vectors (cosine similarity tracks trigram overlap). This lets the
+entity-resolution scripts run end to end offline, in tests and benchmarks,
+without API cost.
+
+Optional latency and periodic 429s exercise the client's concurrency and
+backoff (async_embedder.py).
+
+Usage:
+    python3 fake_embedding_server.py --port 8765 [--latency 0.2] [--rate-limit-every 50]
+    export OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake
+    python3 16_singleton_national.py columbus_oh
+"""
+
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+MODEL_DIMS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+}
+DEFAULT_DIM = 1536
+MAX_INPUTS = 2048
+
+
+@lru_cache(maxsize=200_000)
+def trigram_vector(trigram: str, dim: int) -> np.ndarray:
+    """Fixed pseudo-random direction for one trigram."""
+    seed = int.from_bytes(hashlib.blake2b(trigram.encode('utf-8'), digest_size=8).digest(), 'little')
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def fake_embedding(text: str, dim: int) -> np.ndarray:
+    """Unit vector: sum of the text's trigram directions."""
+    padded = f"  {text.lower()} "
+    vector = np.zeros(dim, dtype=np.float32)
+    for i in range(len(padded) - 2):
+        vector += trigram_vector(padded[i:i + 3], dim)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    rate_limit_every = 0
+    request_count = 0
+    count_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/embeddings'):
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        with EmbeddingHandler.count_lock:
+            EmbeddingHandler.request_count += 1
+            count = EmbeddingHandler.request_count
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_every and count % self.rate_limit_every == 0:
+            self.send_json(429, {'error': {'message': 'Rate limit reached (fake)', 'type': 'rate_limit_error'}},
+                           headers={'Retry-After': '1'})
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        texts = request.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts or len(texts) > MAX_INPUTS or any(not isinstance(t, str) or not t for t in texts):
+            self.send_json(400, {'error': {'message': f'input must be 1-{MAX_INPUTS} non-empty strings'}})
+            return
+
+        model = request.get('model', '')
+        dim = request.get('dimensions') or MODEL_DIMS.get(model, DEFAULT_DIM)
+        as_base64 = request.get('encoding_format') == 'base64'
+
+        data = []
+        for i, text in enumerate(texts):
+            vector = fake_embedding(text, dim)
+            embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode() if as_base64 else vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+
+        tokens = sum(len(t.split()) for t in texts)
+        self.send_json(200, {'object': 'list', 'data': data, 'model': model,
+                             'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake OpenAI embeddings server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='Answer every Nth request with a 429 (0 = never)')
+    args = parser.parse_args()
+
+    EmbeddingHandler.latency = args.latency
+    EmbeddingHandler.rate_limit_every = args.rate_limit_every
+    server = ThreadingHTTPServer((args.host, args.port), EmbeddingHandler)
+    print(f"Fake embedding server on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
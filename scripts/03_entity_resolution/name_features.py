@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Batched string-similarity features for candidate name pairs.
+
+Computes the feature matrix of the singleton logit model
+(columbus_oh_logit_model_v2.pkl, trained by fix_labels_v2_and_train.py):
+
+    cos_sim, jaro_winkler, jaro_winkler_norm, token_jaccard, contains_match
+
+Instead of scoring pair by pair with DataFrame.apply, each unique name is
+normalized, lowercased and tokenized once, duplicate pairs are scored once,
+Jaro-Winkler runs over all pairs in rapidfuzz's multithreaded cpdist, and
+token Jaccard is counted with numpy over token ids.
+
+Feature definitions match training exactly:
+  - jaro_winkler:      Jaro-Winkler on the raw names
+  - jaro_winkler_norm: Jaro-Winkler on normalize_name(), 0.0 if either is empty
+  - token_jaccard:     Jaccard of lowercase whitespace tokens, 0.0 if either is empty
+  - contains_match:    1.0 if either lowercase name contains the other
+
+Usage:
+    from name_features import FEATURES, score_pairs
+
+    features = score_pairs(poi_names, company_names, cos_sim)
+    probs = model.predict_proba(features[FEATURES].values)[:, 1]
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+from rapidfuzz.distance import JaroWinkler
+
+try:
+    from rapidfuzz.process import cpdist
+except ImportError:  # rapidfuzz < 3.6
+    cpdist = None
+
+FEATURES = ['cos_sim', 'jaro_winkler', 'jaro_winkler_norm', 'token_jaccard', 'contains_match']
+
+# Pairs per token-Jaccard block; bounds the temporary key arrays
+JACCARD_CHUNK = 1_000_000
+
+SUFFIX_PATTERNS = [
+    r'\s+inc\.?$', r'\s+llc\.?$', r'\s+corp\.?$', r'\s+co\.?$',
+    r'\s+ltd\.?$', r'\s+llp\.?$', r'\s+pllc\.?$', r'\s+pc\.?$',
+    r'\s+incorporated$', r'\s+corporation$', r'\s+company$',
+    r'\s+limited$', r'\s+the$', r'^the\s+',
+]
+TITLE_PATTERNS = [
+    (r'd\s*\.?\s*d\s*\.?\s*s\.?', 'dds'),  # D.D.S., D D S, DDS
+    (r'm\s*\.?\s*d\.?', 'md'),              # M.D., MD
+    (r'o\s*\.?\s*d\.?', 'od'),              # O.D., OD (optometrist)
+    (r'd\s*\.?\s*o\.?', 'do'),              # D.O., DO
+    (r'ph\s*\.?\s*d\.?', 'phd'),            # Ph.D., PhD
+]
+_SUFFIX_RES = [re.compile(p, flags=re.IGNORECASE) for p in SUFFIX_PATTERNS]
+_TITLE_RES = [(re.compile(p, flags=re.IGNORECASE), r) for p, r in TITLE_PATTERNS]
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize company name by removing punctuation, suffixes, and titles.
+
+    Same definition as fix_labels_v2_and_train.py, so serving features match
+    the ones the model was fit on.
+    """
+    if not name:
+        return ""
+
+    s = name.lower()
+    for suffix in _SUFFIX_RES:
+        s = suffix.sub('', s)
+    for pattern, replacement in _TITLE_RES:
+        s = pattern.sub(replacement, s)
+    s = _PUNCT_RE.sub(' ', s)
+    return ' '.join(s.split())
+
+
+def blocking_keys(names, method: str) -> list:
+    """
+    Blocking key per name for candidate pruning.
+
+    first_token: first token of normalize_name(name)
+    metaphone:   Metaphone code of that token (jellyfish), so spelling
+                 variants like "Jon's" / "John" share a block
+    """
+    first_tokens = [(normalize_name(n).split() or [''])[0] for n in names]
+    if method == 'first_token':
+        return first_tokens
+    if method == 'metaphone':
+        import jellyfish
+        codes = {t: jellyfish.metaphone(t) for t in set(first_tokens)}
+        return [codes[t] for t in first_tokens]
+    raise ValueError(f"Unknown blocking method: {method}")
+
+
+def jaro_winkler_pairs(a: list, b: list) -> np.ndarray:
+    """
+    Jaro-Winkler similarity of a[i] vs b[i] for every i.
+
+    Two empty strings score 0.0, as in jellyfish (rapidfuzz alone gives 1.0).
+    """
+    if not a:
+        return np.zeros(0, dtype=np.float64)
+    if cpdist is not None:
+        scores = cpdist(a, b, scorer=JaroWinkler.similarity, dtype=np.float64, workers=-1)
+    else:
+        scores = np.fromiter((JaroWinkler.similarity(x, y) for x, y in zip(a, b)),
+                             dtype=np.float64, count=len(a))
+    empty = np.fromiter((not x or not y for x, y in zip(a, b)), dtype=bool, count=len(a))
+    scores[empty] = 0.0
+    return scores
+
+
+def token_table(names: list):
+    """
+    CSR table of each name's distinct lowercase tokens as integer ids.
+
+    Returns (indptr, token_ids, vocabulary_size).
+    """
+    vocab = {}
+    lengths = np.zeros(len(names), dtype=np.int64)
+    token_ids = []
+    for i, name in enumerate(names):
+        tokens = {vocab.setdefault(t, len(vocab)) for t in name.lower().split()}
+        lengths[i] = len(tokens)
+        token_ids.extend(tokens)
+    indptr = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return indptr, np.asarray(token_ids, dtype=np.int64), max(len(vocab), 1)
+
+
+def _gather_rows(indptr: np.ndarray, values: np.ndarray, rows: np.ndarray):
+    """Concatenate CSR rows; returns (position in rows, value) for each element."""
+    lengths = indptr[rows + 1] - indptr[rows]
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    out_start = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(indptr[rows] - out_start, lengths)
+    return owner, values[positions]
+
+
+def token_jaccard_pairs(indptr: np.ndarray, token_ids: np.ndarray, n_tokens: int,
+                        left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Token Jaccard for name pairs (left[i], right[i]) of a token_table.
+
+    Each name's tokens are distinct, so a (pair, token) key appearing twice
+    across both sides is one shared token.
+    """
+    sizes = np.diff(indptr)
+    jaccard = np.zeros(len(left), dtype=np.float64)
+
+    for start in range(0, len(left), JACCARD_CHUNK):
+        l = left[start:start + JACCARD_CHUNK]
+        r = right[start:start + JACCARD_CHUNK]
+        owner_l, tok_l = _gather_rows(indptr, token_ids, l)
+        owner_r, tok_r = _gather_rows(indptr, token_ids, r)
+        keys = np.concatenate([owner_l * n_tokens + tok_l, owner_r * n_tokens + tok_r])
+        keys.sort()
+        shared = keys[1:][keys[1:] == keys[:-1]] // n_tokens
+        intersection = np.bincount(shared, minlength=len(l))
+
+        size_l, size_r = sizes[l], sizes[r]
+        union = size_l + size_r - intersection
+        valid = (size_l > 0) & (size_r > 0)
+        jaccard[start:start + len(l)][valid] = intersection[valid] / union[valid]
+
+    return jaccard
+
+
+def score_pairs(left_names, right_names, cos_sim=None,
+                normalize=normalize_name, lowercase_jw: bool = False) -> pd.DataFrame:
+    """
+    Score aligned name pairs (left_names[i], right_names[i]).
+
+    Args:
+        left_names, right_names: equal-length sequences of names
+        cos_sim: optional embedding similarities, copied into the output
+        normalize: name normalizer for jaro_winkler_norm
+        lowercase_jw: lowercase names before raw jaro_winkler (Tier 3 scoring
+            in 20_tiered_entity_resolution.py; the logit model uses raw case)
+
+    Returns:
+        DataFrame with one row per pair and the FEATURES columns
+        (cos_sim only when given).
+    """
+    n_pairs = len(left_names)
+    codes, uniques = pd.factorize(
+        np.concatenate([np.asarray(left_names, dtype=object), np.asarray(right_names, dtype=object)])
+    )
+    uniques = list(uniques)
+    left, right = codes[:n_pairs], codes[n_pairs:]
+
+    # Score each distinct pair once
+    _, first, inverse = np.unique(left.astype(np.int64) * len(uniques) + right,
+                                  return_index=True, return_inverse=True)
+    left, right = left[first], right[first]
+
+    lowered = [name.lower() for name in uniques]
+    normalized_unique = [normalize(name) for name in uniques]
+    jw_names = lowered if lowercase_jw else uniques
+
+    jw = jaro_winkler_pairs([jw_names[i] for i in left], [jw_names[i] for i in right])
+    jw_norm = jaro_winkler_pairs([normalized_unique[i] for i in left],
+                                 [normalized_unique[i] for i in right])
+    indptr, token_ids, n_tokens = token_table(uniques)
+    jaccard = token_jaccard_pairs(indptr, token_ids, n_tokens, left, right)
+    contains = np.fromiter(
+        (lowered[a] in lowered[b] or lowered[b] in lowered[a] for a, b in zip(left, right)),
+        dtype=np.float64, count=len(left)
+    )
+
+    features = pd.DataFrame({
+        'jaro_winkler': jw[inverse],
+        'jaro_winkler_norm': jw_norm[inverse],
+        'token_jaccard': jaccard[inverse],
+        'contains_match': contains[inverse],
+    })
+    if cos_sim is not None:
+        features.insert(0, 'cos_sim', np.asarray(cos_sim))
+    return features
@@ -9,6 +9,7 @@ This script:
 4. Generates validation visualizations
 """
 
+import sys
 import pandas as pd
 import numpy as np
 from pathlib import Path
@@ -20,10 +21,13 @@ from scipy import stats
 import warnings
 warnings.filterwarnings('ignore')
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / '02_partisan_lean'))
+from panel_query import connect, register_panel
+
 SCRATCH = Path('/global/scratch/users/maxkagan/measuring_stakeholder_ideology')
 HOME = Path('/global/home/users/maxkagan/measuring_stakeholder_ideology')
 
-PARTISAN_LEAN_DIR = SCRATCH / 'outputs' / 'national_with_normalized'
+PARTISAN_LEAN_DIR = SCRATCH / 'outputs' / 'national_panel'
 SCHOENMUELLER_PATH = HOME / 'reference' / 'other_measures' / 'schoenmueller_et_al' / 'social-listening_PoliticalAffiliation_2022_Dec.csv'
 OUTPUT_DIR = SCRATCH / 'outputs' / 'validation'
 
@@ -46,42 +50,23 @@ def aggregate_brand_lean() -> pd.DataFrame:
     """
     print("=== Aggregating POI-level data to brand level ===")
 
-    parquet_files = sorted(PARTISAN_LEAN_DIR.glob('partisan_lean_*.parquet'))
-    print(f"Found {len(parquet_files)} monthly files")
-
-    brand_agg = []
-
-    for i, pf in enumerate(parquet_files):
-        print(f"Processing {pf.name} ({i+1}/{len(parquet_files)})")
-
-        df = pd.read_parquet(pf, columns=[
-            'brand', 'rep_lean_2020', 'rep_lean_2016',
-            'normalized_visits_by_state_scaling', 'year_month'
-        ])
-
-        df = df[df['brand'].notna() & (df['brand'] != '')]
-        df = df[df['normalized_visits_by_state_scaling'].notna() & (df['normalized_visits_by_state_scaling'] > 0)]
-
-        df['weighted_lean_2020'] = df['rep_lean_2020'] * df['normalized_visits_by_state_scaling']
-        df['weighted_lean_2016'] = df['rep_lean_2016'] * df['normalized_visits_by_state_scaling']
-
-        monthly_agg = df.groupby('brand').agg({
-            'weighted_lean_2020': 'sum',
-            'weighted_lean_2016': 'sum',
-            'normalized_visits_by_state_scaling': 'sum',
-            'year_month': 'first'
-        }).reset_index()
-
-        brand_agg.append(monthly_agg)
-
-    print("Combining all months...")
-    all_months = pd.concat(brand_agg, ignore_index=True)
-
-    overall_agg = all_months.groupby('brand').agg({
-        'weighted_lean_2020': 'sum',
-        'weighted_lean_2016': 'sum',
-        'normalized_visits_by_state_scaling': 'sum'
-    }).reset_index()
+    con = connect()
+    n_files = register_panel(con, PARTISAN_LEAN_DIR)
+    print(f"Found {n_files} monthly files")
+
+    # One multithreaded scan over all months; only brand totals reach pandas
+    overall_agg = con.execute("""
+        SELECT brand,
+               COALESCE(SUM(rep_lean_2020 * normalized_visits_by_state_scaling), 0) AS weighted_lean_2020,
+               COALESCE(SUM(rep_lean_2016 * normalized_visits_by_state_scaling), 0) AS weighted_lean_2016,
+               SUM(normalized_visits_by_state_scaling) AS normalized_visits_by_state_scaling
+        FROM panel
+        WHERE brand IS NOT NULL AND brand != ''
+          AND normalized_visits_by_state_scaling > 0
+        GROUP BY brand
+        ORDER BY brand
+    """).df()
+    con.close()
 
     overall_agg['brand_rep_lean_2020'] = overall_agg['weighted_lean_2020'] / overall_agg['normalized_visits_by_state_scaling']
     overall_agg['brand_rep_lean_2016'] = overall_agg['weighted_lean_2016'] / overall_agg['normalized_visits_by_state_scaling']
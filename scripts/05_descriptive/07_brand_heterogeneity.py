@@ -8,6 +8,8 @@ This script computes variance decomposition for brand × geography analysis:
 3. Variance decomposition with ICC (intraclass correlation)
 
 Uses full panel (2019-2025) to compute time-averaged partisan lean per location.
+The per-location averages are computed by DuckDB over the partitioned panel
+(panel_query.py), so memory is bounded by the result, not the panel.
 
 Outputs:
 - brand_heterogeneity_summary.parquet: Brand-level metrics (n_locations, n_msas, between/within variance, ICC)
@@ -15,11 +17,14 @@ Outputs:
 - variance_decomposition_report.csv: Summary statistics
 """
 
+import sys
 import logging
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import glob
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "02_partisan_lean"))
+from panel_query import connect, register_panel
 
 logging.basicConfig(
     level=logging.INFO,
@@ -35,40 +40,26 @@ MIN_MSAS_PER_BRAND = 3
 MIN_LOCATIONS_PER_MSA = 2
 
 
-def load_national_data():
-    """Load all monthly parquet files into single DataFrame."""
-    logger.info("Loading national data...")
-
-    parquet_files = sorted(glob.glob(str(INPUT_DIR / "*.parquet")))
-    logger.info(f"Found {len(parquet_files)} monthly files")
-
-    if not parquet_files:
-        logger.error(f"No parquet files found in {INPUT_DIR}")
-        return None
-
-    all_data = []
-    for file_path in parquet_files:
-        df = pd.read_parquet(file_path)
-        all_data.append(df)
-
-    combined = pd.concat(all_data, ignore_index=True)
-    logger.info(f"Loaded {len(combined):,} POI-month observations")
+def compute_location_averages(con):
+    """
+    Compute time-averaged partisan lean per location.
 
-    return combined
-
-
-def compute_location_averages(df):
-    """Compute time-averaged partisan lean per location."""
+    Aggregated by DuckDB directly over the panel, so only the per-location
+    result (not the 596M POI-month rows) is loaded into memory. Rows with a
+    missing grouping key are dropped, as pandas groupby did.
+    """
     logger.info("Computing time-averaged partisan lean per location...")
 
-    location_avg = df.groupby(['placekey', 'brand', 'cbsa_title', 'region']).agg({
-        'rep_lean_2020': 'mean',
-        'rep_lean_2016': 'mean',
-        'date_range_start': 'count'
-    }).reset_index()
-
-    location_avg.columns = ['placekey', 'brand', 'cbsa_title', 'region',
-                            'mean_rep_lean_2020', 'mean_rep_lean_2016', 'n_months']
+    location_avg = con.execute("""
+        SELECT placekey, brand, cbsa_title, region,
+               AVG(rep_lean_2020) AS mean_rep_lean_2020,
+               AVG(rep_lean_2016) AS mean_rep_lean_2016,
+               COUNT(date_range_start) AS n_months
+        FROM panel
+        WHERE placekey IS NOT NULL AND brand IS NOT NULL
+          AND cbsa_title IS NOT NULL AND region IS NOT NULL
+        GROUP BY placekey, brand, cbsa_title, region
+    """).df()
 
     logger.info(f"Computed averages for {len(location_avg):,} unique locations")
 
@@ -259,11 +250,16 @@ def main():
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-    df = load_national_data()
-    if df is None:
+    con = connect()
+    try:
+        n_files = register_panel(con, INPUT_DIR)
+    except FileNotFoundError as e:
+        logger.error(str(e))
         return 1
+    logger.info(f"Found {n_files} monthly files")
 
-    location_avg = compute_location_averages(df)
+    location_avg = compute_location_averages(con)
+    con.close()
 
     brand_msa = compute_brand_msa_summary(location_avg)
 
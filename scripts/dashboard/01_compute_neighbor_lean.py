@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Compute each POI's excess partisan lean relative to its local neighbors.
+
+For every POI in poi_with_coords.parquet (all ~9M), finds its k nearest
+neighbors within a radius using a KD-tree over unit-sphere coordinates, and
+adds three columns:
+  neighbor_lean_2020   visit-weighted mean mean_rep_lean_2020 of the neighbors
+                       (unweighted if none of them have visitors)
+  excess_lean_2020     mean_rep_lean_2020 - neighbor_lean_2020
+  n_neighbors          neighbors used (0 -> both columns are NaN)
+
+With --same-naics, neighbors are restricted to POIs with the same 2-digit
+NAICS code (one tree per code); POIs without a NAICS code get no baseline.
+
+The columns are written back into poi_with_coords.parquet and, matched on
+placekey, poi_sampled.parquet. Run this before 02_build_poi_store.py and
+03_build_map_tiles.py so the store and tiles carry them.
+
+Usage:
+    python3 01_compute_neighbor_lean.py
+    python3 01_compute_neighbor_lean.py --k 20 --radius-km 2 --same-naics
+"""
+
+import os
+import argparse
+from time import time
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy.spatial import cKDTree
+
+DATA_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology/dashboard_data")
+POI_FILE = DATA_DIR / "poi_with_coords.parquet"
+SAMPLED_FILE = DATA_DIR / "poi_sampled.parquet"
+
+K_NEIGHBORS = 20
+RADIUS_KM = 1.0
+EARTH_RADIUS_KM = 6371.0
+# Queries per tree.query call; bounds the (chunk, k) neighbor arrays
+QUERY_CHUNK = 500_000
+NEIGHBOR_COLUMNS = ['neighbor_lean_2020', 'excess_lean_2020', 'n_neighbors']
+
+
+def unit_sphere(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """3D unit vectors, so Euclidean (chord) distance is monotone in great-circle distance."""
+    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+    cos_lat = np.cos(lat_rad)
+    return np.column_stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)])
+
+
+def chord_length(radius_km: float) -> float:
+    """Chord length on the unit sphere for a great-circle distance."""
+    return 2.0 * np.sin(radius_km / EARTH_RADIUS_KM / 2.0)
+
+
+def neighbor_lean(points: np.ndarray, lean: np.ndarray, weights: np.ndarray,
+                  k: int, radius_km: float, workers: int) -> tuple:
+    """
+    Visit-weighted lean of each point's k nearest neighbors within radius_km.
+
+    lean may be NaN (such neighbors are skipped); weights are visitor counts.
+    The point itself is excluded, but other POIs at the same coordinates count.
+
+    Returns:
+        (baseline, n_neighbors) arrays aligned with points
+    """
+    n = len(points)
+    baseline = np.full(n, np.nan)
+    n_neighbors = np.zeros(n, dtype=np.int16)
+    if n < 2:
+        return baseline, n_neighbors
+
+    tree = cKDTree(points)
+    has_lean = ~np.isnan(lean)
+    # Index n is what query() returns for missing neighbors
+    lean_pad = np.append(np.where(has_lean, lean, 0.0), 0.0)
+    weight_pad = np.append(np.where(has_lean, weights, 0.0), 0.0)
+    leaned_pad = np.append(has_lean, False)
+    max_dist = chord_length(radius_km)
+
+    for start in range(0, n, QUERY_CHUNK):
+        stop = min(start + QUERY_CHUNK, n)
+        # k + 1 so the point itself can be dropped
+        _, idx = tree.query(points[start:stop], k=min(k + 1, n),
+                            distance_upper_bound=max_dist, workers=workers)
+        idx = idx.reshape(stop - start, -1)
+        own = np.arange(start, stop)[:, None]
+        usable = (idx < n) & (idx != own)
+        # If the point was crowded out by co-located POIs, keep only the first k
+        usable &= np.cumsum(usable, axis=1) <= k
+        usable &= leaned_pad[idx]
+
+        w = np.where(usable, weight_pad[idx], 0.0)
+        l = np.where(usable, lean_pad[idx], 0.0)
+        count = usable.sum(axis=1)
+        weight_sum = w.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weighted = (w * l).sum(axis=1) / weight_sum
+            unweighted = l.sum(axis=1) / count
+        baseline[start:stop] = np.where(weight_sum > 0, weighted, unweighted)
+        n_neighbors[start:stop] = count
+
+    return baseline, n_neighbors
+
+
+def compute_neighbor_columns(pois: pd.DataFrame, k: int, radius_km: float,
+                             same_naics: bool, workers: int) -> pd.DataFrame:
+    """neighbor_lean_2020, excess_lean_2020 and n_neighbors for every POI."""
+    points = unit_sphere(pois['latitude'].to_numpy(dtype=np.float64),
+                         pois['longitude'].to_numpy(dtype=np.float64))
+    lean = pois['mean_rep_lean_2020'].to_numpy(dtype=np.float64)
+    weights = np.nan_to_num(pois['total_visitors'].to_numpy(dtype=np.float64), nan=0.0)
+    located = ~np.isnan(points).any(axis=1)
+
+    if same_naics:
+        naics = pois['naics_2'].astype('string').fillna('').to_numpy()
+        groups = [(code, np.flatnonzero(located & (naics == code)))
+                  for code in np.unique(naics[located]) if code != '']
+    else:
+        groups = [('all', np.flatnonzero(located))]
+
+    baseline = np.full(len(pois), np.nan)
+    n_neighbors = np.zeros(len(pois), dtype=np.int16)
+    for code, rows in groups:
+        group_start = time()
+        baseline[rows], n_neighbors[rows] = neighbor_lean(points[rows], lean[rows], weights[rows],
+                                                          k, radius_km, workers)
+        print(f"  {code}: {len(rows):,} POIs, {np.isfinite(baseline[rows]).mean():.1%} with a baseline "
+              f"({time() - group_start:.0f}s)", flush=True)
+
+    return pd.DataFrame({
+        'neighbor_lean_2020': baseline,
+        'excess_lean_2020': lean - baseline,
+        'n_neighbors': n_neighbors,
+    }, index=pois.index)
+
+
+def write_columns(path: Path, df: pd.DataFrame):
+    """Replace the file atomically so the dashboard never reads a partial write."""
+    tmp_file = path.with_name(path.name + '.tmp')
+    df.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, path)
+
+
+def main(k: int = K_NEIGHBORS, radius_km: float = RADIUS_KM, same_naics: bool = False, workers: int = -1):
+    print("=" * 60)
+    print("Computing neighbor baseline and excess partisan lean")
+    print("=" * 60)
+    scope = "same 2-digit NAICS" if same_naics else "any category"
+    print(f"Neighbors: {k} nearest within {radius_km} km, {scope}")
+
+    start = time()
+    pois = pd.read_parquet(POI_FILE)
+    pois = pois.drop(columns=[c for c in NEIGHBOR_COLUMNS if c in pois.columns])
+    print(f"Loaded {len(pois):,} POIs from {POI_FILE.name}")
+
+    neighbors = compute_neighbor_columns(pois, k, radius_km, same_naics, workers)
+    pois = pd.concat([pois, neighbors], axis=1)
+
+    has_baseline = pois['n_neighbors'] > 0
+    print(f"\nPOIs with a neighbor baseline: {has_baseline.sum():,} ({100 * has_baseline.mean():.1f}%)")
+    print(f"Median neighbors used: {pois.loc[has_baseline, 'n_neighbors'].median():.0f}")
+    print(f"Excess lean: mean {pois['excess_lean_2020'].mean():+.4f}, sd {pois['excess_lean_2020'].std():.4f}")
+
+    write_columns(POI_FILE, pois)
+    print(f"Updated {POI_FILE}")
+
+    if SAMPLED_FILE.exists():
+        sampled = pd.read_parquet(SAMPLED_FILE)
+        sampled = sampled.drop(columns=[c for c in NEIGHBOR_COLUMNS if c in sampled.columns])
+        sampled = sampled.merge(pois[['placekey'] + NEIGHBOR_COLUMNS], on='placekey', how='left')
+        write_columns(SAMPLED_FILE, sampled)
+        print(f"Updated {SAMPLED_FILE}")
+
+    print(f"\nDone in {time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Neighbor baseline and excess partisan lean per POI')
+    parser.add_argument('--k', type=int, default=K_NEIGHBORS, help='Nearest neighbors to average')
+    parser.add_argument('--radius-km', type=float, default=RADIUS_KM, help='Maximum neighbor distance')
+    parser.add_argument('--same-naics', action='store_true',
+                        help='Only compare against POIs with the same 2-digit NAICS code')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', -1)),
+                        help='Parallel query workers (default: all CPUs)')
+    args = parser.parse_args()
+
+    main(k=args.k, radius_km=args.radius_km, same_naics=args.same_naics, workers=args.workers)
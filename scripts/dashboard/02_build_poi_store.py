@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Build the spatially indexed POI store for the dashboard.
+
+Rewrites poi_with_coords.parquet (all ~9M POIs) so the dashboard can read
+only the rows a view needs instead of loading the whole frame (or the 500k
+sample) and filtering it with boolean masks on every interaction.
+
+Layout (DATA_DIR/poi_store/):
+  {region}.parquet   one file per state, rows sorted by Hilbert index of
+                     (longitude, latitude) and written in small row groups,
+                     so each row group covers a compact patch of the map
+  index.parquet      one row per row group: file, row_group, n_rows, region
+                     and its latitude/longitude bounding box
+  values.parquet     which top_category / naics_2 values occur in each row
+                     group (file, row_group, column, value, n_rows)
+
+Queries (utils/data_loader.query_poi_store) select row groups from the two
+index tables by state, viewport overlap and category/NAICS membership, then
+read just those row groups. Each row also gets a fixed random sample_key in
+[0, 1), so a sample of any query is `sample_key < fraction`, stable across
+reruns and filter changes.
+
+Usage:
+    python3 02_build_poi_store.py
+"""
+
+import os
+import shutil
+from pathlib import Path
+from time import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DATA_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology/dashboard_data")
+POI_FILE = DATA_DIR / "poi_with_coords.parquet"
+STORE_DIR = DATA_DIR / "poi_store"
+
+HILBERT_ORDER = 16          # 2^16 cells per axis: ~600m x 300m at the equator
+ROW_GROUP_SIZE = 16_384
+INDEXED_VALUE_COLUMNS = ['top_category', 'naics_2']
+UNKNOWN_REGION = "_unknown"
+
+
+def hilbert_index(x: np.ndarray, y: np.ndarray, order: int = HILBERT_ORDER) -> np.ndarray:
+    """Hilbert curve distance of integer cell coordinates (0 <= x, y < 2**order)."""
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    n = 1 << order
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry
+        swap_x = flip & rx
+        x = np.where(swap_x, n - 1 - x, x)
+        y = np.where(swap_x, n - 1 - y, y)
+        x, y = np.where(flip, y, x), np.where(flip, x, y)
+        s >>= 1
+    return d
+
+
+def spatial_keys(lat: np.ndarray, lon: np.ndarray, order: int = HILBERT_ORDER) -> np.ndarray:
+    """Hilbert index of each coordinate on a global lon/lat grid."""
+    cells = (1 << order) - 1
+    x = np.clip((lon + 180.0) / 360.0 * cells, 0, cells).astype(np.int64)
+    y = np.clip((lat + 90.0) / 180.0 * cells, 0, cells).astype(np.int64)
+    return hilbert_index(x, y, order)
+
+
+def write_region(region: str, df: pd.DataFrame, path: Path) -> tuple:
+    """Write one region's rows in spatial order; returns its row group stats."""
+    df = df.sort_values('hilbert').reset_index(drop=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path, row_group_size=ROW_GROUP_SIZE, compression='zstd')
+
+    groups, values = [], []
+    for rg, start in enumerate(range(0, len(df), ROW_GROUP_SIZE)):
+        part = df.iloc[start:start + ROW_GROUP_SIZE]
+        groups.append({
+            'file': path.name, 'row_group': rg, 'n_rows': len(part), 'region': region,
+            'lat_min': part['latitude'].min(), 'lat_max': part['latitude'].max(),
+            'lon_min': part['longitude'].min(), 'lon_max': part['longitude'].max(),
+        })
+        for column in INDEXED_VALUE_COLUMNS:
+            counts = part[column].dropna().value_counts()
+            values.extend({'file': path.name, 'row_group': rg, 'column': column,
+                           'value': str(value), 'n_rows': int(n)} for value, n in counts.items())
+    return groups, values
+
+
+def main():
+    print("=" * 60)
+    print("Building spatially indexed POI store")
+    print("=" * 60)
+
+    start = time()
+    df = pd.read_parquet(POI_FILE)
+    df = df[df['latitude'].notna() & df['longitude'].notna()].reset_index(drop=True)
+    print(f"Loaded {len(df):,} POIs with coordinates from {POI_FILE.name}")
+
+    df['hilbert'] = spatial_keys(df['latitude'].to_numpy(), df['longitude'].to_numpy())
+    df['sample_key'] = np.random.default_rng(42).random(len(df), dtype=np.float32)
+    df['region'] = df['region'].fillna(UNKNOWN_REGION).replace('', UNKNOWN_REGION)
+
+    # Build into a temporary directory and swap it in, so the running
+    # dashboard never sees a half-written store
+    tmp_dir = STORE_DIR.with_name(STORE_DIR.name + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    all_groups, all_values = [], []
+    for region, part in df.groupby('region', sort=True):
+        groups, values = write_region(region, part, tmp_dir / f"{region}.parquet")
+        all_groups.extend(groups)
+        all_values.extend(values)
+        print(f"  {region}: {len(part):,} POIs in {len(groups)} row groups")
+
+    pd.DataFrame(all_groups).to_parquet(tmp_dir / "index.parquet", index=False)
+    pd.DataFrame(all_values).to_parquet(tmp_dir / "values.parquet", index=False)
+
+    old_dir = STORE_DIR.with_name(STORE_DIR.name + '.old')
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if STORE_DIR.exists():
+        os.replace(STORE_DIR, old_dir)
+    os.replace(tmp_dir, STORE_DIR)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    size_mb = sum(f.stat().st_size for f in STORE_DIR.glob("*.parquet")) / (1024 * 1024)
+    print(f"\nWrote {len(all_groups):,} row groups ({size_mb:.1f} MB) to {STORE_DIR} in {time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
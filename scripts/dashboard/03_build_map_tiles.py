@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Build multi-resolution map tiles for the dashboard's national view.
+
+Aggregates all ~9M POIs in poi_with_coords.parquet into web-mercator quadkey
+tiles at several levels, so the neighbor map can draw every POI as a few
+thousand cells instead of shipping a random 100k-point sample to the browser.
+
+Each tile row holds, for one cell at one level:
+  n_pois, n_lean              POIs in the cell / POIs with a partisan lean
+  total_visitors              summed visitors
+  mean_rep_lean_2020          visit-weighted mean of the POIs' lean (unweighted
+                              if none of the leaned POIs have visitors)
+  excess_lean_2020            same for excess lean vs neighbors, when
+                              01_compute_neighbor_lean.py has been run
+
+Tiles are built for all POIs and separately per top_category and per naics_2
+(filter_column / filter_value), so the map's filters keep working in cell mode.
+
+Output (DATA_DIR/map_tiles.parquet) is sorted by filter, value and level and
+written in small row groups; utils/data_loader.load_map_tiles reads one level
+of one filter with a pyarrow filter, touching only those row groups.
+
+Usage:
+    python3 03_build_map_tiles.py
+"""
+
+import os
+from time import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from pathlib import Path
+
+DATA_DIR = Path("/global/scratch/users/maxkagan/measuring_stakeholder_ideology/dashboard_data")
+POI_FILE = DATA_DIR / "poi_with_coords.parquet"
+TILES_FILE = DATA_DIR / "map_tiles.parquet"
+
+# Level L splits the world into 2^L x 2^L tiles: level 4 is ~1,700 km across
+# at US latitudes, level 12 ~7 km. The map picks level = zoom + 5 (cells of
+# ~8 px), see utils/data_loader.tile_level_for_zoom.
+TILE_LEVELS = list(range(4, 13))
+FILTER_COLUMNS = ['top_category', 'naics_2']
+# Averaged per cell, weighted by visitors (if present in the POI file)
+LEAN_COLUMNS = ['mean_rep_lean_2020', 'excess_lean_2020']
+ALL_VALUE = "All"
+ROW_GROUP_SIZE = 65_536
+MAX_LATITUDE = 85.05112878
+
+
+def tile_coords(lat: np.ndarray, lon: np.ndarray, level: int) -> tuple:
+    """Web-mercator tile (x, y) of each coordinate at a level."""
+    n = 1 << level
+    lat_rad = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = np.floor((lon + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def tile_centers(x: np.ndarray, y: np.ndarray, level: int) -> tuple:
+    """Latitude and longitude of tile centers."""
+    n = 1 << level
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * (y + 0.5) / n))))
+    return lat, lon
+
+
+def quadkeys(x: np.ndarray, y: np.ndarray, level: int) -> np.ndarray:
+    """Bing-style quadkey strings ('0'-'3' per level, most significant first)."""
+    shifts = np.arange(level - 1, -1, -1)
+    digits = ((x[:, None] >> shifts) & 1) + 2 * ((y[:, None] >> shifts) & 1)
+    chars = (digits + ord('0')).astype(np.uint8)
+    return np.ascontiguousarray(chars).view(f'S{level}').ravel().astype(str)
+
+
+def aggregate_level(pois: pd.DataFrame, x: np.ndarray, y: np.ndarray, level: int,
+                    group_codes: np.ndarray = None) -> pd.DataFrame:
+    """
+    Sum the POIs of each (group, tile) cell at one level.
+
+    group_codes are integer filter-value codes per POI (-1 = missing), or None
+    for the unfiltered tiles.
+    """
+    key = (x << level) | y
+    if group_codes is not None:
+        keep = group_codes >= 0
+        key = (group_codes[keep].astype(np.int64) << (2 * level)) | key[keep]
+        pois = pois[keep]
+
+    sums = pois[[c for c in pois.columns if c.endswith(('_n', '_sum', '_weight', '_weighted'))]]
+    cells = sums.assign(key=key, n_pois=1, total_visitors=pois['visitors'].to_numpy())
+    cells = cells.groupby('key', sort=True).sum()
+
+    keys = cells.index.to_numpy()
+    tiles = keys & ((1 << (2 * level)) - 1)
+    tile_x, tile_y = tiles >> level, tiles & ((1 << level) - 1)
+    lat, lon = tile_centers(tile_x, tile_y, level)
+
+    means = {}
+    for column in LEAN_COLUMNS:
+        if f'{column}_n' not in cells.columns:
+            continue
+        weight = cells[f'{column}_weight'].to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weighted = cells[f'{column}_weighted'].to_numpy() / weight
+            unweighted = cells[f'{column}_sum'].to_numpy() / cells[f'{column}_n'].to_numpy()
+        means[column] = np.where(weight > 0, weighted, unweighted)
+
+    return pd.DataFrame({
+        'group_code': keys >> (2 * level) if group_codes is not None else 0,
+        'level': np.int8(level),
+        'quadkey': quadkeys(tile_x, tile_y, level),
+        'tile_x': tile_x.astype(np.int32),
+        'tile_y': tile_y.astype(np.int32),
+        'latitude': lat,
+        'longitude': lon,
+        'n_pois': cells['n_pois'].to_numpy().astype(np.int32),
+        'n_lean': cells['mean_rep_lean_2020_n'].to_numpy().astype(np.int32),
+        'total_visitors': cells['total_visitors'].to_numpy(),
+        **means,
+    })
+
+
+def build_tiles(pois: pd.DataFrame) -> pd.DataFrame:
+    """Tiles at every level for all POIs and for each filter value."""
+    lat = pois['latitude'].to_numpy()
+    lon = pois['longitude'].to_numpy()
+    # Coarser tiles are the finest tile shifted right, so project once
+    finest = max(TILE_LEVELS)
+    x_max, y_max = tile_coords(lat, lon, finest)
+
+    filters = [(ALL_VALUE, None, np.array([ALL_VALUE]))]
+    for column in FILTER_COLUMNS:
+        values = pois[column].astype('string').replace('', pd.NA)
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        filters.append((column, codes, np.asarray(uniques, dtype=object)))
+
+    parts = []
+    for column, codes, uniques in filters:
+        for level in TILE_LEVELS:
+            shift = finest - level
+            tiles = aggregate_level(pois, x_max >> shift, y_max >> shift, level, codes)
+            tiles.insert(0, 'filter_column', column)
+            tiles.insert(1, 'filter_value', uniques[tiles.pop('group_code').to_numpy()].astype(str))
+            parts.append(tiles)
+        n_rows = sum(len(p) for p in parts if p['filter_column'].iat[0] == column)
+        print(f"  {column}: {len(uniques):,} values, {n_rows:,} tiles")
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def main():
+    print("=" * 60)
+    print("Building multi-resolution map tiles")
+    print("=" * 60)
+
+    start = time()
+    available = pq.read_schema(POI_FILE).names
+    columns = ['latitude', 'longitude', 'total_visitors'] + FILTER_COLUMNS
+    columns += [c for c in LEAN_COLUMNS if c in available]
+    pois = pd.read_parquet(POI_FILE, columns=columns)
+    pois = pois[pois['latitude'].notna() & pois['longitude'].notna()].reset_index(drop=True)
+    print(f"Loaded {len(pois):,} POIs with coordinates from {POI_FILE.name}")
+
+    # Per-POI terms of the per-cell sums: count, sum, weight and weighted sum
+    visitors = np.nan_to_num(pois['total_visitors'].to_numpy(dtype=np.float64), nan=0.0)
+    pois['visitors'] = visitors
+    for column in LEAN_COLUMNS:
+        if column not in pois.columns:
+            continue
+        lean = pois[column].to_numpy(dtype=np.float64)
+        has_lean = ~np.isnan(lean)
+        pois[f'{column}_n'] = has_lean.astype(np.int64)
+        pois[f'{column}_sum'] = np.where(has_lean, lean, 0.0)
+        pois[f'{column}_weight'] = np.where(has_lean, visitors, 0.0)
+        pois[f'{column}_weighted'] = pois[f'{column}_sum'] * pois[f'{column}_weight']
+
+    tiles = build_tiles(pois)
+    tiles = tiles.sort_values(['filter_column', 'filter_value', 'level', 'quadkey'], ignore_index=True)
+
+    # Write next to the target and swap in, so the dashboard never reads a partial file
+    tmp_file = TILES_FILE.with_name(TILES_FILE.name + '.tmp')
+    tiles.to_parquet(tmp_file, index=False, row_group_size=ROW_GROUP_SIZE, compression='zstd')
+    os.replace(tmp_file, TILES_FILE)
+
+    size_mb = TILES_FILE.stat().st_size / (1024 * 1024)
+    print(f"\nWrote {len(tiles):,} tiles ({size_mb:.1f} MB) to {TILES_FILE} in {time() - start:.0f}s")
+    for level, n in tiles[tiles['filter_column'] == ALL_VALUE].groupby('level').size().items():
+        print(f"  level {level}: {n:,} cells")
+
+
+if __name__ == "__main__":
+    main()